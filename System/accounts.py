@@ -0,0 +1,176 @@
+import collections
+import queue
+import sqlite3
+import threading
+import time
+from System.cache import *
+
+
+class Accounts(object):
+    class AccountsError(Exception):
+        pass
+
+    # Defaults for the optional [registration] section
+    cache_size = 4096
+    grace = 30
+
+    # Most queued operations run (and committed) in one transaction
+    batch = 256
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS accounts (name TEXT PRIMARY KEY, display TEXT NOT NULL, credential TEXT NOT NULL, "
+        "registered REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS nicks (nick TEXT PRIMARY KEY, account TEXT NOT NULL REFERENCES accounts(name), "
+        "registered REAL NOT NULL)"
+    ]
+
+    def __init__(self, file, log, cache_size=None):
+        self.file = file
+
+        # Read-through cache in front of the database, keyed by ("account", name) or ("nick", nick) with folded
+        # names. Misses are cached too (as False) since most nicks aren't registered
+        self.cache = Cache(cache_size or Accounts.cache_size)
+
+        # Finished operations as (callback, result), drained by the server loop
+        self.results = collections.deque()
+
+        self._log = log
+        self._queue = queue.Queue()
+
+        # WAL keeps commits cheap (appends, no rewriting of the main file) and lets e.g. backups read meanwhile
+        try:
+            self._connection = sqlite3.connect(self.file, check_same_thread=False, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+
+            for statement in Accounts.schema:
+                self._connection.execute(statement)
+        except sqlite3.Error as error:
+            raise self.AccountsError("Could not open account store '{0}': {1}".format(self.file, error))
+
+        # Every read and write happens on this thread, the server loop never waits for the disk
+        self._thread = threading.Thread(target=self.run, args=[])
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Call callback((display name, credential)) for account, or callback(None) if it doesn't exist
+    def account(self, name, callback):
+        self.read(("account", name.lower()), callback)
+
+    # Call callback(display name of the owning account) for nick, or callback(None) if it isn't registered
+    def nick_owner(self, nick, callback):
+        self.read(("nick", nick.lower()), callback)
+
+    # Answer from the cache straight away, otherwise queue the lookup for the database thread
+    def read(self, key, callback):
+        cached = self.cache.get(key, None)
+
+        if cached is not None:
+            callback(cached or None)
+        else:
+            self._queue.put((key[0], key[1:], callback))
+
+    # Create an account and register its name as a nick, callback(True) once it's committed or
+    # callback(False) if the account or nick already exists
+    def create(self, name, credential, callback):
+        self._queue.put(("create", (name, credential), callback))
+
+    # Database thread: take whatever has been queued, run it in one transaction and hand the results back
+    def run(self):
+        while True:
+            operations = [self._queue.get()]
+
+            while len(operations) < Accounts.batch:
+                try:
+                    operations.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            finished = []
+
+            try:
+                self._connection.execute("BEGIN")
+
+                for operation in operations:
+                    if operation is None:
+                        continue
+
+                    finished.append((operation[2], self.execute(operation[0], operation[1])))
+
+                self._connection.execute("COMMIT")
+            except sqlite3.Error as error:
+                self._log.warning("Account store operation failed: " + str(error))
+                finished = [(operation[2], None) for operation in operations if operation is not None]
+
+                if self._connection.in_transaction:
+                    self._connection.execute("ROLLBACK")
+
+            # Results only become visible once they're committed
+            self.results.extend(finished)
+
+            if None in operations:
+                self._connection.close()
+                return
+
+    def execute(self, kind, arguments):
+        if kind == "account":
+            row = self._connection.execute(
+                "SELECT display, credential FROM accounts WHERE name = ?", (arguments[0],)
+            ).fetchone()
+
+            return ("account", arguments[0]), tuple(row) if row is not None else False
+        elif kind == "nick":
+            row = self._connection.execute(
+                "SELECT display FROM nicks JOIN accounts ON accounts.name = nicks.account WHERE nick = ?", (arguments[0],)
+            ).fetchone()
+
+            return ("nick", arguments[0]), row[0] if row is not None else False
+        elif kind == "create":
+            name, credential = arguments
+
+            # Savepoint so a duplicate only undoes this operation, not the rest of the batch
+            self._connection.execute("SAVEPOINT create_account")
+
+            try:
+                self._connection.execute(
+                    "INSERT INTO accounts (name, display, credential, registered) VALUES (?, ?, ?, ?)",
+                    (name.lower(), name, credential, time.time())
+                )
+                self._connection.execute(
+                    "INSERT INTO nicks (nick, account, registered) VALUES (?, ?, ?)",
+                    (name.lower(), name.lower(), time.time())
+                )
+                self._connection.execute("RELEASE create_account")
+            except sqlite3.IntegrityError:
+                self._connection.execute("ROLLBACK TO create_account")
+                self._connection.execute("RELEASE create_account")
+                return None, False
+
+            return None, (name, credential)
+
+    # Deliver finished operations and fill the cache, called from the server loop
+    def complete(self):
+        while len(self.results):
+            callback, result = self.results.popleft()
+
+            if result is None:
+                callback(None)
+                continue
+
+            key, value = result
+
+            if key is not None:
+                self.cache.set(key, value)
+                callback(value or None)
+            # A new account, both lookups can be answered from memory from now on
+            elif value:
+                self.cache.set(("account", value[0].lower()), value)
+                self.cache.set(("nick", value[0].lower()), value[0])
+                callback(True)
+            else:
+                callback(False)
+
+    # Finish whatever is queued and close the database
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,316 @@
+import heapq
+import ipaddress
+import socket
+import time
+from System.mask import *
+
+
+class Radix(object):
+    # Path-compressed binary (Patricia) trie over the CIDR prefixes of one address family. Nodes are
+    # [network, prefix length, value, zero child, one child] and only exist where prefixes end or branch,
+    # so a lookup takes at most one step per branching point on the way down rather than one per bit
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [0, 0, None, None, None]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def bit(self, network, position):
+        return (network >> (self.bits - position - 1)) & 1
+
+    # Leading bits two prefixes have in common, up to the shorter of their lengths
+    def common(self, first, second, length):
+        if not length:
+            return 0
+
+        difference = (first ^ second) >> (self.bits - length)
+        return length - difference.bit_length()
+
+    def insert(self, network, length, value):
+        node = self.root
+
+        while True:
+            if node[1] == length:
+                if node[2] is None:
+                    self.size += 1
+
+                node[2] = value
+                return
+
+            branch = 3 + self.bit(network, node[1])
+            child = node[branch]
+
+            if child is None:
+                node[branch] = [network, length, value, None, None]
+                self.size += 1
+                return
+
+            shared = self.common(child[0], network, min(child[1], length))
+
+            if shared == child[1]:
+                node = child
+                continue
+
+            # The new prefix and child part ways (or the new one ends) above child, put a node there
+            fork = [network & self.mask(shared), shared, None, None, None]
+            fork[3 + self.bit(child[0], shared)] = child
+            node[branch] = fork
+
+            if shared == length:
+                fork[2] = value
+            else:
+                fork[3 + self.bit(network, shared)] = [network, length, value, None, None]
+
+            self.size += 1
+            return
+
+    def remove(self, network, length):
+        path = [self.root]
+
+        while path[-1][1] < length:
+            child = path[-1][3 + self.bit(network, path[-1][1])]
+
+            if child is None or child[1] > length or self.common(child[0], network, child[1]) != child[1]:
+                return None
+
+            path.append(child)
+
+        node = path[-1]
+
+        if node[1] != length or node[2] is None:
+            return None
+
+        value = node[2]
+        node[2] = None
+        self.size -= 1
+
+        # Fold away nodes that no longer end a prefix or branch (at most this one and a fork above it)
+        for index in range(len(path) - 1, 0, -1):
+            node, parent = path[index], path[index - 1]
+            children = [child for child in node[3:] if child is not None]
+
+            if node[2] is not None or len(children) == 2:
+                break
+
+            parent[3 + self.bit(node[0], parent[1])] = children[0] if len(children) else None
+
+        return value
+
+    # Value of the most specific prefix containing address, or None
+    def search(self, address):
+        node = self.root
+        found = None
+
+        while node is not None:
+            if node[1] and (address ^ node[0]) >> (self.bits - node[1]):
+                break
+
+            if node[2] is not None:
+                found = node[2]
+
+            if node[1] == self.bits:
+                break
+
+            node = node[3 + self.bit(address, node[1])]
+
+        return found
+
+    def mask(self, length):
+        return ((1 << length) - 1) << (self.bits - length) if length else 0
+
+
+class Bans(object):
+    class BansError(Exception):
+        pass
+
+    # K-lines are this server's own, G-lines are shared with every linked server
+    kinds = ["K", "G"]
+
+    def __init__(self):
+        # Folded mask -> {"kind", "mask", "setter", "reason", "time", "expires"}, expires is None for permanent bans
+        self.entries = {}
+
+        # "*@<address or CIDR>" bans go in the tries and are checked on accept(), before anything else happens
+        # to a connection. Other user@host masks can only be checked once the user and hostname are known
+        self.networks = {4: Radix(32), 6: Radix(128)}
+        self.masks = MaskList()
+
+        # (expires, folded mask) for temporary bans, stale pairs (a ban replaced or removed) are skipped
+        self.expiry = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    # "host" -> "*@host", ban masks always have a user part. Addresses and CIDRs are written out in their
+    # canonical form so any spelling of a network finds the same ban
+    @staticmethod
+    def normalise(mask):
+        mask = mask if "@" in mask else "*@" + mask
+        network = Bans.network(mask)
+
+        return mask if network is None else "*@" + str(network)
+
+    # "90" (seconds), "30m", "12h", "7d" or "0" (permanent) in seconds, None if it isn't a duration
+    @staticmethod
+    def duration(text):
+        units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+        multiplier = units.get(text[-1:].lower(), None)
+        number = text[:-1] if multiplier is not None else text
+
+        if not number.isdigit():
+            return None
+
+        return int(number) * (multiplier or 1)
+
+    # The network a "*@<address or CIDR>" mask covers, or None for a user@host mask
+    @staticmethod
+    def network(mask):
+        user, _, host = mask.rpartition("@")
+
+        if user != "*":
+            return None
+
+        try:
+            return ipaddress.ip_network(host, strict=False)
+        except ValueError:
+            return None
+
+    # (IP version, integer address) of a peer, IPv4-mapped IPv6 addresses count as IPv4. None for anything
+    # else (e.g. "localhost" for Unix domain peers). inet_pton is a good deal quicker than ipaddress here
+    @staticmethod
+    def address(ip_address):
+        try:
+            return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip_address), "big")
+        except OSError:
+            pass
+
+        try:
+            address = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip_address.split("%")[0]), "big")
+        except OSError:
+            return None
+
+        return (4, address & 0xFFFFFFFF) if address >> 32 == 0xFFFF else (6, address)
+
+    # Add (or replace) a ban, duration 0 is permanent. Returns the entry
+    def add(self, kind, mask, setter, reason, duration=0, when=None, expires=None):
+        mask = mask if "@" in mask else "*@" + mask
+        user, _, host = mask.rpartition("@")
+        network = Bans.network(mask)
+
+        if kind not in Bans.kinds:
+            raise self.BansError("Unknown ban type " + kind)
+        elif not len(user) or not len(host) or " " in mask or "!" in mask:
+            raise self.BansError("Invalid ban mask " + mask)
+
+        mask = mask if network is None else "*@" + str(network)
+        when = time.time() if when is None else when
+        expires = expires if expires is not None else (when + duration if duration > 0 else None)
+
+        self.discard(Mask.casefold(mask))
+
+        # The parsed prefix is kept so removing the ban needn't parse it again
+        entry = {
+            "kind": kind,
+            "mask": mask,
+            "setter": setter,
+            "reason": reason,
+            "time": when,
+            "expires": expires,
+            "network": [network.version, int(network.network_address), network.prefixlen] if network is not None else None
+        }
+
+        if network is not None:
+            self.networks[network.version].insert(entry["network"][1], entry["network"][2], entry)
+        else:
+            self.masks.add(mask, setter, when)
+
+        self.entries[Mask.casefold(mask)] = entry
+
+        if expires is not None:
+            heapq.heappush(self.expiry, (expires, Mask.casefold(mask)))
+
+        return entry
+
+    # Remove a ban, returns its entry or None if there was no such ban
+    def remove(self, mask):
+        return self.discard(Mask.casefold(Bans.normalise(mask)))
+
+    def discard(self, folded):
+        entry = self.entries.pop(folded, None)
+
+        if entry is None:
+            return None
+        elif entry["network"] is not None:
+            self.networks[entry["network"][0]].remove(entry["network"][1], entry["network"][2])
+        else:
+            self.masks.remove(entry["mask"])
+
+        return entry
+
+    # Ban covering a just-accepted connection's address, or None. Unix domain peers have no address
+    def check_address(self, ip_address):
+        address = Bans.address(ip_address)
+
+        if address is None:
+            return None
+
+        return self.networks[address[0]].search(address[1])
+
+    # Ban covering a registering client's user@host or user@address, or None
+    def check_user(self, user, hostname, ip_address):
+        entry = self.check_address(ip_address)
+
+        if entry is None and len(self.masks):
+            found = self.masks.match([user + "@" + hostname, user + "@" + ip_address])
+            entry = self.entries[Mask.casefold(found["mask"])] if found is not None else None
+
+        return entry
+
+    # Whether one ban entry covers user@hostname or user@ip_address
+    @staticmethod
+    def covers(entry, user, hostname, ip_address):
+        if entry["network"] is not None:
+            version, network, length = entry["network"]
+            address = Bans.address(ip_address)
+            bits = 32 if version == 4 else 128
+
+            return address is not None and address[0] == version and address[1] >> (bits - length) == network >> (bits - length)
+
+        return Mask.match(entry["mask"], user + "@" + hostname) or Mask.match(entry["mask"], user + "@" + ip_address)
+
+    # Drop bans whose time is up, returns their entries
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        expired = []
+
+        while len(self.expiry) and self.expiry[0][0] <= now:
+            expires, folded = heapq.heappop(self.expiry)
+            entry = self.entries.get(folded, None)
+
+            if entry is not None and entry["expires"] == expires:
+                expired.append(self.discard(folded))
+
+        return expired
+
+    # Entries of one kind, oldest first
+    def list(self, kind):
+        return sorted([entry for entry in self.entries.values() if entry["kind"] == kind], key=lambda entry: entry["time"])
+
+    def export_state(self):
+        return list(self.entries.values())
+
+    # Entries come back already normalised and parsed, so large ban lists don't slow a hot restart down
+    def import_state(self, state):
+        for entry in state:
+            folded = Mask.casefold(entry["mask"])
+            self.entries[folded] = entry
+
+            if entry["network"] is not None:
+                self.networks[entry["network"][0]].insert(entry["network"][1], entry["network"][2], entry)
+            else:
+                self.masks.add(entry["mask"], entry["setter"], entry["time"])
+
+            if entry["expires"] is not None:
+                heapq.heappush(self.expiry, (entry["expires"], folded))
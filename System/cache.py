@@ -0,0 +1,61 @@
+import collections
+import time
+
+
+class Cache(object):
+    # A bounded mapping that drops its least recently used entries first, entries may also expire after
+    # ttl seconds (None keeps them until they're pushed out)
+    def __init__(self, limit, ttl=None):
+        self.limit = limit
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        entry = self.entries.get(key, None)
+        return entry is not None and (entry[1] is None or entry[1] > time.time())
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key, None)
+
+        if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+            if entry is not None:
+                del self.entries[key]
+
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+
+        self.entries[key] = (value, time.time() + ttl if ttl is not None else None)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        self.entries.clear()
+
+    # Drop everything that has expired, returns the number of entries removed
+    def expire(self):
+        now = time.time()
+        expired = [key for key, entry in self.entries.items() if entry[1] is not None and entry[1] <= now]
+
+        for key in expired:
+            del self.entries[key]
+
+        return len(expired)
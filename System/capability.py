@@ -0,0 +1,126 @@
+import calendar
+import itertools
+import time
+
+
+class Capability(object):
+    # IRCv3 capabilities we implement, each one is a bit in Client.caps
+    message_tags = 1
+    server_time = 2
+    batch = 4
+    echo_message = 8
+    sasl = 16
+    chathistory = 32
+
+    names = {
+        "message-tags": message_tags,
+        "server-time": server_time,
+        "batch": batch,
+        "echo-message": echo_message,
+        "sasl": sasl,
+        "draft/chathistory": chathistory
+    }
+
+    # Values advertised alongside a capability to CAP LS 302 clients
+    values = {
+        "sasl": "PLAIN,SCRAM-SHA-256"
+    }
+
+    # Capabilities that change how an outgoing line is serialised, recipients are grouped by these bits
+    serialised = message_tags | server_time | batch
+
+    # Clients may send at most this much tag data (the leading "@" and trailing space excluded)
+    tag_limit = 4094
+
+    escapes = [("\\", "\\\\"), (";", "\\:"), (" ", "\\s"), ("\r", "\\r"), ("\n", "\\n")]
+
+    # Batch reference tags only have to be unique per connection, a counter is plenty
+    references = itertools.count(1)
+
+    # CAP LS reply, version 302 and up also get capability values
+    @staticmethod
+    def advertise(version):
+        if version < 302:
+            return list(Capability.names.keys())
+
+        return [name + "=" + Capability.values[name] if name in Capability.values else name for name in Capability.names]
+
+    # Names of the capabilities set in a bitfield
+    @staticmethod
+    def enabled(caps):
+        return [name for name, flag in Capability.names.items() if caps & flag]
+
+    @staticmethod
+    def reference():
+        return "{0:x}".format(next(Capability.references))
+
+    # ISO 8601 timestamp with milliseconds, as the server-time specification wants it
+    @staticmethod
+    def timestamp(now=None):
+        now = time.time() if now is None else now
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now)) + ".{0:03d}Z".format(int(now * 1000) % 1000)
+
+    # Milliseconds since the epoch from a timestamp() string (the same precision it was written with),
+    # raises ValueError if it isn't one
+    @staticmethod
+    def parse_timestamp(value):
+        seconds, _, fraction = value.rstrip("Z").partition(".")
+        milliseconds = int(fraction[:3].ljust(3, "0")) if len(fraction) else 0
+
+        return calendar.timegm(time.strptime(seconds, "%Y-%m-%dT%H:%M:%S")) * 1000 + milliseconds
+
+    @staticmethod
+    def escape(value):
+        for character, escaped in Capability.escapes:
+            value = value.replace(character, escaped)
+
+        return value
+
+    @staticmethod
+    def unescape(value):
+        output = ""
+        characters = iter(value)
+
+        for character in characters:
+            if character == "\\":
+                character = next(characters, "")
+                output += {":": ";", "s": " ", "r": "\r", "n": "\n"}.get(character, character)
+            else:
+                output += character
+
+        return output
+
+    # Split "a=1;+b;c=x\\sy" into a dict, tags without a value map to ""
+    @staticmethod
+    def parse_tags(tags):
+        parsed = {}
+
+        for tag in tags.split(";"):
+            if len(tag):
+                key, _, value = tag.partition("=")
+                parsed[key] = Capability.unescape(value)
+
+        return parsed
+
+    # Prefix line with the tags a client with caps is allowed to see. tags may hold "batch" and
+    # client-only ("+" prefixed) tags, server-time is added from now
+    @staticmethod
+    def render(line, caps, tags, now):
+        rendered = []
+
+        if caps & Capability.server_time:
+            rendered.append("time=" + Capability.timestamp(now))
+
+        for key, value in tags.items():
+            if key == "batch":
+                if not caps & Capability.batch:
+                    continue
+            elif not caps & Capability.message_tags:
+                continue
+
+            rendered.append(key + "=" + Capability.escape(value) if len(value) else key)
+
+        if not len(rendered):
+            return line
+
+        return "@" + ";".join(rendered) + " " + line
@@ -1,9 +1,24 @@
+import collections
+
+from System.capability import *
 from System.irc import *
+from System.mask import *
 
 import time
 
 
 class Channel(object):
+    # Most masks a single ban or exception list will hold
+    list_limit = 4096
+
+    # Outstanding invites per channel, and how long (in seconds) an unused one stays valid
+    invite_limit = 64
+    invite_expiry = 3600
+
+    # Longest topic kept, and longest run of names put in a single 353 line
+    topic_length = 390
+    names_length = 400
+
     def __init__(self, server, channel):
         self._server = server
 
@@ -14,24 +29,136 @@ class Channel(object):
         self.clients = []
         self.modes = {}
 
+        # Ban and ban exception (+b/+e) masks
+        self.bans = MaskList()
+        self.exceptions = MaskList()
+
+        # Invited clients (client -> expiry time), oldest first so the list can be trimmed from the front
+        self.invites = collections.OrderedDict()
+
+        # Cached can-speak verdict per member, dropped whenever modes, bans, the member's powers or
+        # their nick/host change
+        self.verdicts = {}
+
+        # Server links with members in this channel (link -> member count), see Links.channel_message
+        self.links = {}
+
         self.topic = {
             "content": "",
             "time": time.time(),
             "author": None
         }
 
-    def broadcast_exclusive(self, exclusive_client, buffer):
-        for client in self.clients:
-            if client is not exclusive_client:
-                client.write(buffer)
+    # Serialisable snapshot, used by hot restarts
+    def export_state(self):
+        return {
+            "name": self.name,
+            "created": self.created,
+            "modes": self.modes,
+            "topic": self.topic,
+            "bans": self.bans.export_state(),
+            "exceptions": self.exceptions.export_state(),
+            "clients": [client.nick for client in self.clients]
+        }
 
-    def broadcast_inclusive(self, buffer):
-        for client in self.clients:
-            client.write(buffer)
+    # Members must already have been restored on the server
+    def import_state(self, state):
+        self.created = state["created"]
+        self.modes = state["modes"]
+        self.topic = state["topic"]
+        self.bans.import_state(state.get("bans", []))
+        self.exceptions.import_state(state.get("exceptions", []))
+        self.clients = [self._server.get_client(nick) for nick in state.get("clients", []) if self._server.get_client(nick) is not None]
 
-    def join_client(self, client, key):
+    # Membership bookkeeping shared by local and remote joins/parts
+    def add_member(self, client):
         self.clients.append(client)
         client.channels.append(self.name)
+        self._server.resize_channel(self, len(self.clients) - 1)
+
+        if client.link is not None:
+            self.links[client.link] = self.links.get(client.link, 0) + 1
+
+    def remove_member(self, client):
+        self.clients.remove(client)
+        client.channels.remove(self.name)
+        client.channel_modes.pop(self.name, None)
+        self.verdicts.pop(client, None)
+        self._server.resize_channel(self, len(self.clients) + 1)
+
+        if client.link is not None:
+            self.links[client.link] -= 1
+
+            if self.links[client.link] <= 0:
+                del self.links[client.link]
+
+        # No clients left, destroy channel unless it's permanent
+        if len(self.clients) == 0 and "P" not in self.modes:
+            self.destroyed = True
+
+    # Channel modes as a mode string plus its parameters
+    def mode_parameters(self):
+        modes = "+" + "".join(self.modes.keys())
+        arguments = [value for value in self.modes.values() if len(value)]
+
+        return modes, arguments
+
+    # Take on modes a linked server has for this channel
+    def merge_modes(self, modes, arguments):
+        arguments = list(arguments)
+
+        for mode in modes:
+            if mode in IRC.channel_modes and mode not in IRC.channel_symbols.values() and mode not in IRC.channel_list_modes:
+                self.modes[mode] = arguments.pop(0) if IRC.channel_modes[mode] > 0 and len(arguments) else ""
+
+        self.verdicts.clear()
+        self.save()
+
+    # Journal the channel if it's permanent (+P), called whenever persisted state changes
+    def save(self):
+        if self._server.persistence is not None and "P" in self.modes:
+            state = self.export_state()
+            del state["clients"]
+
+            self._server.persistence.record(state)
+
+    # A ban not covered by an exception, checked against every host the client could have been banned by
+    def banned(self, client):
+        hostmasks = client.hostmasks()
+        return self.bans.match(hostmasks) is not None and self.exceptions.match(hostmasks) is None
+
+    # Whether client may send to the channel. Members are answered from the verdict cache so the check
+    # stays O(1) however many bans there are, outsiders (only allowed without +n) are checked every time
+    def can_speak(self, client):
+        if self.name not in client.channels:
+            return "n" not in self.modes and "m" not in self.modes and not self.banned(client)
+
+        verdict = self.verdicts.get(client, None)
+
+        if verdict is None:
+            verdict = len(client.channel_modes[self.name]) > 0 or ("m" not in self.modes and not self.banned(client))
+            self.verdicts[client] = verdict
+
+        return verdict
+
+    # Channel operator (owner, admin or op), or halfop too when halfop is set
+    def operator(self, client, halfop=False):
+        powers = {"q", "a", "o", "h"} if halfop else {"q", "a", "o"}
+        return len(powers.intersection(client.channel_modes.get(self.name, []))) > 0
+
+    def list_mode(self, letter):
+        return self.bans if letter == "b" else self.exceptions
+
+    def broadcast_exclusive(self, exclusive_client, buffer, tags=None, required=0, now=None):
+        self._server.fanout([client for client in self.clients if client is not exclusive_client], buffer, tags, required, now)
+        self._server.metrics.observe("pyrcd_broadcast_fanout", len(self.clients) - 1, "size")
+
+    def broadcast_inclusive(self, buffer, tags=None, required=0, now=None):
+        self._server.fanout(self.clients, buffer, tags, required, now)
+        self._server.metrics.observe("pyrcd_broadcast_fanout", len(self.clients), "size")
+
+    def join_client(self, client, key):
+        self.add_member(client)
         join_string = client.substitute(":{identifier} JOIN " + self.name)
 
         # Only 1 client in the channel, give them operator
@@ -40,61 +167,231 @@ class Channel(object):
         else:
             client.channel_modes[self.name] = []
 
-        # Start calculating a list of names/modes at the same time as broadcasting the JOIN
+        self.broadcast_inclusive(join_string)
+
+        if self.topic["author"] is not None:
+            client.num_332_channel_topic(self.name, self.topic["content"])
+            client.num_333_channel_topic_time(self.name, self.topic["time"], self.topic["author"])
+
+        self.send_names(client)
+
+    # 353 lines (split to stay well under the line length limit) and the 366, invisible users are only
+    # listed for other members
+    def send_names(self, client):
+        member = self.name in client.channels
         names = []
+        length = 0
 
         for channel_client in self.clients:
-            channel_client.write(join_string)
+            if not member and "i" in channel_client.modes and channel_client is not client:
+                continue
 
             for power in IRC.channel_power_symbols:
                 # Power found
                 if power in channel_client.channel_modes[self.name]:
-                    names.append(IRC.channel_powers[power] + channel_client.get_identifier())
+                    name = IRC.channel_powers[power] + channel_client.get_identifier()
                     break
                 # Client has no power
                 elif power == "v":
-                    names.append(channel_client.get_identifier())
+                    name = channel_client.get_identifier()
 
-        if self.topic["author"] is not None:
-            client.num_332_channel_topic(self.name, self.topic["content"])
-            client.num_333_channel_topic_time(self.name, self.topic["time"], self.topic["author"])
+            if length + len(name) > Channel.names_length:
+                client.num_353_names(self.name, names)
+                names = []
+                length = 0
+
+            names.append(name)
+            length += len(name) + 1
+
+        if len(names):
+            client.num_353_names(self.name, names)
 
-        client.num_353_names(self.name, names)
         client.num_366_end_of_names(self.name)
 
+    def invite(self, client):
+        self.invites.pop(client, None)
+        self.invites[client] = time.time() + Channel.invite_expiry
+
+        while len(self.invites) > Channel.invite_limit:
+            self.invites.popitem(last=False)
+
+    # Whether client holds an unexpired invite, it's used up by the JOIN it lets through
+    def invited(self, client, use=False):
+        expiry = self.invites.get(client, None)
+
+        if expiry is None:
+            return False
+        elif expiry < time.time() or use:
+            del self.invites[client]
+
+        return expiry >= time.time()
+
+    # TOPIC: members can change it, on +t only (half)operators
+    def handle_topic(self, client, topic):
+        if self.name not in client.channels:
+            client.num_442_not_on_channel(self.name)
+        elif "t" in self.modes and not self.operator(client, True):
+            client.num_482_not_channel_operator(self.name)
+        else:
+            self.set_topic(client, topic[:Channel.topic_length])
+            self._server.links.topic(client, self)
+            self._server.log.custom("TOPIC", "[{0}]: {1} ({2})".format(self.name, self.topic["content"], client.nick))
+
+    # Store and announce a new topic, source is the local or remote client that set it
+    def set_topic(self, source, topic):
+        self.topic = {"content": topic, "time": time.time(), "author": source.get_identifier()}
+        self.broadcast_inclusive(source.substitute(":{identifier} TOPIC {0} :{1}").format(self.name, topic))
+        self.save()
+
+    # KICK: operators can kick anyone, halfops only members without a power above voice
+    def handle_kick(self, client, target, reason):
+        if self.name not in client.channels:
+            client.num_442_not_on_channel(self.name)
+        elif not self.operator(client, True):
+            client.num_482_not_channel_operator(self.name)
+        elif target is None or self.name not in target.channels:
+            client.num_441_they_arent_on_channel(self.name, target.nick if target is not None else "*")
+        elif not self.operator(client) and self.operator(target, True):
+            client.num_482_not_channel_operator(self.name)
+        else:
+            self._server.links.kick(client, self, target, reason)
+            self.kick(client, target, reason)
+
+    # Remove target, telling the channel (target included), remote kicks come straight here
+    def kick(self, source, target, reason):
+        self.broadcast_inclusive(source.substitute(":{identifier} KICK {0} {1} :{2}").format(self.name, target.nick, reason))
+        self.remove_member(target)
+
+        if self.destroyed:
+            self._server.deregister_channel(self.name)
+
+        self._server.log.custom("KICK", "[{0}]: {1} by {2} ({3})".format(self.name, target.nick, source.nick, reason))
+
+    # A member on another server joined, their powers come from the originating server
+    def join_remote(self, client, powers):
+        self.add_member(client)
+        client.channel_modes[self.name] = powers
+
+        self.broadcast_exclusive(client, client.substitute(":{identifier} JOIN " + self.name))
+
+        if len(powers):
+            self.broadcast_exclusive(client, ":{0} MODE {1} +{2} {3}".format(
+                client.origin,
+                self.name,
+                "".join(powers),
+                " ".join([client.nick] * len(powers))
+            ))
+
     def remove_client(self, client, arguments):
         part_string = client.substitute(":{identifier} PART " + self.name + " :" + arguments)
         self.broadcast_inclusive(part_string)
 
-        self.clients.remove(client)
-        client.channels.remove(self.name)
-        del client.channel_modes[self.name]
+        self.remove_member(client)
 
-        # No clients left, destroy channel
-        if len(self.clients) == 0:
-            self.destroyed = True
+    # Deliver a PRIVMSG/NOTICE to local members and on to any linked servers with members, and keep it for CHATHISTORY
+    def relay(self, client, command, text, from_link=None):
+        message = client.substitute(":{identifier} {0} {1} :{2}").format(command, self.name, text)
+        msgid = self._server.history.msgid()
+        tags = dict(client.tags, msgid=msgid)
+        now = time.time()
 
-    def handle_message(self, client, text):
-        # Client is in channel
-        if self.name in client.channels:
-            message = client.substitute(":{identifier} PRIVMSG {0} :{1}").format(self.name, text)
-            self.broadcast_exclusive(client, message)
+        # Senders with echo-message get their own copy, tagged the same as everyone else's
+        if client.caps & Capability.echo_message:
+            self.broadcast_inclusive(message, tags, now=now)
+        else:
+            self.broadcast_exclusive(client, message, tags, now=now)
+
+        self._server.history.record(self.name, msgid, now, message)
 
-            self._server.log.custom("PRIVMSG", "[{0} to {1}]: {2}".format(client.name, self.name, text))
-        # Client in not in channel
+        if len(self.links):
+            self._server.links.channel_message(client, self, command, text, from_link)
+
+        self._server.log.custom(command, "[{0} to {1}]: {2}".format(client.nick, self.name, text))
+
+    def handle_message(self, client, text):
+        if self.can_speak(client):
+            self.relay(client, "PRIVMSG", text)
+        # Banned, moderated (+m) without a power, or from outside a +n channel
         else:
-            client.num_442_not_on_channel(self.name)
+            client.num_404_cannot_send_to_channel(self.name)
 
     def handle_notice(self, client, text):
-        # Client is in channel
-        if self.name in client.channels:
-            message = client.substitute(":{identifier} NOTICE {0} :{1}").format(self.name, text)
-            self.broadcast_exclusive(client, message)
+        if self.can_speak(client):
+            self.relay(client, "NOTICE", text)
+        # Banned, moderated (+m) without a power, or from outside a +n channel
+        else:
+            client.num_404_cannot_send_to_channel(self.name)
+
+    # Client-only tags with no message, only members that negotiated message-tags receive it
+    def handle_tagmsg(self, client):
+        if not self.can_speak(client):
+            client.num_404_cannot_send_to_channel(self.name)
+            return
+
+        message = client.substitute(":{identifier} TAGMSG " + self.name)
 
-            self._server.log.custom("NOTICE", "[{0} to {1}]: {2}".format(client.name, self.name, text))
-        # Client in not in channel
+        if client.caps & Capability.echo_message:
+            self.broadcast_inclusive(message, client.tags, Capability.message_tags)
         else:
-            client.num_442_not_on_channel(self.name)
+            self.broadcast_exclusive(client, message, client.tags, Capability.message_tags)
+
+    # Mode change made on another server, member arguments arrive as UIDs
+    def apply_remote_mode(self, source, modes, arguments):
+        display = []
+        permanent = "P" in self.modes
+
+        for bunch in IRC.mode_deconstruct(IRC.channel_modes, modes, arguments, IRC.channel_set_only_modes):
+            if bunch["type"] in IRC.channel_symbols.values():
+                target = self._server.get_client_by_uid(bunch["arguments"])
+
+                if target is None or self.name not in target.channels:
+                    continue
+
+                powers = target.channel_modes[self.name]
+
+                if bunch["mode"] == "+" and bunch["type"] not in powers:
+                    powers.append(bunch["type"])
+                elif bunch["mode"] == "-" and bunch["type"] in powers:
+                    powers.remove(bunch["type"])
+
+                self.verdicts.pop(target, None)
+                display.append((bunch["mode"] + bunch["type"], target.nick))
+            elif bunch["type"] in IRC.channel_list_modes:
+                masks = self.list_mode(bunch["type"])
+
+                if bunch["mode"] == "+":
+                    changed = masks.add(bunch["arguments"], source.get_identifier())
+                else:
+                    changed = masks.remove(bunch["arguments"])
+
+                if changed:
+                    display.append((bunch["mode"] + bunch["type"], bunch["arguments"]))
+            else:
+                if bunch["mode"] == "+":
+                    self.modes[bunch["type"]] = bunch["arguments"] or ""
+                else:
+                    self.modes.pop(bunch["type"], None)
+
+                display.append((bunch["mode"] + bunch["type"], bunch["arguments"]))
+
+        if len(display):
+            self.verdicts.clear()
+            self.broadcast_inclusive(source.substitute(":{identifier} MODE {0} {1}{2}").format(
+                self.name,
+                "".join(change for change, argument in display),
+                "".join(" " + argument for change, argument in display if argument)
+            ))
+
+            self.save()
+
+        # Made non-permanent elsewhere
+        if permanent and "P" not in self.modes:
+            if self._server.persistence is not None:
+                self._server.persistence.remove(self.name)
+
+            if len(self.clients) == 0:
+                self.destroyed = True
+                self._server.deregister_channel(self.name)
 
     def handle_mode(self, client, arguments):
         arguments = arguments.split(" ")
@@ -105,7 +402,11 @@ class Channel(object):
         else:
             arguments = []
 
-        modes = IRC.mode_deconstruct(IRC.channel_modes, modes, arguments)
+        # "MODE #channel b" asks for the list rather than changing it
+        if modes.lstrip("+") in IRC.channel_list_modes and not len(arguments):
+            return self.send_list(client, modes.lstrip("+"))
+
+        modes = IRC.mode_deconstruct(IRC.channel_modes, modes, arguments, IRC.channel_set_only_modes)
 
         for bunch in modes:
             try:
@@ -115,37 +416,51 @@ class Channel(object):
                 pass
 
     def mode_o(self, client, mode, arguments):
+        self.mode_power(client, mode, arguments, "o")
+
+    def mode_h(self, client, mode, arguments):
+        self.mode_power(client, mode, arguments, "h")
+
+    def mode_v(self, client, mode, arguments):
+        self.mode_power(client, mode, arguments, "v")
+
+    # Grant or revoke a channel power (+o/+h/+v), halfops can only hand out voice
+    def mode_power(self, client, mode, arguments, power):
         nick_lower = arguments.lower()
 
         # Client is actually in this channel
         if self.name in client.channels:
-            # User has op
-            if "o" in client.channel_modes[self.name]:
-                # User isn't trying to set op on themseves
-                if nick_lower != client.nick.lower():
+            # User has op, or is a halfop (de)voicing someone
+            if self.operator(client) or (power == "v" and "h" in client.channel_modes[self.name]):
+                # User isn't trying to give themselves more power
+                if nick_lower != client.nick.lower() or mode == "-":
                     # Target is actually online
                     if nick_lower in self._server.nicks:
                         # Target is in this channel
-                        if self._server.clients[self._server.nicks[nick_lower]] in self.clients:
-                            target = self._server.clients[self._server.nicks[nick_lower]]
+                        if self._server.get_client(nick_lower) in self.clients:
+                            target = self._server.get_client(nick_lower)
                             process = False
 
-                            # User is trying to grant op
-                            if mode == "+" and "o" not in target.channel_modes[self.name]:
-                                target.channel_modes[self.name].append("o")
+                            # User is trying to grant the power
+                            if mode == "+" and power not in target.channel_modes[self.name]:
+                                target.channel_modes[self.name].append(power)
                                 process = True
-                            # User is trying to remove op
-                            elif mode == "-" and "o" in target.channel_modes[self.name]:
-                                target.channel_modes[self.name].remove("o")
+                            # User is trying to remove the power
+                            elif mode == "-" and power in target.channel_modes[self.name]:
+                                target.channel_modes[self.name].remove(power)
                                 process = True
 
                             if process:
-                                self.broadcast_inclusive(":{0} MODE {1} {2}o {3}".format(
+                                self.verdicts.pop(target, None)
+                                self.broadcast_inclusive(":{0} MODE {1} {2}{3} {4}".format(
                                     client.get_identifier(),
                                     self.name,
                                     mode,
+                                    power,
                                     target.nick
                                 ))
+
+                                self._server.links.channel_mode(client, self, mode + power, [target])
                         # Target is not in this channel
                         else:
                             client.num_441_they_arent_on_channel(self.name, arguments)
@@ -154,10 +469,128 @@ class Channel(object):
                         client.num_401_no_such_recipient(arguments)
             # User has halfop
             elif "h" in client.channel_modes[self.name]:
-                client.num_460_halfops_cannot_set_mode("o")
+                client.num_460_halfops_cannot_set_mode(power)
             # User has no relevant power
             else:
                 client.num_482_not_channel_operator(self.name)
         # Client isn't in this channel
         else:
-            client.num_482_not_channel_operator()
\ No newline at end of file
+            client.num_482_not_channel_operator(self.name)
+
+    def mode_k(self, client, mode, arguments):
+        self.mode_setting(client, mode, arguments, "k")
+
+    def mode_l(self, client, mode, arguments):
+        self.mode_setting(client, mode, arguments, "l")
+
+    def mode_i(self, client, mode, arguments):
+        self.mode_setting(client, mode, arguments, "i")
+
+        if mode == "-":
+            self.invites.clear()
+
+    def mode_m(self, client, mode, arguments):
+        self.mode_setting(client, mode, arguments, "m")
+
+    def mode_n(self, client, mode, arguments):
+        self.mode_setting(client, mode, arguments, "n")
+
+    def mode_t(self, client, mode, arguments):
+        self.mode_setting(client, mode, arguments, "t")
+
+    # Flag and parameter modes (+i, +k key, +l limit, +m, +n, +t), operators and halfops only
+    def mode_setting(self, client, mode, arguments, letter):
+        if self.name not in client.channels or not self.operator(client, True):
+            client.num_482_not_channel_operator(self.name)
+            return
+
+        value = arguments if arguments is not None and mode == "+" else ""
+
+        if mode == "+":
+            # Keys are a single word, limits a positive number
+            if letter == "k" and (not len(value) or "," in value):
+                return
+            elif letter == "l" and (not value.isdigit() or int(value) < 1):
+                return
+            elif letter in self.modes and self.modes[letter] == value:
+                return
+
+            self.modes[letter] = value
+        elif letter in self.modes:
+            del self.modes[letter]
+        else:
+            return
+
+        # Removing a key still takes a parameter, whatever it was
+        shown = value if mode == "+" else ("*" if letter == "k" else "")
+
+        self.verdicts.clear()
+        self.broadcast_inclusive(client.substitute(":{identifier} MODE {0} {1}{2}{3}").format(
+            self.name,
+            mode,
+            letter,
+            " " + shown if len(shown) else ""
+        ))
+
+        self._server.links.channel_mode(client, self, mode + letter, [shown] if len(shown) else [])
+        self.save()
+
+    # Ban and exception lists can be long, they're streamed like a WHO reply
+    def send_list(self, client, letter):
+        if letter == "b":
+            lines = (client.num_367_ban_list(self.name, entry) for entry in self.bans)
+            client.stream(lines, client.num_368_end_of_ban_list(self.name))
+        else:
+            lines = (client.num_348_exception_list(self.name, entry) for entry in self.exceptions)
+            client.stream(lines, client.num_349_end_of_exception_list(self.name))
+
+    def mode_b(self, client, mode, arguments):
+        self.mode_list(client, mode, arguments, "b")
+
+    def mode_e(self, client, mode, arguments):
+        self.mode_list(client, mode, arguments, "e")
+
+    # Add or remove a mask on one of the list modes, operators and halfops only
+    def mode_list(self, client, mode, mask, letter):
+        masks = self.list_mode(letter)
+        mask = Mask.normalise(mask)
+
+        if self.name not in client.channels or not self.operator(client, True):
+            client.num_482_not_channel_operator(self.name)
+            return
+        elif mode == "+" and len(masks) >= Channel.list_limit:
+            client.num_478_list_full(self.name, mask, letter)
+            return
+
+        if mode == "+":
+            changed = masks.add(mask, client.get_identifier())
+        else:
+            changed = masks.remove(mask)
+
+        if changed:
+            self.verdicts.clear()
+            self.broadcast_inclusive(client.substitute(":{identifier} MODE {0} {1}{2} {3}").format(self.name, mode, letter, mask))
+            self._server.links.channel_mode(client, self, mode + letter, [mask])
+            self.save()
+
+    def mode_P(self, client, mode, arguments):
+        # Only IRC operators can make a channel permanent
+        if "o" not in client.modes:
+            client.num_481_no_privileges()
+        elif mode == "+" and "P" not in self.modes:
+            self.modes["P"] = ""
+            self.broadcast_inclusive(":{0} MODE {1} +P".format(client.get_identifier(), self.name))
+            self._server.links.channel_mode(client, self, "+P", [])
+            self.save()
+        elif mode == "-" and "P" in self.modes:
+            del self.modes["P"]
+            self.broadcast_inclusive(":{0} MODE {1} -P".format(client.get_identifier(), self.name))
+            self._server.links.channel_mode(client, self, "-P", [])
+
+            if self._server.persistence is not None:
+                self._server.persistence.remove(self.name)
+
+            # Nobody left to keep it alive
+            if len(self.clients) == 0:
+                self.destroyed = True
+                self._server.deregister_channel(self.name)
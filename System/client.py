@@ -1,15 +1,38 @@
+import collections
+import hmac
 import socket
+import ssl
 import time
 import threading
 
+from System.capability import *
+from System.configuration import *
+from System.handoff import *
 from System.irc import *
+from System.mask import *
+from System.profiler import *
+from System.sasl import *
+from System.history import *
+from System.bans import *
 
 
 class Client(object):
-    # Class constructor
-    def __init__(self, server, handle, address):
-        self.lock = threading.Lock()
+    # Default cap on unsent output before a client is dropped (overridden by [server] "sendq")
+    sendq = 1048576
+
+    # Streamed replies (WHO, LIST) pause while more than this many bytes are queued, and write at most
+    # stream_lines lines per loop iteration
+    stream_watermark = 16384
+    stream_lines = 256
+
+    # Default MONITOR list size, advertised in ISUPPORT
+    monitor_limit = 100
 
+    # Most nicks a single WHOWAS looks up
+    whowas_targets = 10
+
+    # Class constructor
+    def __init__(self, server, handle, address, state=None):
         # Reset properties
         self.active = True
 
@@ -19,40 +42,130 @@ class Client(object):
         self.authorised = False
         self.pong = {"sent": 0, "pending": False}
 
+        # IRCv3 capabilities (Capability bits), registration waits for CAP END once negotiation starts
+        self.caps = 0
+        self.cap_version = 0
+        self.negotiating = False
+
+        # Client-only tags on the command being handled, passed on with PRIVMSG/NOTICE/TAGMSG
+        self.tags = {}
+
+        # Account logged into with SASL, and the exchange in progress (see Sasl.authenticate)
+        self.account = None
+        self.sasl_session = None
+
+        # Registration waits for the address's DNSBL check (see Dnsbl.check)
+        self.dnsbl_pending = False
+
         # Client attributes
         self.nick = None
         self.user = None
         self.name = None
         self.modes = []
+        self.oper = None
 
         # Channel information
         self.channels = []
         self.channel_modes = {}
 
+        # Folded nicks this client wants online/offline notifications for (MONITOR)
+        self.monitoring = set()
+
         # Initialise object
         self._server = server
         self._handle = handle
+        self._handle.setblocking(False)
+
+        # Partial input line, and output waiting for the socket to become writable
+        self.recv_queue = b""
+        self.send_queue = bytearray()
+
+        # Long replies still being written out, as (line generator, final line) pairs
+        self.streams = collections.deque()
+
+        # Clients are keyed by descriptor, it's unique for as long as the connection is open
+        self.index = handle.fileno()
 
         # Client address information
-        self.index = address[0] + ":" + str(address[1])
         self.ip_address = address[0]
         self.port = address[1]
         self.hostname = address[0]
         self.masked_hostname = self.calculate_hostname()
+        self.secure = isinstance(handle, ssl.SSLSocket)
+
+        # Network identity, remote servers refer to us by UID rather than nick
+        self.uid = server.links.next_uid()
+        self.link = None
+        self.origin = server.config.server["fqdn"]
+        self.nick_time = time.time()
+        self.quit_reason = None
+
+        # Carried over from a previous process, registration and lookups have already happened
+        if state is not None:
+            self.import_state(state)
+            self._server.register_client(self)
+
+            if self.nick is not None:
+                self._server.register_nick(self.nick, self, False)
+
+            if self.authorised:
+                self._server.index_host(self)
+                self._server.index_user(self)
+
+            self._server.add_monitors(self, state.get("monitoring", []))
+
+            # A DNSBL check the previous process didn't finish starts over, registration keeps waiting on it
+            if self.dnsbl_pending:
+                self.dnsbl_pending = False
+                self._server.dnsbl.check(self)
+
+            return
 
         # Register ourselves with the server
         self._server.register_client(self)
 
-        # Boot the client off the network if we're full
+        # Boot the client off the network if we're full (only our own users count)
         if len(self._server.clients) >= self._server.config.server["client_limit"]:
             self.close_link("Server is full; please try again later")
 
         # Hostname lookup
-        try:
-            lookup = threading.Thread(target=self.lookup_hostname, args=[])
-            lookup.start()
-        except threading.ThreadError:
-            self.notice_auth("Failed to lookup hostname, using IP address (" + self.address + ") instead")
+        if self.active:
+            self.lookup_hostname()
+
+        # DNSBL check, alongside the hostname lookup
+        if self.active:
+            self._server.dnsbl.check(self)
+
+    # Serialisable snapshot, used by hot restarts
+    def export_state(self):
+        return {
+            "address": [self.ip_address, self.port],
+            "connected": self.connected,
+            "last_cmd": self.last_cmd,
+            "authorised": self.authorised,
+            "caps": self.caps,
+            "cap_version": self.cap_version,
+            "account": self.account,
+            "negotiating": self.negotiating,
+            "pong": self.pong,
+            "nick": self.nick,
+            "nick_time": self.nick_time,
+            "user": self.user,
+            "name": self.name,
+            "modes": self.modes,
+            "oper": self.oper,
+            "channels": self.channels,
+            "channel_modes": self.channel_modes,
+            "monitoring": sorted(self.monitoring),
+            "hostname": self.hostname,
+            "masked_hostname": self.masked_hostname,
+            "dnsbl_pending": self.dnsbl_pending
+        }
+
+    def import_state(self, state):
+        for key, value in state.items():
+            if key not in ("address", "monitoring"):
+                setattr(self, key, value)
 
     # String value substitution for quicker reply-building
     def substitute(self, buffer):
@@ -72,20 +185,103 @@ class Client(object):
 
         return buffer
 
-    # Quicker socket "send" alias with the required unicode<->bytes conversion
+    # Queue a line and try to send it straight away, whatever the socket won't take is sent once it's writable
     def write(self, buffer):
-        try:
-            if self._handle.send((buffer + "\r\n").encode("ascii")):
-                self._server.log.custom("RAW", "[{0}:{1}] -> {2}".format(self.ip_address, self.port, buffer))
-                return True
-            else:
-                return False
-        except (OSError, BrokenPipeError):
+        return self.write_encoded(buffer, (buffer + "\r\n").encode("utf-8", "replace"))
+
+    # Queue a line that has already been encoded, fanouts encode each variant once for all recipients
+    def write_encoded(self, buffer, encoded):
+        if not self.active:
+            return False
+
+        self.send_queue += encoded
+        overflow = len(self.send_queue) > self._server.config.server.get("sendq", Client.sendq)
+
+        self._server.metrics.increment("pyrcd_lines_out_total")
+        self._server.metrics.increment("pyrcd_bytes_out_total", len(encoded))
+        self._server.log.custom("RAW", "[{0}:{1}] -> {2}".format(self.ip_address, self.port, buffer))
+
+        # A client that can't keep up would otherwise grow the queue without bound
+        if overflow:
+            if self.quit_reason is None:
+                self.quit_reason = "SendQ exceeded"
+
             self.terminate()
+            return False
+
+        return self.flush()
+
+    # Send as much of the queue as the socket will take, returns False if the connection is dead
+    def flush(self):
+        failed = False
+
+        try:
+            if len(self.send_queue):
+                del self.send_queue[:self._handle.send(self.send_queue)]
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            pass
+        except OSError:
+            self.send_queue.clear()
+            failed = True
+
+        pending = len(self.send_queue) > 0
+
+        if failed:
+            if self.active:
+                self.terminate()
+
+            return False
+
+        self._server.want_write(self, pending)
+        return True
+
+    # Queue a reply made up of many lines, written a chunk at a time as the send queue drains. end is
+    # written once lines runs out, or straight away if the stream is cut short
+    def stream(self, lines, end):
+        self.streams.append((lines, end))
+        self._server.streams.add(self)
+        self.continue_stream()
+
+    def continue_stream(self):
+        budget = Client.stream_lines
+
+        while len(self.streams) and self.active:
+            lines, end = self.streams[0]
+
+            for line in lines:
+                self.write(line)
+                budget -= 1
+
+                if budget <= 0 or len(self.send_queue) >= Client.stream_watermark:
+                    return
+
+            self.streams.popleft()
+            self.write(end)
+
+        self._server.streams.discard(self)
+
+    def end_streams(self):
+        while len(self.streams):
+            self.write(self.streams.popleft()[1])
+
+        self._server.streams.discard(self)
+
+    # Write a pre-rendered block of lines (see Configuration.render_block), only the nick is filled in here
+    def write_block(self, block):
+        nick = self.nick if self.nick is not None else "*"
+
+        for segments in block:
+            self.write(nick.join(segments))
 
     # Kill client
     def terminate(self):
+        if not self.active:
+            return
+
+        # Last chance for anything queued (e.g. the ERROR line from close_link) to go out
         self.active = False
+        self.flush()
+
         self._server.deregister_client(self)
 
         try:
@@ -94,62 +290,62 @@ class Client(object):
         except OSError:
             pass
 
-    # Reverse DNS lookup
+    # Reverse DNS lookup, answered from the cache straight away or resolved on a thread of its own
     def lookup_hostname(self):
-        self.lock.acquire()
-
         self.notice_auth("Looking up your hostname...")
-        hostname = False
-        log_output = ""
-        client_output = ""
-
-        # Lookup exists
-        if self.ip_address in self._server.hostnames.keys():
-            # Record is older than 1 hour, flush it
-            if time.time() - self._server.hostnames[self.ip_address]["time"] >= 3600:
-                self._server.hostnames.pop(self.ip_address, None)
-
-                hostname = self._server.resolve_ip_address(self.ip_address)
-
-                if hostname:
-                    self.hostname = hostname
-                    self._server.hostnames[self.ip_address] = {"time": time.time(), "result": self.hostname}
-                    log_output = "{0} resolves to {1} (cached)"
-                    client_output = "Found your hostname (" + self.hostname + ")"
-                else:
-                    self._server.hostnames[self.ip_address] = {"time": time.time(), "result": None}
-                    log_output = "{0} is unresolvable (cached)"
-                    client_output = "Unable to resolve IP address (" + self.hostname + ")"
-            # Use cached result
-            else:
-                # Failed lookup is cached
-                if self._server.hostnames[self.ip_address]["result"] is None:
-                    self.hostname = self.ip_address
-                    log_output = "{0} is unresolvable (cached)"
-                    client_output = "Unable to resolve IP address (" + self.hostname + ")"
-                # Successful lookup is cached
-                else:
-                    self.hostname = self._server.hostnames[self.ip_address]["result"]
-                    log_output = "{0} resolves to {1} (cached)"
-                    client_output = "Cached your hostname (" + self.hostname + ")"
-        # New host, no cache record at all
-        else:
-            hostname = self._server.resolve_ip_address(self.ip_address)
-
-            if hostname:
-                self.hostname = hostname
-                self._server.hostnames[self.ip_address] = {"time": time.time(), "result": self.hostname}
-                log_output = "{0} resolves to {1}"
-                client_output = "Found your hostname (" + self.hostname + ")"
-            else:
-                self.hostname = self.ip_address
-                self._server.hostnames[self.ip_address] = {"time": time.time(), "result": None}
-                log_output = "{0} is unresolvable"
-                client_output = "Unable to resolve IP address (" + self.hostname + ")"
+        cached = self._server.hostnames.get(self.ip_address, None)
+
+        # Record is older than 1 hour, flush it
+        if cached is not None and time.time() - cached["time"] >= 3600:
+            self._server.hostnames.pop(self.ip_address, None)
+            cached = None
+
+        if cached is not None:
+            self._server.metrics.increment("pyrcd_cache_hits_total", label="hostname")
+            self.finish_lookup(cached["result"], True)
+            return
+
+        self._server.metrics.increment("pyrcd_cache_misses_total", label="hostname")
+
+        try:
+            lookup = threading.Thread(target=self.resolve_hostname, args=[])
+            lookup.start()
+        except threading.ThreadError:
+            self.notice_auth("Failed to lookup hostname, using IP address (" + self.ip_address + ") instead")
+
+    # Lookup thread: only resolves, the server loop applies the result (see Server.complete_lookups)
+    def resolve_hostname(self):
+        started = time.perf_counter()
+        hostname = self._server.resolve_ip_address(self.ip_address)
+        self._server.lookups.append((self, hostname or None, time.perf_counter() - started))
+
+    # Apply a lookup's result, hostname is None if the address didn't resolve
+    def finish_lookup(self, hostname, cached):
+        if not cached:
+            self._server.hostnames[self.ip_address] = {"time": time.time(), "result": hostname}
+
+        if not self.active:
+            return
+
+        self.hostname = hostname or self.ip_address
+
+        if hostname is not None:
+            log_output = "{0} resolves to {1}"
+            client_output = ("Cached" if cached else "Found") + " your hostname (" + self.hostname + ")"
+        else:
+            log_output = "{0} is unresolvable"
+            client_output = "Unable to resolve IP address (" + self.hostname + ")"
 
-        self._server.log.custom("LOOKUP", log_output.format(self.ip_address, self.hostname))
+        self._server.log.custom("LOOKUP", (log_output + (" (cached)" if cached else "")).format(self.ip_address, self.hostname))
         self.notice_auth(client_output)
-        self.lock.release()
+
+        # Cloak the resolved hostname, unless the address's cloak has already been shown to the network
+        if not self.authorised:
+            self.masked_hostname = self.calculate_hostname()
+        # Registered before the lookup finished, WHO needs to find the resolved host and bans may now match
+        else:
+            self._server.index_host(self)
+            self._server.invalidate_verdicts(self)
 
     # Dynamic client hostname, depending on modes (not implemented yet)
     def get_hostname(self):
@@ -158,14 +354,13 @@ class Client(object):
         else:
             return self.hostname
 
-    # Calculate a "masked" hostname for a client
+    # Calculate a "masked" hostname for a client (see Cloak.hide)
     def calculate_hostname(self):
-        full_address = self.ip_address.split(".")
+        return self._server.cloak.hide(self.hostname)
 
-        if len(full_address) == 4:
-            return "{0}.{1}.x.x".format(full_address[0], full_address[1])
-        else:
-            return self.hostname
+    # nick!user@host with each host a ban could have been set against
+    def hostmasks(self):
+        return {"{0}!{1}@{2}".format(self.nick, self.user, host) for host in [self.hostname, self.masked_hostname, self.ip_address]}
 
     # Get full identifier
     def get_identifier(self):
@@ -174,9 +369,23 @@ class Client(object):
         else:
             return "{0}:{1}".format(self.ip_address, self.port)
 
-    # Pulls out the command+arguments and passes them on
+    # Pulls out the tags and command+arguments and passes them on
     def handle_data(self, arguments):
-        arguments = arguments.strip("\n").split(" ")
+        arguments = arguments.strip("\n")
+        self.tags = {}
+
+        if arguments.startswith("@"):
+            tags, _, arguments = arguments[1:].partition(" ")
+
+            if len(tags) > Capability.tag_limit:
+                self.num_417_input_too_long()
+                return False
+
+            # Only client-only tags are relayed, and only from clients that negotiated them
+            if self.caps & Capability.message_tags:
+                self.tags = {key: value for key, value in Capability.parse_tags(tags).items() if key.startswith("+")}
+
+        arguments = arguments.lstrip(" ").split(" ")
 
         if len(arguments) < 1:
             return False
@@ -195,13 +404,11 @@ class Client(object):
 
     # Called when data is received by unregistered client
     def data_unregistered(self, command, arguments):
-        commands = ["NICK", "USER", "PONG", "QUIT", "CAP"]
+        commands = ["NICK", "USER", "PONG", "QUIT", "CAP", "AUTHENTICATE"]
 
         if command in commands:
             self._server.log.custom("COMMAND", self.get_hostname() + ": " + command)
-
-            method = getattr(self, "cmd_" + command.lower())
-            method(arguments)
+            self.run_command(command, arguments)
         else:
             self.num_451_not_registered(command)
 
@@ -211,20 +418,39 @@ class Client(object):
             "PRIVMSG", "NOTICE",            # Communication commands
             "NICK", "USER",                 # Client attribute stuff
             "PONG", "QUIT",                 # Connection stuff
-            "WHOIS", "ISON", "USERHOST",    # User information
+            "WHOIS", "WHOWAS", "ISON",      # User information
+            "USERHOST",
+            "MONITOR", "AUTHENTICATE", "REGISTER",
+            "WHO", "LIST",
+            "WALLOPS",
             "JOIN", "PART",                 # Channel stuff
+            "TOPIC", "KICK", "INVITE", "NAMES",
             "MODE",                         # User/channel stuff
-            "LUSERS", "MOTD", "RULES"       # Statistics and crap
+            "LUSERS", "MOTD", "RULES",      # Statistics and crap
+            "STATS",
+            "CAP", "TAGMSG", "CHATHISTORY", # IRCv3
+            "OPER", "PROFILE", "REHASH",    # Operator commands
+            "RESTART", "KLINE", "UNKLINE", "GLINE", "UNGLINE"
         ]
 
         if command in commands:
             self._server.log.custom("COMMAND", self.get_identifier() + ": " + command)
-
-            method = getattr(self, "cmd_" + command.lower())
-            method(arguments)
+            self.run_command(command, arguments)
         else:
             self.num_421_unknown_command(command)
 
+    # Calls the matching cmd_* method and records how long it took
+    def run_command(self, command, arguments):
+        method = getattr(self, "cmd_" + command.lower())
+        started = time.perf_counter()
+
+        method(arguments)
+
+        elapsed = time.perf_counter() - started
+        self._server.metrics.increment("pyrcd_commands_total", label=command)
+        self._server.metrics.observe("pyrcd_command_seconds", elapsed, label=command)
+        self._server.profiler.record_command(command, elapsed)
+
     # Ping/pong function
     def ping(self):
         self.pong["sent"] = time.time()
@@ -233,6 +459,9 @@ class Client(object):
 
     # Terminates client prematurely
     def close_link(self, buffer):
+        if self.quit_reason is None:
+            self.quit_reason = buffer
+
         self.write(self.substitute("ERROR :Closing Link: {nick}[{hostname}] (" + buffer + ")"))
         self.terminate()
 
@@ -243,10 +472,19 @@ class Client(object):
                 if self.user is not None:
                     if self.name is not None:
                         if self.pong["pending"] is False and self.pong["sent"] > 0:
-                            self.handle_authorised()
+                            if not self.negotiating and not self.dnsbl_pending:
+                                self.handle_authorised()
 
     # Client has authorised
     def handle_authorised(self):
+        # Address bans were checked on accept(), user@host ones need the username and hostname
+        ban = self._server.bans.check_user(self.user, self.hostname, self.ip_address) if len(self._server.bans) else None
+
+        if ban is not None:
+            self._server.metrics.increment("pyrcd_connections_banned_total", label=ban["kind"])
+            self.close_link("{0}-lined: {1}".format(ban["kind"], ban["reason"]))
+            return
+
         self.authorised = True
 
         buffer = [
@@ -267,11 +505,13 @@ class Client(object):
         for line in buffer:
             self.write(line)
 
+        self.num_005_isupport()
+
+        # Counted before LUSERS so the statistics include this client
+        self._server.index_user(self)
+
         # LUSERS statistics
-        self.num_251_lusers_total()
-        self.num_255_lusers_local_total()
-        self.num_265_lusers_local_users()
-        self.num_266_lusers_global_users()
+        self.send_lusers()
 
         # Message of the Day
         self.num_375_motd_start()
@@ -283,6 +523,12 @@ class Client(object):
         self.mode_w("+", None)
         self.mode_x("+", None)
 
+        self._server.index_host(self)
+        self._server.monitor_online(self)
+        self._server.check_nick(self)
+
+        # Introduce after the base modes so remote servers get them in the UID line
+        self._server.links.introduce(self)
         self._server.log.custom("AUTHORISED", self.get_identifier())
 
     # Handle client modes (either for self or external target)
@@ -309,27 +555,134 @@ class Client(object):
 
     # BROADCAST: "MODE"
     def broadcast_mode(self, modes):
+        if self.authorised:
+            self._server.links.user_mode(self, modes)
+
         return self.write(self.substitute(":{identifier} MODE {nick} " + modes))
 
     # NOTICE "AUTH"
     def notice_auth(self, buffer):
         self.write(self.substitute(":{fqdn} NOTICE AUTH :*** " + buffer))
 
+    # Features advertised in 005, derived from the mode tables so they can't drift out of step
+    def isupport(self):
+        modes = IRC.channel_modes
+        plain = [mode for mode in modes if mode not in IRC.channel_power_symbols + IRC.channel_list_modes]
+
+        return [
+            "NETWORK=" + self._server.config.server["name"].replace(" ", "_"),
+            "CASEMAPPING=ascii",
+            "CHANTYPES=#",
+            "PREFIX=({0}){1}".format(
+                "".join(IRC.channel_power_symbols),
+                "".join(IRC.channel_powers[power] for power in IRC.channel_power_symbols)
+            ),
+            "CHANMODES={0},{1},{2},{3}".format(
+                "".join(IRC.channel_list_modes),
+                "".join(mode for mode in plain if modes[mode] and mode not in IRC.channel_set_only_modes),
+                "".join(IRC.channel_set_only_modes),
+                "".join(mode for mode in plain if not modes[mode])
+            ),
+            "MONITOR={0}".format(self._server.config.server.get("monitor_limit", Client.monitor_limit)),
+            "CHATHISTORY={0}".format(self._server.history.setting("limit", History.limit)),
+            "MSGREFTYPES=msgid,timestamp",
+            "WHOX"
+        ]
+
+    # NUMERIC: 005 "ISUPPORT"
+    def num_005_isupport(self):
+        tokens = self.isupport()
+
+        # At most 13 tokens per line
+        for start in range(0, len(tokens), 13):
+            self.write(self.substitute(":{fqdn} 005 {nick} " + " ".join(tokens[start:start + 13]) + " :are supported by this server"))
+
+    # NUMERIC: 212 "STATS COMMANDS"
+    def num_212_stats_commands(self, command, count):
+        self.write(self.substitute(":{fqdn} 212 {nick} {0} {1} 0 0").format(command, count))
+
+    # NUMERIC: 216 "STATS K-LINE"
+    def num_216_stats_kline(self, ban):
+        self.num_stats_ban("216", ban)
+
+    # NUMERIC: 219 "END OF STATS"
+    def num_219_end_of_stats(self, letter):
+        self.write(self.substitute(":{fqdn} 219 {nick} " + letter + " :End of /STATS report"))
+
+    # NUMERIC: 223 "STATS G-LINE"
+    def num_223_stats_gline(self, ban):
+        self.num_stats_ban("223", ban)
+
+    def num_stats_ban(self, numeric, ban):
+        self.write(self.substitute(":{fqdn} {0} {nick} {1} {2} {3:.0f} {4:.0f} {5} :{6}").format(
+            numeric,
+            ban["kind"],
+            ban["mask"],
+            ban["expires"] or 0,
+            ban["time"],
+            ban["setter"],
+            ban["reason"]
+        ))
+
+    # NOTICE from the server itself
+    def notice_server(self, buffer):
+        self.write(self.substitute(":{fqdn} NOTICE {nick} :*** " + buffer))
+
+    # IRCv3 standard reply: FAIL <command> <code> <context> :<description>
+    def fail(self, command, code, context, description):
+        self.write(self.substitute(":{fqdn} FAIL {0} {1} {2} :{3}").format(command, code, context, description))
+
     # NUMERIC: 221 "USER MODES"
     def num_221_user_modes(self):
         return self.write(self.substitute(":{fqdn} 221 {nick} " + IRC.mode_construct(self.modes)))
 
     # NUMERIC: 232 "RULES"
     def num_232_rules(self):
-        for line in self._server.config.rules["content"].split("\n"):
-            self.write(self.substitute(":{fqdn} 232 {nick} :- " + line))
+        self.write_block(self._server.config.rules["lines"])
+
+    # NUMERIC: 242 "STATS UPTIME"
+    def num_242_stats_uptime(self):
+        uptime = int(time.time() - self._server.started)
+
+        self.write(self.substitute(":{fqdn} 242 {nick} :Server Up {0} days {1}:{2:02d}:{3:02d}").format(
+            uptime // 86400,
+            (uptime % 86400) // 3600,
+            (uptime % 3600) // 60,
+            uptime % 60
+        ))
+
+    # NUMERIC: 249 "STATS DEBUG"
+    def num_249_stats_debug(self, buffer):
+        self.write(self.substitute(":{fqdn} 249 {nick} :" + buffer))
 
     # NUMERIC: 251 "LUSERS TOTAL"
     def num_251_lusers_total(self):
-        self.write(self.substitute(":{fqdn} 251 {nick} :There are {0} users on 1 server").format(
-            len(self._server.clients)
+        servers = 1 + len(self._server.links.servers)
+        invisible = len(self._server.user_modes["i"])
+
+        self.write(self.substitute(":{fqdn} 251 {nick} :There are {0} users and {1} invisible on {2} server{3}").format(
+            len(self._server.users) - invisible,
+            invisible,
+            servers,
+            "s" if servers > 1 else ""
         ))
 
+    # NUMERIC: 252 "LUSERS OPERATORS"
+    def num_252_lusers_operators(self):
+        self.write(self.substitute(":{fqdn} 252 {nick} {0} :operator(s) online").format(
+            len(self._server.user_modes["o"])
+        ))
+
+    # NUMERIC: 253 "LUSERS UNKNOWN"
+    def num_253_lusers_unknown(self):
+        self.write(self.substitute(":{fqdn} 253 {nick} {0} :unknown connection(s)").format(
+            len(self._server.clients) + len(self._server.remote_clients) - len(self._server.users)
+        ))
+
+    # NUMERIC: 254 "LUSERS CHANNELS"
+    def num_254_lusers_channels(self):
+        self.write(self.substitute(":{fqdn} 254 {nick} {0} :channels formed").format(len(self._server.channels)))
+
     # NUMERIC: 255 "LUSERS LOCAL TOTAL"
     def num_255_lusers_local_total(self):
         self.write(self.substitute(":{fqdn} 255 {nick} :I have {0} users").format(
@@ -346,8 +699,8 @@ class Client(object):
     # NUMERIC: 266 "LUSERS GLOBAL USERS"
     def num_266_lusers_global_users(self):
         self.write(self.substitute(":{fqdn} 266 {nick} :Current global users {0}, max {1}").format(
-            len(self._server.clients),
-            self._server.max_clients
+            len(self._server.users),
+            self._server.max_users
         ))
 
     # NUMERIC: 302 "USERHOST"
@@ -379,8 +732,25 @@ class Client(object):
     def num_312_whois(self, target):
         self.write(self.substitute(":{fqdn} 312 {nick} {0} {1} :{2}").format(
             target.nick,
-            self._server.config.server["fqdn"],
-            self._server.config.server["name"]
+            target.origin,
+            self._server.links.description(target.origin)
+        ))
+
+    # NUMERIC: 312 "WHOWAS"
+    def num_312_whowas(self, record):
+        self.write(self.substitute(":{fqdn} 312 {nick} {0} {1} :{2}").format(
+            record[0],
+            record[4],
+            time.strftime("%a %b %d %H:%M:%S %Y", time.gmtime(record[6]))
+        ))
+
+    # NUMERIC: 314 "WHOWAS"
+    def num_314_whowas(self, record):
+        self.write(self.substitute(":{fqdn} 314 {nick} {0} {1} {2} * :{3}").format(
+            record[0],
+            record[1],
+            record[2],
+            record[3]
         ))
 
     # NUMERIC: 317 "WHOIS"
@@ -416,18 +786,37 @@ class Client(object):
 
         self.write(self.substitute(":{fqdn} 319 {nick} " + target.nick + " :" + (" ".join(channels))))
 
+    # NUMERIC: 315 "END OF WHO"
+    def num_315_end_of_who(self, mask):
+        return self.substitute(":{fqdn} 315 {nick} " + mask + " :End of /WHO list.")
+
+    # NUMERIC: 321 "LIST START"
+    def num_321_list_start(self):
+        self.write(self.substitute(":{fqdn} 321 {nick} Channel :Users  Name"))
+
+    # NUMERIC: 322 "LIST"
+    def num_322_list(self, channel):
+        description = channel.topic["content"]
+
+        if len(channel.modes):
+            description = ("[+" + "".join(channel.modes.keys()) + "] " + description).rstrip(" ")
+
+        return self.substitute(":{fqdn} 322 {nick} {0} {1} :{2}").format(channel.name, len(channel.clients), description)
+
+    # NUMERIC: 323 "END OF LIST"
+    def num_323_end_of_list(self):
+        return self.substitute(":{fqdn} 323 {nick} :End of /LIST")
+
     # NUMERIC: 324 "CHANNEL MODES"
     def num_324_channel_modes(self, target):
         channel = self._server.channels[target]
+        modes, arguments = channel.mode_parameters()
 
-        if len(channel.modes):
-            mode_keys = "".join(channel.modes.keys())
-            mode_values = "".join(channel.modes.values())
-        else:
-            mode_keys = "+"
-            mode_values = ""
+        # Only members get to see the key
+        if "k" in channel.modes and channel.name not in self.channels:
+            arguments = ["*" if argument == channel.modes["k"] else argument for argument in arguments]
 
-        self.write(self.substitute(":{fqdn} 324 {nick} {0} {1} {2}").format(channel.name, mode_keys, mode_values))
+        self.write(self.substitute(":{fqdn} 324 {nick} {0} {1}").format(channel.name, " ".join([modes] + arguments)))
 
     # NUMERIC: 329 "CHANNEL CREATION"
     def num_329_channel_creation(self, target):
@@ -437,6 +826,18 @@ class Client(object):
             channel.created
         ))
 
+    # NUMERIC: 330 "WHOIS ACCOUNT"
+    def num_330_whois_account(self, target):
+        self.write(self.substitute(":{fqdn} 330 {nick} {0} {1} :is logged in as").format(target.nick, target.account))
+
+    # NUMERIC: 330 "WHOWAS ACCOUNT"
+    def num_330_whowas_account(self, record):
+        self.write(self.substitute(":{fqdn} 330 {nick} {0} {1} :was logged in as").format(record[0], record[5]))
+
+    # NUMERIC: 331 "NO TOPIC"
+    def num_331_no_topic(self, target):
+        self.write(self.substitute(":{fqdn} 331 {nick} " + target + " :No topic is set"))
+
     # NUMERIC: 332 "CHANNEL TOPIC"
     def num_332_channel_topic(self, target, topic):
         self.write(self.substitute(":{fqdn} 332 {nick} " + target + " :" + topic))
@@ -445,6 +846,61 @@ class Client(object):
     def num_333_channel_topic_time(self, target, edit_time, author):
         self.write(self.substitute(":{fqdn} 333 {nick} {0} {1} {2:.0f}").format(target, author, edit_time))
 
+    # NUMERIC: 341 "INVITING"
+    def num_341_inviting(self, target, channel):
+        self.write(self.substitute(":{fqdn} 341 {nick} {0} {1}").format(target, channel))
+
+    # NUMERIC: 348 "EXCEPTION LIST"
+    def num_348_exception_list(self, channel, entry):
+        return self.substitute(":{fqdn} 348 {nick} {0} {1} {2} {3:.0f}").format(channel, entry["mask"], entry["setter"], entry["time"])
+
+    # NUMERIC: 349 "END OF EXCEPTION LIST"
+    def num_349_end_of_exception_list(self, channel):
+        return self.substitute(":{fqdn} 349 {nick} " + channel + " :End of Channel Exception List")
+
+    # NUMERIC: 352 "WHO" (or 354 "WHOX" when fields were asked for)
+    def num_352_who(self, target, channel, fields, token):
+        status = "H" + ("*" if "o" in target.modes else "")
+
+        if channel is not None:
+            for power in IRC.channel_power_symbols:
+                if power in target.channel_modes.get(channel.name, []):
+                    status += IRC.channel_powers[power]
+                    break
+
+        hops = 0 if target.link is None else self._server.links.servers.get(target.origin, {}).get("hops", 0)
+
+        if not len(fields):
+            return self.substitute(":{fqdn} 352 {nick} {0} {1} {2} {3} {4} {5} :{6} {7}").format(
+                channel.name if channel is not None else "*",
+                target.user,
+                target.get_hostname(),
+                target.origin,
+                target.nick,
+                status,
+                hops,
+                target.name
+            )
+
+        # Only operators and the user themselves get to see the real address
+        values = {
+            "t": token,
+            "c": channel.name if channel is not None else "*",
+            "u": target.user,
+            "i": target.ip_address if target is self or "o" in self.modes else "255.255.255.255",
+            "h": target.get_hostname(),
+            "s": target.origin,
+            "n": target.nick,
+            "f": status,
+            "d": str(hops),
+            "l": str(int(time.time() - target.last_cmd)) if target.link is None else "0",
+            "a": "0",
+            "o": "n/a",
+            "r": ":" + target.name
+        }
+
+        return self.substitute(":{fqdn} 354 {nick} ") + " ".join(values[field] for field in "tcuihsnfdlaor" if field in fields)
+
     # NUMERIC: 353 "NAMES"
     def num_353_names(self, channel, names):
         self.write(self.substitute(":{fqdn} 353 {nick} = {0} :{1}").format(channel, " ".join(names)))
@@ -453,14 +909,21 @@ class Client(object):
     def num_366_end_of_names(self, target):
         self.write(self.substitute(":{fqdn} 366 {nick} " + target + " :End of /NAMES list."))
 
+    # NUMERIC: 367 "BAN LIST"
+    def num_367_ban_list(self, channel, entry):
+        return self.substitute(":{fqdn} 367 {nick} {0} {1} {2} {3:.0f}").format(channel, entry["mask"], entry["setter"], entry["time"])
+
+    # NUMERIC: 368 "END OF BAN LIST"
+    def num_368_end_of_ban_list(self, channel):
+        return self.substitute(":{fqdn} 368 {nick} " + channel + " :End of Channel Ban List")
+
+    # NUMERIC: 369 "END OF WHOWAS"
+    def num_369_end_of_whowas(self, target):
+        self.write(self.substitute(":{fqdn} 369 {nick} " + target + " :End of WHOWAS"))
+
     # NUMERIC: 372 "MOTD"
     def num_372_motd(self):
-        self.write(self.substitute(":{fqdn} 372 {nick} :- {0}").format(
-            time.strftime("%d/%m/%Y %H:%M", time.localtime(self._server.config.motd["modified"]))
-        ))
-
-        for line in self._server.config.motd["content"].split("\n"):
-            self.write(self.substitute(":{fqdn} 372 {nick} :- " + line))
+        self.write_block(self._server.config.motd["lines"])
 
     # NUMERIC: 375 "MOTD START"
     def num_375_motd_start(self):
@@ -477,6 +940,14 @@ class Client(object):
             target.get_hostname()
         ))
 
+    # NUMERIC: 381 "YOU'RE OPER"
+    def num_381_youre_oper(self):
+        self.write(self.substitute(":{fqdn} 381 {nick} :You are now an IRC operator"))
+
+    # NUMERIC: 382 "REHASHING"
+    def num_382_rehashing(self, file):
+        self.write(self.substitute(":{fqdn} 382 {nick} " + file + " :Rehashing"))
+
     # NUMERIC: 401 "NO SUCH RECIPIENT"
     def num_401_no_such_recipient(self, target):
         self.write(self.substitute(":{fqdn} 401 {nick} " + target + " :No such nick/channel"))
@@ -485,6 +956,14 @@ class Client(object):
     def num_403_no_such_channel(self, target):
         self.write(self.substitute(":{fqdn} 403 {nick} " + target + " :No such channel"))
 
+    # NUMERIC: 404 "CANNOT SEND TO CHANNEL"
+    def num_404_cannot_send_to_channel(self, channel):
+        self.write(self.substitute(":{fqdn} 404 {nick} " + channel + " :Cannot send to channel"))
+
+    # NUMERIC: 406 "WAS NO SUCH NICK"
+    def num_406_was_no_such_nick(self, target):
+        self.write(self.substitute(":{fqdn} 406 {nick} " + target + " :There was no such nickname"))
+
     # NUMERIC: 410 "INVALID CAP SUBCOMMAND"
     def num_410_invalid_cap_subcommand(self, subcommand):
         self.write(self.substitute(":{fqdn} 410 {nick} " + subcommand + " :Invalid CAP subcommand"))
@@ -497,6 +976,10 @@ class Client(object):
     def num_412_no_text_to_send(self):
         self.write(self.substitute(":{fqdn} 412 {nick} :No text to send"))
 
+    # NUMERIC: 417 "INPUT TOO LONG"
+    def num_417_input_too_long(self):
+        self.write(self.substitute(":{fqdn} 417 {nick} :Input line was too long"))
+
     # NUMERIC: 421 "UNKNOWN COMMAND"
     def num_421_unknown_command(self, command):
         self.write(self.substitute(":{fqdn} 421 {nick} " + command + " :Unknown command"))
@@ -521,6 +1004,10 @@ class Client(object):
     def num_451_not_registered(self, command):
         self.write(self.substitute(":{fqdn} 451 " + command + " :You have not registered"))
 
+    # NUMERIC: 443 "USER ON CHANNEL"
+    def num_443_user_on_channel(self, target, channel):
+        self.write(self.substitute(":{fqdn} 443 {nick} {0} {1} :is already on channel").format(target, channel))
+
     # NUMERIC: 460 "HALFOPS CANNOT SET MODE"
     def num_460_halfops_cannot_set_mode(self, mode):
         self.write(self.substitute(":{fqdn} 460 {nick} :Halfops cannot set mode " + mode))
@@ -533,19 +1020,236 @@ class Client(object):
     def num_462_already_registered(self):
         self.write(self.substitute(":{fqdn} 462 {nick} USER :You may not reregister"))
 
+    # NUMERIC: 464 "PASSWORD MISMATCH"
+    def num_464_password_mismatch(self):
+        self.write(self.substitute(":{fqdn} 464 {nick} :Password incorrect"))
+
+    # NUMERIC: 471 "CHANNEL IS FULL"
+    def num_471_channel_is_full(self, channel):
+        self.write(self.substitute(":{fqdn} 471 {nick} " + channel + " :Cannot join channel (+l)"))
+
+    # NUMERIC: 473 "INVITE ONLY CHANNEL"
+    def num_473_invite_only_channel(self, channel):
+        self.write(self.substitute(":{fqdn} 473 {nick} " + channel + " :Cannot join channel (+i)"))
+
+    # NUMERIC: 474 "BANNED FROM CHANNEL"
+    def num_474_banned_from_channel(self, channel):
+        self.write(self.substitute(":{fqdn} 474 {nick} " + channel + " :Cannot join channel (+b)"))
+
+    # NUMERIC: 475 "BAD CHANNEL KEY"
+    def num_475_bad_channel_key(self, channel):
+        self.write(self.substitute(":{fqdn} 475 {nick} " + channel + " :Cannot join channel (+k)"))
+
+    # NUMERIC: 478 "LIST FULL"
+    def num_478_list_full(self, channel, mask, letter):
+        self.write(self.substitute(":{fqdn} 478 {nick} {0} {1} :Channel {2} list is full").format(
+            channel,
+            mask,
+            "ban" if letter == "b" else "exception"
+        ))
+
+    # NUMERIC: 481 "NO PRIVILEGES"
+    def num_481_no_privileges(self):
+        self.write(self.substitute(":{fqdn} 481 {nick} :Permission Denied- You're not an IRC operator"))
+
     # NUMERIC: 482 "NOT CHANNEL OPERATOR"
     def num_482_not_channel_operator(self, target):
         self.write(self.substitute(":{fqdn} 482 {nick} " + target + " :You're not channel operator"))
 
+    # NUMERIC: 671 "WHOIS SECURE"
+    def num_671_whois_secure(self, target):
+        self.write(self.substitute(":{fqdn} 671 {nick} {0} :is using a secure connection").format(target.nick))
+
+    # NUMERIC: 730 "MONITOR ONLINE"
+    def num_730_monitor_online(self, targets):
+        for chunk in IRC.chunk(targets):
+            self.write(self.substitute(":{fqdn} 730 {nick} :" + ",".join(chunk)))
+
+    # NUMERIC: 731 "MONITOR OFFLINE"
+    def num_731_monitor_offline(self, targets):
+        for chunk in IRC.chunk(targets):
+            self.write(self.substitute(":{fqdn} 731 {nick} :" + ",".join(chunk)))
+
+    # NUMERIC: 732 "MONITOR LIST"
+    def num_732_monitor_list(self, targets):
+        for chunk in IRC.chunk(targets):
+            self.write(self.substitute(":{fqdn} 732 {nick} :" + ",".join(chunk)))
+
+    # NUMERIC: 733 "END OF MONITOR LIST"
+    def num_733_end_of_monitor_list(self):
+        self.write(self.substitute(":{fqdn} 733 {nick} :End of MONITOR list"))
+
+    # NUMERIC: 734 "MONITOR LIST FULL"
+    def num_734_monitor_list_full(self, limit, targets):
+        self.write(self.substitute(":{fqdn} 734 {nick} {0} {1} :Monitor list is full.").format(limit, ",".join(targets)))
+
+    # NUMERIC: 900 "LOGGED IN"
+    def num_900_logged_in(self, account):
+        self.write(self.substitute(":{fqdn} 900 {nick} {0}!{1}@{hostname} {2} :You are now logged in as {2}").format(
+            self.nick or "*",
+            self.user or "*",
+            account
+        ))
+
+    # NUMERIC: 903 "SASL SUCCESS"
+    def num_903_sasl_success(self):
+        self.write(self.substitute(":{fqdn} 903 {nick} :SASL authentication successful"))
+
+    # NUMERIC: 904 "SASL FAIL"
+    def num_904_sasl_fail(self):
+        self.write(self.substitute(":{fqdn} 904 {nick} :SASL authentication failed"))
+
+    # NUMERIC: 905 "SASL TOO LONG"
+    def num_905_sasl_too_long(self):
+        self.write(self.substitute(":{fqdn} 905 {nick} :SASL message too long"))
+
+    # NUMERIC: 906 "SASL ABORTED"
+    def num_906_sasl_aborted(self):
+        self.write(self.substitute(":{fqdn} 906 {nick} :SASL authentication aborted"))
+
+    # NUMERIC: 907 "SASL ALREADY"
+    def num_907_sasl_already(self):
+        self.write(self.substitute(":{fqdn} 907 {nick} :You have already authenticated using SASL"))
+
+    # NUMERIC: 908 "SASL MECHANISMS"
+    def num_908_sasl_mechanisms(self, mechanisms):
+        self.write(self.substitute(":{fqdn} 908 {nick} " + ",".join(mechanisms) + " :are available SASL mechanisms"))
+
+    # COMMAND: "AUTHENTICATE"
+    def cmd_authenticate(self, arguments):
+        if len(arguments) < 1:
+            self.num_461_more_parameters("AUTHENTICATE")
+        elif not self.caps & Capability.sasl:
+            self.num_421_unknown_command("AUTHENTICATE")
+        else:
+            self._server.sasl.authenticate(self, arguments[0])
+
     # COMMAND: "CAP"
     def cmd_cap(self, arguments):
         if len(arguments) == 0:
             self.num_461_more_parameters("CAP")
-        elif arguments[0].upper() == "LS":
-            self.write(self.substitute(":{fqdn} CAP {nick} LS :account-notify multi-prefix userhost-in-names"))
+            return
+
+        subcommand = arguments[0].upper()
+
+        # Registration is held until CAP END once a client starts negotiating
+        if not self.authorised and subcommand in ["LS", "REQ"]:
+            self.negotiating = True
+
+        if subcommand == "LS":
+            if len(arguments) > 1 and arguments[1].isdigit():
+                self.cap_version = max(self.cap_version, int(arguments[1]))
+
+            self.write(self.substitute(":{fqdn} CAP {nick} LS :" + " ".join(Capability.advertise(self.cap_version))))
+        elif subcommand == "LIST":
+            self.write(self.substitute(":{fqdn} CAP {nick} LIST :" + " ".join(Capability.enabled(self.caps))))
+        elif subcommand == "REQ":
+            if len(arguments) < 2:
+                self.num_461_more_parameters("CAP")
+                return
+
+            requested = " ".join(arguments[1:])
+            requested = requested[1:] if requested.startswith(":") else requested
+            caps = self.caps
+
+            # The whole request is accepted or rejected as one
+            for name in requested.split():
+                flag = Capability.names.get(name.lstrip("-"), None)
+
+                if flag is None:
+                    self.write(self.substitute(":{fqdn} CAP {nick} NAK :" + requested))
+                    return
+
+                caps = caps & ~flag if name.startswith("-") else caps | flag
+
+            self.caps = caps
+            self.write(self.substitute(":{fqdn} CAP {nick} ACK :" + requested))
+        elif subcommand == "END":
+            # Ending negotiation part way through an exchange abandons it
+            if self.sasl_session is not None:
+                self._server.sasl.abort(self)
+
+            if self.negotiating:
+                self.negotiating = False
+                self.check_authorisation()
         else:
             self.num_410_invalid_cap_subcommand(arguments[0])
 
+    # COMMAND: "CHATHISTORY"
+    def cmd_chathistory(self, arguments):
+        if len(arguments) < 4:
+            self.num_461_more_parameters("CHATHISTORY")
+            return
+
+        # CHATHISTORY <LATEST|BEFORE|AFTER> <channel> <msgid=...|timestamp=...|*> <limit>, "*" only for LATEST
+        subcommand = arguments[0].upper()
+        channel = self._server.channels.get(arguments[1].lower(), None)
+        maximum = self._server.history.setting("limit", History.limit)
+
+        if subcommand not in ["LATEST", "BEFORE", "AFTER"]:
+            self.fail("CHATHISTORY", "UNKNOWN_COMMAND", subcommand, "Unknown subcommand")
+            return
+        elif channel is None or self not in channel.clients:
+            self.fail("CHATHISTORY", "INVALID_TARGET", subcommand + " " + arguments[1], "You are not on that channel")
+            return
+
+        try:
+            limit = min(int(arguments[3]), maximum)
+        except ValueError:
+            limit = -1
+
+        records = self._server.history.query(channel.name, subcommand, arguments[2], limit) if limit >= 0 else None
+
+        if records is None:
+            self.fail("CHATHISTORY", "INVALID_PARAMS", subcommand, "Invalid message reference or limit")
+            return
+
+        # Stored lines go out as they were encoded, only this client's tags are put in front
+        batch = Capability.reference() if self.caps & Capability.batch else None
+
+        if batch is not None:
+            self.write(self.substitute(":{fqdn} BATCH +{0} chathistory {1}").format(batch, channel.name))
+
+        for sequence, msgid, when, encoded in records:
+            tags = {"msgid": msgid, "batch": batch} if batch is not None else {"msgid": msgid}
+            prefix = Capability.render("", self.caps, tags, when)
+            self.write_encoded(prefix + encoded[:-2].decode("utf-8"), prefix.encode("utf-8") + encoded)
+
+        if batch is not None:
+            self.write(self.substitute(":{fqdn} BATCH -{0}").format(batch))
+
+    # COMMAND: "GLINE"
+    def cmd_gline(self, arguments):
+        self.set_ban("G", "GLINE", arguments)
+
+    # COMMAND: "INVITE"
+    def cmd_invite(self, arguments):
+        if len(arguments) < 2:
+            self.num_461_more_parameters("INVITE")
+            return
+
+        target = self._server.get_client(arguments[0])
+        channel = self._server.channels.get(arguments[1].lower(), None)
+
+        if target is None:
+            self.num_401_no_such_recipient(arguments[0])
+        elif channel is None:
+            self.num_403_no_such_channel(arguments[1])
+        elif channel.name not in self.channels:
+            self.num_442_not_on_channel(channel.name)
+        elif "i" in channel.modes and not channel.operator(self, True):
+            self.num_482_not_channel_operator(channel.name)
+        elif channel.name in target.channels:
+            self.num_443_user_on_channel(target.nick, channel.name)
+        else:
+            self.num_341_inviting(target.nick, channel.name)
+
+            if target.link is not None:
+                self._server.links.invite(self, target, channel)
+            else:
+                channel.invite(target)
+                target.write(self.substitute(":{identifier} INVITE {0} :{1}").format(target.nick, channel.name))
+
     # COMMAND: "ISON"
     def cmd_ison(self, arguments):
         if len(arguments) < 1:
@@ -563,28 +1267,131 @@ class Client(object):
     def cmd_join(self, arguments):
         if len(arguments) < 1:
             self.num_461_more_parameters("JOIN")
-        elif arguments[0][0] != "#":
-            self.num_403_no_such_channel(arguments[0])
         else:
-            if arguments[0] not in self.channels:
-                if len(arguments) < 2:
-                    arguments.append("")
+            # Keys line up with the channels they're for: JOIN #a,#b keyA,keyB
+            keys = arguments[1].split(",") if len(arguments) > 1 else []
+            joined = [channel.lower() for channel in self.channels]
 
-                count = 1
+            # Loop through all channels that have been provided
+            for count, channel in enumerate(arguments[0].split(",")):
+                if not len(channel) or channel[0] != "#":
+                    self.num_403_no_such_channel(channel)
+                elif channel.lower() not in joined:
+                    self._server.channel_join(self, channel, keys[count] if count < len(keys) else None)
 
-                # Loop through all channels that have been provided
-                for channel in arguments[0].split(","):
-                    if count + 1 <= len(arguments):
-                        key = arguments[count]
-                    else:
-                        key = None
+    # COMMAND: "KICK"
+    def cmd_kick(self, arguments):
+        if len(arguments) < 2:
+            self.num_461_more_parameters("KICK")
+            return
 
-                    self._server.channel_join(self.index, channel, key)
-                    count += 1
+        reason = " ".join(arguments[2:]) if len(arguments) > 2 else self.nick
+        reason = reason[1:] if reason.startswith(":") else reason
+
+        if not self._server.channel_exists(arguments[0]):
+            self.num_403_no_such_channel(arguments[0])
+            return
+
+        channel = self._server.channels[arguments[0].lower()]
+
+        # Several members can be kicked at once: KICK #channel a,b :reason
+        for nick in arguments[1].split(","):
+            target = self._server.get_client(nick)
+
+            if target is None:
+                self.num_401_no_such_recipient(nick)
+            else:
+                channel.handle_kick(self, target, reason)
+
+    # COMMAND: "KLINE"
+    def cmd_kline(self, arguments):
+        self.set_ban("K", "KLINE", arguments)
+
+    # KLINE/GLINE [duration] <[user@]host|address/CIDR> [:reason], operators only
+    def set_ban(self, kind, command, arguments):
+        if "o" not in self.modes:
+            self.num_481_no_privileges()
+            return
+
+        duration = Bans.duration(arguments[0]) if len(arguments) > 1 else None
+        arguments = arguments[1:] if duration is not None else arguments
+
+        if len(arguments) < 1:
+            self.num_461_more_parameters(command)
+            return
+
+        reason = " ".join(arguments[1:]) if len(arguments) > 1 else "No reason"
+        reason = reason[1:] if reason.startswith(":") else reason
+
+        try:
+            self._server.add_ban(kind, arguments[0], self.nick, reason, duration or 0)
+        except Bans.BansError as error:
+            self.notice_server(str(error))
+
+    # UNKLINE/UNGLINE <mask>, operators only
+    def unset_ban(self, kind, command, arguments):
+        if "o" not in self.modes:
+            self.num_481_no_privileges()
+        elif len(arguments) < 1:
+            self.num_461_more_parameters(command)
+        elif self._server.remove_ban(kind, arguments[0], self.nick) is None:
+            self.notice_server("No {0}-line on {1}".format(kind, Bans.normalise(arguments[0])))
+
+    # COMMAND: "LIST"
+    def cmd_list(self, arguments):
+        self.num_321_list_start()
+        self.stream(self.list_replies(arguments[0] if len(arguments) else ""), self.num_323_end_of_list())
+
+    # Generates 322 lines lazily, terms are channel names/masks plus >n and <n member count filters
+    def list_replies(self, query):
+        minimum = -1
+        maximum = None
+        names = []
+        patterns = []
+
+        for term in query.split(","):
+            if term.startswith(">") and term[1:].isdigit():
+                minimum = int(term[1:])
+            elif term.startswith("<") and term[1:].isdigit():
+                maximum = int(term[1:])
+            elif "*" in term or "?" in term:
+                patterns.append(Mask.compile(term))
+            elif len(term):
+                names.append(term)
+
+        # Named channels are looked up directly, everything else walks the member count buckets
+        if len(names):
+            channels = [self._server.channels[name.lower()] for name in names if name.lower() in self._server.channels]
+        else:
+            channels = self._server.channels_by_size(minimum, maximum)
+
+        for channel in channels:
+            if channel.destroyed or len(channel.clients) <= minimum:
+                continue
+            elif maximum is not None and len(channel.clients) >= maximum:
+                continue
+            elif len(patterns) and not any(pattern(Mask.casefold(channel.name)) for pattern in patterns):
+                continue
+
+            yield self.num_322_list(channel)
 
     # COMMAND: "LUSERS"
     def cmd_lusers(self, arguments):
+        self.send_lusers()
+
+    # Every count comes from a set or counter the server keeps up to date, nothing is scanned
+    def send_lusers(self):
         self.num_251_lusers_total()
+
+        if len(self._server.user_modes["o"]):
+            self.num_252_lusers_operators()
+
+        if len(self._server.clients) + len(self._server.remote_clients) > len(self._server.users):
+            self.num_253_lusers_unknown()
+
+        if len(self._server.channels):
+            self.num_254_lusers_channels()
+
         self.num_255_lusers_local_total()
         self.num_265_lusers_local_users()
         self.num_266_lusers_global_users()
@@ -616,12 +1423,82 @@ class Client(object):
                 " ".join(arguments[2:]) if len(arguments) >= 3 else None
             )
 
+    # COMMAND: "MONITOR"
+    def cmd_monitor(self, arguments):
+        if len(arguments) < 1:
+            self.num_461_more_parameters("MONITOR")
+            return
+
+        action = arguments[0]
+        targets = [nick for nick in arguments[1].split(",") if len(nick)] if len(arguments) > 1 else []
+
+        # Watch more nicks, replying with the current state of each one that was added
+        if action == "+":
+            limit = self._server.config.server.get("monitor_limit", Client.monitor_limit)
+            room = max(limit - len(self.monitoring), 0)
+            added = []
+            rejected = []
+
+            for nick in targets:
+                if not IRC.nick_valid(nick) or nick.lower() in self.monitoring:
+                    continue
+                elif len(added) < room:
+                    self._server.add_monitors(self, [nick])
+                    added.append(nick)
+                else:
+                    rejected.append(nick)
+
+            if len(rejected):
+                self.num_734_monitor_list_full(limit, rejected)
+
+            self.monitor_status(added)
+        elif action == "-":
+            self._server.remove_monitors(self, targets)
+        elif action.upper() == "C":
+            self._server.remove_monitors(self, list(self.monitoring))
+        elif action.upper() == "L":
+            self.num_732_monitor_list(sorted(self.monitoring))
+            self.num_733_end_of_monitor_list()
+        elif action.upper() == "S":
+            self.monitor_status(sorted(self.monitoring))
+
+    # 730/731 replies for each of nicks
+    def monitor_status(self, nicks):
+        online = []
+        offline = []
+
+        for nick in nicks:
+            target = self._server.get_client(nick)
+
+            if target is not None and target.authorised:
+                online.append(target.get_identifier())
+            else:
+                offline.append(self._server.nicks_cased.get(nick.lower(), nick))
+
+        if len(online):
+            self.num_730_monitor_online(online)
+
+        if len(offline):
+            self.num_731_monitor_offline(offline)
+
     # COMMAND: "MOTD"
     def cmd_motd(self, arguments):
         self.num_375_motd_start()
         self.num_372_motd()
         self.num_376_motd_end()
 
+    # COMMAND: "NAMES"
+    def cmd_names(self, arguments):
+        if len(arguments) < 1:
+            self.num_366_end_of_names("*")
+            return
+
+        for name in arguments[0].split(","):
+            if self._server.channel_exists(name):
+                self._server.channels[name.lower()].send_names(self)
+            else:
+                self.num_366_end_of_names(name)
+
     # COMMAND: "NICK"
     def cmd_nick(self, arguments):
         if len(arguments) == 0:
@@ -633,15 +1510,21 @@ class Client(object):
             if IRC.nick_valid(arguments[0]):
                 if self._server.nick_available(arguments[0]):
                     if self.nick is not None:
-                        self._server.broadcast_nick(self.nick, arguments[0])
+                        self._server.broadcast_nick(self, arguments[0])
                         self._server.deregister_nick(self.nick)
 
-                    self._server.register_nick(arguments[0], self.index)
+                    self._server.register_nick(arguments[0], self)
 
                     if self.authorised:
                         self.write(self.substitute(":{identifier} NICK :" + arguments[0]))
 
                     self.nick = arguments[0]
+                    self.nick_time = time.time()
+                    self._server.invalidate_verdicts(self)
+
+                    if self.authorised:
+                        self._server.links.nick(self)
+                        self._server.check_nick(self)
 
                     if not self.authorised:
                         self.check_authorisation()
@@ -659,16 +1542,58 @@ class Client(object):
         else:
             arguments[1] = arguments[1][1:] if arguments[1][0] == ":" else arguments[1]
 
+            if not self.filter_message("NOTICE", arguments[0], " ".join(arguments[1:])):
+                return
+
             # Channel
             if arguments[0][0] == "#":
-                self._server.channel_notice(self.index, arguments[0], " ".join(arguments[1:]))
+                self._server.channel_notice(self, arguments[0], " ".join(arguments[1:]))
             # User
             else:
                 if not self._server.nick_available(arguments[0]):
-                    self._server.private_notice(self.index, arguments[0], " ".join(arguments[1:]))
+                    self._server.private_notice(self, arguments[0], " ".join(arguments[1:]))
                 else:
                     self.num_401_no_such_recipient(arguments[0])
 
+    # Check text against the server's filters before it's fanned out, returns False if it was blocked.
+    # IRC operators aren't filtered
+    def filter_message(self, command, target, text):
+        if "o" in self.modes:
+            return True
+
+        pattern = self._server.filter.match(text)
+
+        if pattern is None:
+            return True
+
+        self._server.metrics.increment("pyrcd_filter_hits_total", label=pattern["pattern"])
+        self._server.log.custom(command, "[{0} to {1}] blocked by filter '{2}': {3}".format(
+            self.nick, target, pattern["pattern"], text
+        ))
+
+        # NOTICE never gets an automatic reply
+        if pattern["action"] == "block" and command == "PRIVMSG":
+            self.notice_server("Your message to {0} was blocked: {1}".format(target, pattern["reason"]))
+
+        return False
+
+    # COMMAND: "OPER"
+    def cmd_oper(self, arguments):
+        if len(arguments) < 2:
+            self.num_461_more_parameters("OPER")
+        else:
+            password = self._server.config.operators.get(arguments[0], None)
+
+            if password is not None and hmac.compare_digest(password.encode(), arguments[1].encode()):
+                self.oper = arguments[0]
+                self.mode_o("+", None)
+                self.num_381_youre_oper()
+                self._server.log.info("{0} is now an operator ({1})".format(self.get_identifier(), self.oper))
+            else:
+                self.num_464_password_mismatch()
+                self._server.log.warning("Failed OPER attempt by {0}".format(self.get_identifier()))
+                self._server.notice_operators("Failed OPER attempt by {0}".format(self.get_identifier()))
+
     # COMMAND: "PART"
     def cmd_part(self, arguments):
         if len(arguments) < 1:
@@ -676,6 +1601,8 @@ class Client(object):
         else:
             if len(arguments) < 2:
                 arguments.append("Leaving")
+            else:
+                arguments[-1] = arguments[-1][1:] if arguments[-1][0] == ":" else arguments[-1]
 
             # Loop through all channels that have been provided
             for channel in arguments[0].split(","):
@@ -684,7 +1611,7 @@ class Client(object):
                 elif channel not in self.channels:
                     self.num_442_not_on_channel(channel)
                 else:
-                    self._server.channel_part(self.index, channel, arguments[-1])
+                    self._server.channel_part(self, channel, arguments[-1])
 
     # COMMAND: "PONG"
     def cmd_pong(self, arguments):
@@ -706,16 +1633,40 @@ class Client(object):
         else:
             arguments[1] = arguments[1][1:] if arguments[1][0] == ":" else arguments[1]
 
+            if not self.filter_message("PRIVMSG", arguments[0], " ".join(arguments[1:])):
+                return
+
             # Channel
             if arguments[0][0] == "#":
-                self._server.channel_message(self.index, arguments[0], " ".join(arguments[1:]))
+                self._server.channel_message(self, arguments[0], " ".join(arguments[1:]))
             # User
             else:
                 if not self._server.nick_available(arguments[0]):
-                    self._server.private_message(self.index, arguments[0], " ".join(arguments[1:]))
+                    self._server.private_message(self, arguments[0], " ".join(arguments[1:]))
                 else:
                     self.num_401_no_such_recipient(arguments[0])
 
+    # COMMAND: "PROFILE"
+    def cmd_profile(self, arguments):
+        if "o" not in self.modes:
+            self.num_481_no_privileges()
+        elif len(arguments) and arguments[0].upper() == "STOP":
+            self._server.profiler.stop()
+            self.notice_server("Profiler stopping, output will be written to " + str(self._server.profiler.file))
+        else:
+            try:
+                duration = self._server.profiler.start(
+                    self._server.thread_id,
+                    int(arguments[0]) if len(arguments) and arguments[0].isdigit() else None
+                )
+
+                self.notice_server("Profiling for {0} seconds, writing to {1}".format(
+                    duration,
+                    self._server.profiler.file
+                ))
+            except Profiler.ProfilerError as error:
+                self.notice_server(str(error))
+
     # COMMAND: "QUIT"
     def cmd_quit(self, arguments):
         if len(arguments) == 0:
@@ -726,9 +1677,80 @@ class Client(object):
         else:
             arguments[0] = arguments[0][1:] if arguments[0][0] == ":" else arguments[0]
 
-        arguments = " ".join(arguments)
-        self._server.broadcast_quit(self.index, arguments)
-        self.close_link("Quit: " + arguments)
+        # Channel members and linked servers hear about it when the client is deregistered
+        self.quit_reason = " ".join(arguments)
+        self.close_link("Quit: " + self.quit_reason)
+
+    # COMMAND: "REGISTER"
+    def cmd_register(self, arguments):
+        if len(arguments) < 3:
+            self.num_461_more_parameters("REGISTER")
+            return
+
+        # REGISTER <account|*> <email|*> <password>, accounts are named after the nick they own
+        account = self.nick if arguments[0] == "*" else arguments[0]
+        password = " ".join(arguments[2:])
+        password = password[1:] if password.startswith(":") else password
+
+        if self._server.accounts is None:
+            self.fail("REGISTER", "TEMPORARILY_UNAVAILABLE", account, "Account registration is disabled")
+        elif self.account is not None:
+            self.fail("REGISTER", "ALREADY_AUTHENTICATED", account, "You are already logged in")
+        elif account.lower() != self.nick.lower():
+            self.fail("REGISTER", "BAD_ACCOUNT_NAME", account, "Accounts must be registered under your current nick")
+        elif len(password) < 8:
+            self.fail("REGISTER", "WEAK_PASSWORD", account, "Passwords must be at least 8 characters long")
+        elif any(name.lower() == account.lower() for name in self._server.config.accounts):
+            self.fail("REGISTER", "ACCOUNT_EXISTS", account, "Account already exists")
+        # Hashing is as slow as checking a password, it goes to the SASL workers too
+        elif not self._server.sasl.run(Sasl.hash_password, [password], lambda credential: self.register_hashed(account, credential)):
+            self.fail("REGISTER", "TEMPORARILY_UNAVAILABLE", account, "Please try again later")
+
+    def register_hashed(self, account, credential):
+        if not self.active:
+            return
+        elif credential is None or self._server.accounts is None:
+            self.fail("REGISTER", "TEMPORARILY_UNAVAILABLE", account, "Please try again later")
+        else:
+            self._server.accounts.create(account, credential, lambda created: self.register_created(account, created))
+
+    def register_created(self, account, created):
+        if not self.active:
+            return
+        elif created is None:
+            self.fail("REGISTER", "TEMPORARILY_UNAVAILABLE", account, "Please try again later")
+        elif not created:
+            self.fail("REGISTER", "ACCOUNT_EXISTS", account, "Account already exists")
+        else:
+            self.account = account
+            self.write(self.substitute(":{fqdn} REGISTER SUCCESS {0} :Account created").format(account))
+            self.num_900_logged_in(account)
+            self._server.links.account(self)
+            self._server.log.info("{0} registered account {1}".format(self.get_identifier(), account))
+
+    # COMMAND: "REHASH"
+    def cmd_rehash(self, arguments):
+        if "o" not in self.modes:
+            self.num_481_no_privileges()
+        else:
+            self.num_382_rehashing("pyrcd.json")
+
+            try:
+                changed = self._server.rehash()
+                self.notice_server("Rehash complete, reloaded: " + (", ".join(changed) if len(changed) else "nothing"))
+            except Configuration.ConfigError as error:
+                self.notice_server("Rehash failed, keeping the current configuration: " + str(error))
+
+    # COMMAND: "RESTART"
+    def cmd_restart(self, arguments):
+        if "o" not in self.modes:
+            self.num_481_no_privileges()
+        elif not Handoff.supported():
+            self.notice_server("Hot restarts are not supported on this platform")
+        else:
+            self.notice_server("Restarting, connections will be handed to a new process")
+            self._server.log.info("Hot restart requested by " + self.get_identifier())
+            self._server.restart_pending = True
 
     # COMMAND: "RULES"
     def cmd_rules(self, arguments):
@@ -736,6 +1758,147 @@ class Client(object):
         self.num_232_rules()
         self.num_309_rules_stop()
 
+    # COMMAND: "STATS"
+    def cmd_stats(self, arguments):
+        if len(arguments) < 1:
+            self.num_461_more_parameters("STATS")
+            return
+
+        letter = arguments[0][0]
+        metrics = self._server.metrics
+
+        # Command usage counts
+        if letter == "m":
+            for command, count in sorted(metrics.labels("pyrcd_commands_total").items()):
+                self.num_212_stats_commands(command, count)
+        # K-lines and G-lines
+        elif letter in ["k", "g"]:
+            if "o" not in self.modes:
+                self.num_481_no_privileges()
+            else:
+                for ban in self._server.bans.list(letter.upper()):
+                    if letter == "k":
+                        self.num_216_stats_kline(ban)
+                    else:
+                        self.num_223_stats_gline(ban)
+        # Filter patterns and how often each one matched
+        elif letter == "f":
+            if "o" not in self.modes:
+                self.num_481_no_privileges()
+            else:
+                for pattern, hits in self._server.filter.statistics():
+                    self.num_249_stats_debug("Filter {0} {1} ({2}): {3} hits".format(
+                        "regex" if pattern["regex"] else "literal",
+                        pattern["pattern"],
+                        pattern["action"],
+                        hits
+                    ))
+        # Uptime
+        elif letter == "u":
+            self.num_242_stats_uptime()
+        # Hot-path instrumentation summary
+        elif letter == "z":
+            hits = metrics.counter("pyrcd_cache_hits_total", "hostname")
+            misses = metrics.counter("pyrcd_cache_misses_total", "hostname")
+
+            buffer = [
+                "Lines in {0}, out {1}".format(
+                    metrics.counter("pyrcd_lines_in_total"),
+                    metrics.counter("pyrcd_lines_out_total")
+                ),
+                "Bytes in {0}, out {1}".format(
+                    metrics.counter("pyrcd_bytes_in_total"),
+                    metrics.counter("pyrcd_bytes_out_total")
+                ),
+                "Loop iteration p50 <= {0}s, p99 <= {1}s".format(
+                    metrics.quantile("pyrcd_loop_iteration_seconds", 0.5),
+                    metrics.quantile("pyrcd_loop_iteration_seconds", 0.99)
+                ),
+                "Loop lag p50 <= {0}s, p99 <= {1}s".format(
+                    metrics.quantile("pyrcd_loop_lag_seconds", 0.5),
+                    metrics.quantile("pyrcd_loop_lag_seconds", 0.99)
+                ),
+                "Broadcast fan-out p50 <= {0}, p99 <= {1}".format(
+                    metrics.quantile("pyrcd_broadcast_fanout", 0.5),
+                    metrics.quantile("pyrcd_broadcast_fanout", 0.99)
+                ),
+                "Send queue p99 <= {0} bytes".format(
+                    metrics.quantile("pyrcd_send_queue_bytes", 0.99)
+                ),
+                "DNS lookup p50 <= {0}s, p99 <= {1}s".format(
+                    metrics.quantile("pyrcd_dns_lookup_seconds", 0.5),
+                    metrics.quantile("pyrcd_dns_lookup_seconds", 0.99)
+                ),
+                "Hostname cache {0} hits, {1} misses ({2:.1f}% hit rate)".format(
+                    hits,
+                    misses,
+                    100.0 * hits / (hits + misses) if hits + misses else 0
+                ),
+                "TLS handshakes {0} ({1} resumed, {2} failed), CPU p50 <= {3}s, p99 <= {4}s".format(
+                    metrics.counter("pyrcd_tls_handshakes_total"),
+                    metrics.counter("pyrcd_tls_resumed_total"),
+                    metrics.counter("pyrcd_tls_handshake_failures_total"),
+                    metrics.quantile("pyrcd_tls_handshake_seconds", 0.5),
+                    metrics.quantile("pyrcd_tls_handshake_seconds", 0.99)
+                )
+            ]
+
+            for command in sorted(metrics.labels("pyrcd_commands_total").keys()):
+                buffer.append("Command {0} p50 <= {1}s, p99 <= {2}s".format(
+                    command,
+                    metrics.quantile("pyrcd_command_seconds", 0.5, command),
+                    metrics.quantile("pyrcd_command_seconds", 0.99, command)
+                ))
+
+            for line in buffer:
+                self.num_249_stats_debug(line)
+
+        self.num_219_end_of_stats(letter)
+
+    # COMMAND: "TAGMSG"
+    def cmd_tagmsg(self, arguments):
+        if len(arguments) < 1:
+            self.num_411_no_recipient("TAGMSG")
+        elif not self.caps & Capability.message_tags:
+            self.num_421_unknown_command("TAGMSG")
+        # Channel
+        elif arguments[0][0] == "#":
+            self._server.channel_tagmsg(self, arguments[0])
+        # User
+        elif not self._server.nick_available(arguments[0]):
+            self._server.private_tagmsg(self, arguments[0])
+        else:
+            self.num_401_no_such_recipient(arguments[0])
+
+    # COMMAND: "TOPIC"
+    def cmd_topic(self, arguments):
+        if len(arguments) < 1:
+            self.num_461_more_parameters("TOPIC")
+        elif not self._server.channel_exists(arguments[0]):
+            self.num_403_no_such_channel(arguments[0])
+        else:
+            channel = self._server.channels[arguments[0].lower()]
+
+            # Asking for the topic
+            if len(arguments) == 1:
+                if channel.topic["author"] is not None and len(channel.topic["content"]):
+                    self.num_332_channel_topic(channel.name, channel.topic["content"])
+                    self.num_333_channel_topic_time(channel.name, channel.topic["time"], channel.topic["author"])
+                else:
+                    self.num_331_no_topic(channel.name)
+            # Setting it, an empty topic clears it
+            else:
+                topic = " ".join(arguments[1:])
+                channel.handle_topic(self, topic[1:] if topic.startswith(":") else topic)
+
+    # COMMAND: "UNGLINE"
+    def cmd_ungline(self, arguments):
+        self.unset_ban("G", "UNGLINE", arguments)
+
+    # COMMAND: "UNKLINE"
+    def cmd_unkline(self, arguments):
+        self.unset_ban("K", "UNKLINE", arguments)
+
     # COMMAND: "USER"
     def cmd_user(self, arguments):
         if len(arguments) < 4:
@@ -767,18 +1930,88 @@ class Client(object):
                     online.append(
                         "{0}={1}".format(
                             nick,
-                            self._server.clients[self._server.nicks[nick.lower()]].get_identifier()
+                            self._server.get_client(nick).get_identifier()
                         )
                     )
 
             self.num_302_userhost(online)
 
+    # COMMAND: "WALLOPS"
+    def cmd_wallops(self, arguments):
+        if len(arguments) < 1:
+            self.num_461_more_parameters("WALLOPS")
+        elif "o" not in self.modes:
+            self.num_481_no_privileges()
+        else:
+            text = " ".join(arguments)
+            text = text[1:] if text.startswith(":") else text
+
+            self._server.wallops(self, text)
+            self._server.links.wallops(self, text)
+
+    # COMMAND: "WHO"
+    def cmd_who(self, arguments):
+        mask = arguments[0] if len(arguments) and arguments[0] != "0" else "*"
+
+        # WHOX: WHO <mask> [<match flags>][%<fields>[,<token>]]
+        flags, _, fields = (arguments[1] if len(arguments) > 1 else "").partition("%")
+        fields, _, token = fields.partition(",")
+
+        self.stream(self.who_replies(mask, flags, fields, token or "0"), self.num_315_end_of_who(mask))
+
+    # Generates 352/354 lines lazily. Match flags pick what a mask is compared against: n(ick), u(ser),
+    # h(ost), i(p, operators only), s(erver) and r(ealname), all but i by default; o limits it to operators
+    def who_replies(self, mask, flags, fields, token):
+        operator = "o" in self.modes
+        match = set(flags) & set("nuhisr") or set("nuhsr")
+
+        if not operator:
+            match.discard("i")
+
+        # A channel lists its members, non-members only see the visible ones
+        if mask.startswith("#"):
+            channel = self._server.channels.get(mask.lower(), None)
+            candidates = list(channel.clients) if channel is not None else []
+            member = channel is not None and channel.name in self.channels
+            pattern = None
+        else:
+            channel = None
+            candidates = self._server.who_candidates(mask, match)
+            member = False
+            pattern = Mask.compile(mask)
+
+        for target in candidates:
+            # Gone (or renamed away) since the reply started
+            if not target.authorised or self._server.nicks.get(target.nick.lower(), None) is not target:
+                continue
+            elif "o" in flags and "o" not in target.modes:
+                continue
+            elif "i" in target.modes and not (member or operator or target is self or set(self.channels) & set(target.channels)):
+                continue
+
+            if pattern is not None:
+                values = {
+                    "n": target.nick,
+                    "u": target.user,
+                    "h": target.get_hostname(),
+                    "i": target.ip_address,
+                    "s": target.origin,
+                    "r": target.name
+                }
+
+                # Operators can find users by their real host as well
+                if not any(pattern(Mask.casefold(values[field])) for field in match):
+                    if not (operator and "h" in match and pattern(Mask.casefold(target.hostname))):
+                        continue
+
+            yield self.num_352_who(target, channel, fields, token)
+
     # COMMAND: "WHOIS"
     def cmd_whois(self, arguments):
         if len(arguments) < 1:
             self.num_431_no_nick_given("WHOIS")
         elif not self._server.nick_available(arguments[0]):
-            target = self._server.clients[self._server.nicks[arguments[0].lower()]]
+            target = self._server.get_client(arguments[0])
             self.num_311_whois(target)
             self.num_378_whois(target)
 
@@ -787,35 +2020,78 @@ class Client(object):
                 self.num_319_user_channels(target)
 
             self.num_312_whois(target)
+
+            if target.account is not None:
+                self.num_330_whois_account(target)
+
+            if target.secure:
+                self.num_671_whois_secure(target)
+
             self.num_317_whois(target)
             self.num_318_end_of_whois_list(arguments[0])
         else:
             self.num_401_no_such_recipient(arguments[0])
             self.num_318_end_of_whois_list(arguments[0])
 
+    # COMMAND: "WHOWAS"
+    def cmd_whowas(self, arguments):
+        if len(arguments) < 1:
+            self.num_431_no_nick_given("WHOWAS")
+            return
+
+        # WHOWAS <nick>[,<nick>...] [count], a count of zero or less returns everything remembered
+        try:
+            count = int(arguments[1]) if len(arguments) > 1 else None
+        except ValueError:
+            count = None
+
+        count = count if count is None or count > 0 else None
+
+        for nick in [nick for nick in arguments[0].split(",") if len(nick)][:Client.whowas_targets]:
+            records = self._server.whowas.lookup(nick, count)
+
+            if not len(records):
+                self.num_406_was_no_such_nick(nick)
+
+            for record in records:
+                self.num_314_whowas(record)
+                self.num_312_whowas(record)
+
+                if record[5] is not None:
+                    self.num_330_whowas_account(record)
+
+            self.num_369_end_of_whowas(nick)
+
     # MODE: "i"
     def mode_i(self, mode, arguments):
-        if "i" not in self.modes and mode == "+":
-            self.modes.append("i")
-            return self.broadcast_mode("+i")
-        elif "i" in self.modes and mode == "-":
-            self.modes.remove("i")
-            return self.broadcast_mode("-i")
+        return self.mode_setting(mode, "i")
+
+    # MODE: "o"
+    def mode_o(self, mode, arguments):
+        # Operator status is only granted through OPER
+        if mode == "+" and self.oper is None:
+            return None
+        elif mode == "-" and "o" in self.modes:
+            self.oper = None
+
+        return self.mode_setting(mode, "o")
 
     # MODE: "w"
     def mode_w(self, mode, arguments):
-        if "w" not in self.modes and mode == "+":
-            self.modes.append("w")
-            return self.broadcast_mode("+w")
-        elif "w" in self.modes and mode == "-":
-            self.modes.remove("w")
-            return self.broadcast_mode("-w")
+        return self.mode_setting(mode, "w")
 
     # MODE: "x"
     def mode_x(self, mode, arguments):
-        if "x" not in self.modes and mode == "+":
-            self.modes.append("x")
-            return self.broadcast_mode("+x")
-        elif "x" in self.modes and mode == "-":
-            self.modes.remove("x")
-            return self.broadcast_mode("-x")
\ No newline at end of file
+        return self.mode_setting(mode, "x")
+
+    # Set or unset a plain user mode, keeping the server's per-mode index in step
+    def mode_setting(self, mode, letter):
+        if letter not in self.modes and mode == "+":
+            self.modes.append(letter)
+        elif letter in self.modes and mode == "-":
+            self.modes.remove(letter)
+        else:
+            return None
+
+        self._server.index_user_mode(self, letter, mode == "+")
+        return self.broadcast_mode(mode + letter)
\ No newline at end of file
@@ -0,0 +1,68 @@
+import hmac
+import ipaddress
+import os
+from System.cache import *
+
+
+class Cloak(object):
+    class CloakError(Exception):
+        pass
+
+    # Defaults for the optional [cloak] section
+    prefix = "pyrcd"
+    cache_size = 16384
+
+    def __init__(self, server):
+        self._server = server
+        settings = server.config.cloak or {}
+
+        # Without a configured key cloaks are only stable for this process (hot restarts carry them over), a
+        # fresh start or another server on the network would hide the same host differently
+        self.generated = not len(settings.get("key", ""))
+        self.key = os.urandom(32) if self.generated else settings["key"].encode("utf-8")
+        self.prefix = settings.get("prefix", Cloak.prefix)
+
+        # Host or address -> cloak
+        self.cache = Cache(settings.get("cache_size", Cloak.cache_size))
+
+    # Cloak for a client's host: a resolved hostname keeps its domain, an address its network hierarchy
+    def hide(self, host):
+        cloak = self.cache.get(host.lower(), None)
+
+        if cloak is not None:
+            self._server.metrics.increment("pyrcd_cache_hits_total", label="cloak")
+            return cloak
+
+        self._server.metrics.increment("pyrcd_cache_misses_total", label="cloak")
+        cloak = self.address(host) or self.hostname(host)
+        self.cache.set(host.lower(), cloak)
+
+        return cloak
+
+    def digest(self, text):
+        return hmac.new(self.key, text.encode("utf-8"), "sha256").hexdigest()[:8].upper()
+
+    # "A.B.C.IP" for IPv4 and "A:B:C:IP" for IPv6, hashes of the address and its enclosing /24 and /16 (IPv4)
+    # or /64 and /48 (IPv6) networks. Most specific first like a hostname, so "*.B.C.IP" bans the /24 without
+    # revealing it. None if host isn't an address
+    def address(self, host):
+        try:
+            address = ipaddress.ip_address(host.split("%")[0])
+        except ValueError:
+            return None
+
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+
+        if address.version == 4:
+            octets = str(address).split(".")
+            return "{0}.{1}.{2}.IP".format(*[self.digest(".".join(octets[:count])) for count in (4, 3, 2)])
+
+        hextets = address.exploded.split(":")
+        return "{0}:{1}:{2}:IP".format(*[self.digest(":".join(hextets[:count])) for count in (8, 4, 3)])
+
+    # "<prefix>-HASH.isp.example.com" for "cpe-1-2-3-4.isp.example.com", the first label hides the customer
+    # while the rest of the domain stays matchable
+    def hostname(self, host):
+        labels = host.lower().split(".")
+        return ".".join(["{0}-{1}".format(self.prefix, self.digest(host.lower()))] + labels[1:])
@@ -1,49 +1,195 @@
 import json
 import os
+import time
 
 
 class Configuration(object):
     class ConfigError(Exception):
         pass
 
+    # Expected types of the [server] settings, checked before a configuration is swapped in
+    types = {
+        "debug": int,
+        "fqdn": str,
+        "name": str,
+        "client_limit": int,
+        "recv_buffer": int,
+        "sendq": int,
+        "accept_budget": int,
+        "setup_budget": int,
+        "monitor_limit": int,
+        "whowas_limit": int,
+        "motd": str,
+        "rules": str
+    }
+
     def __init__(self, path, categories):
         # Reset properties
         self.bind = None
         self.server = None
+        self.metrics = None
+        self.operators = {}
+        self.accounts = {}
+        self.sasl = None
+        self.registration = None
+        self.history = None
+        self.filters = []
+        self.dnsbl = None
+        self.cloak = None
+        self.persistence = None
+        self.links = None
 
-        self.motd = {"modified": 0, "content": ""}
-        self.rules = {"modified": 0, "content": ""}
+        self.modified = 0
+        self.motd = {"file": None, "modified": 0, "content": "", "lines": []}
+        self.rules = {"file": None, "modified": 0, "content": "", "lines": []}
 
-        # Load configuration file and parse as JSON
-        try:
-            configuration = self.read_file(path + "pyrcd.json")
-            configuration = json.loads(configuration[0])
-        except json.decoder.JSONDecodeError as error:
-            raise self.ConfigError("Configuration file has invalid contents (not parsable JSON): " + str(error))
+        self._path = path
+        self._categories = categories
+
+        self.reload()
+
+    # Re-read whatever changed on disk since the last load, returns the names of the changed parts
+    def reload(self):
+        changed = []
+        configuration = None
+        modified = self.get_modified(self._path + "pyrcd.json")
+
+        # Load configuration file and parse as JSON, only when it has been touched
+        if modified != self.modified:
+            try:
+                configuration = self.read_file(self._path + "pyrcd.json")
+                modified = configuration[1]
+                configuration = json.loads(configuration[0])
+            except ValueError as error:
+                raise self.ConfigError("Configuration file has invalid contents (not parsable JSON): " + str(error))
+
+            success, error = self.check_keys(configuration, self._categories)
+
+            if not success:
+                raise self.ConfigError(error)
+
+            success, error = self.check_types(configuration["server"])
+
+            if not success:
+                raise self.ConfigError(error)
+
+            # A single listener object is shorthand for a list of one
+            if isinstance(configuration["bind"], dict):
+                configuration["bind"] = [configuration["bind"]]
+
+            success, error = self.check_binds(configuration["bind"])
+
+            if not success:
+                raise self.ConfigError(error)
+
+            server = configuration["server"]
+        else:
+            server = self.server
+
+        # Re-read the MOTD/rules when they've been edited or the setting points to another file
+        motd = self.reload_text(self.motd, self._path + server["motd"])
+        rules = self.reload_text(self.rules, self._path + server["rules"])
+
+        # Everything parsed and validated, swap it all in
+        if configuration is not None:
+            # Listening sockets can't be moved without a restart, keep the bound address
+            if self.bind is None:
+                self.bind = configuration["bind"]
+            elif configuration["bind"] != self.bind:
+                changed.append("bind (requires restart)")
+
+            self.modified = modified
+            self.server = configuration["server"]
+
+            # Optional sections
+            self.metrics = configuration.get("metrics", None)
+            self.operators = configuration.get("operators", {})
+            self.accounts = configuration.get("accounts", {})
+            self.sasl = configuration.get("sasl", None)
+            self.registration = configuration.get("registration", None)
+            self.history = configuration.get("history", None)
+            self.filters = configuration.get("filters", [])
+            self.dnsbl = configuration.get("dnsbl", None)
+            self.cloak = configuration.get("cloak", None)
+            self.persistence = configuration.get("persistence", None)
+            self.links = configuration.get("links", None)
+
+            changed.append("pyrcd.json")
+
+        if motd is not None:
+            self.motd = motd
+            changed.append(server["motd"])
+
+        if rules is not None:
+            self.rules = rules
+            changed.append(server["rules"])
+
+        # The server name/FQDN are baked into the pre-rendered blocks
+        if configuration is not None or motd is not None:
+            self.motd["lines"] = self.render_motd()
+
+        if configuration is not None or rules is not None:
+            self.rules["lines"] = self.render_rules()
+
+        return changed
 
-        success, error = self.check_keys(configuration, categories)
+    # Returns a fresh text record when the file differs from the loaded one, otherwise None
+    def reload_text(self, record, file):
+        if record["file"] == file and record["modified"] == self.get_modified(file):
+            return None
 
-        if not success:
-            raise self.ConfigError(error)
+        content, modified = self.read_file(file)
+        return {"file": file, "modified": modified, "content": content, "lines": []}
 
-        self.bind = configuration["bind"]
-        self.server = configuration["server"]
+    # Pre-render MOTD lines with everything but the nick filled in
+    def render_motd(self):
+        lines = [":{0} 372 {{nick}} :- {1}".format(
+            self.server["fqdn"],
+            time.strftime("%d/%m/%Y %H:%M", time.localtime(self.motd["modified"]))
+        )]
 
-        self.motd["content"], self.motd["modified"] = self.read_file(path + self.server["motd"])
-        self.rules["content"], self.rules["modified"] = self.read_file(path + self.server["rules"])
+        for line in self.motd["content"].split("\n"):
+            lines.append(":{fqdn} 372 {nick} :- " + line)
+
+        return self.render_block(lines)
+
+    # Pre-render rules lines with everything but the nick filled in
+    def render_rules(self):
+        return self.render_block([":{fqdn} 232 {nick} :- " + line for line in self.rules["content"].split("\n")])
+
+    # Splits each line around "{nick}" so a client only has to join its nick back in
+    def render_block(self, lines):
+        block = []
+
+        for line in lines:
+            line = line.replace("{fqdn}", self.server["fqdn"]).replace("{server_name}", self.server["name"])
+            block.append(tuple(line.split("{nick}")))
+
+        return block
+
+    # Relative paths in the configuration are relative to the configuration directory
+    def resolve(self, file):
+        return os.path.join(self._path, file)
+
+    @staticmethod
+    def get_modified(file):
+        try:
+            return os.path.getmtime(file)
+        except OSError:
+            raise Configuration.ConfigError("Could not read file '" + file + "'")
 
     @staticmethod
     def read_file(file):
-        with open(file) as handle:
-            try:
+        try:
+            with open(file) as handle:
                 return handle.read(), os.path.getmtime(file)
-            except (IOError, FileNotFoundError):
-                raise Configuration.ConfigError("Could not read file '" + file + "'")
+        except (IOError, FileNotFoundError):
+            raise Configuration.ConfigError("Could not read file '" + file + "'")
 
     @staticmethod
     def check_keys(configuration, categories):
         # Check top-level configuration keys
-        if set(configuration.keys()) < set(categories.keys()):
+        if not set(categories.keys()) <= set(configuration.keys()):
             return False, "Some settings are missing"
 
         # Check second-level configuration keys
@@ -53,3 +199,32 @@ class Configuration(object):
                     return False, "'{0}' setting is missing from section [{1}]".format(str(setting), str(category))
 
         return True, ""
+
+    @staticmethod
+    def check_binds(binds):
+        if not isinstance(binds, list) or not len(binds):
+            return False, "Section [bind] must be a listener or a list of listeners"
+
+        for bind in binds:
+            if not isinstance(bind, dict):
+                return False, "Each listener in section [bind] must be an object"
+
+            if "path" not in bind and not ("address" in bind and "port" in bind):
+                return False, "Each listener in section [bind] needs an 'address' and 'port', or a 'path'"
+
+            for setting in ["backlog", "accept_batch"]:
+                if not isinstance(bind.get(setting, 1), int) or bind.get(setting, 1) < 1:
+                    return False, "'{0}' setting in section [bind] must be a positive integer".format(setting)
+
+        return True, ""
+
+    @staticmethod
+    def check_types(server):
+        for setting, expected in Configuration.types.items():
+            if setting in server and not isinstance(server[setting], expected):
+                return False, "'{0}' setting in section [server] must be of type {1}".format(setting, expected.__name__)
+
+        if server.get("recv_buffer", 1) < 1:
+            return False, "'recv_buffer' setting in section [server] must be positive"
+
+        return True, ""
@@ -0,0 +1,276 @@
+import collections
+import concurrent.futures
+import ipaddress
+import os
+import select
+import socket
+import struct
+import time
+from System.cache import *
+
+
+class Dnsbl(object):
+    class DnsblError(Exception):
+        pass
+
+    # Defaults for the optional [dnsbl] section
+    timeout = 2
+    workers = 4
+    cache_size = 16384
+    cache_ttl = 3600
+    negative_ttl = 900
+
+    def __init__(self, server):
+        self._server = server
+        self._pool = None
+
+        # Finished checks as (ip address, result, cache ttl, seconds taken), filled by the pool threads and drained by the server
+        # loop. result is a listing {"zone", "reason"}, False if the address isn't listed or None if some zone
+        # didn't answer in time (which isn't cached, the next connection asks again)
+        self.results = collections.deque()
+
+        # Address -> (deadline, clients waiting on its check), so clones share one check. The server loop lets
+        # clients go once the deadline passes, even if the check itself is still stuck in the pool
+        self.waiting = {}
+
+        self.cache = Cache(self.setting("cache_size", Dnsbl.cache_size))
+
+        # Zones the cached results were found with, a REHASH that changes them starts the cache afresh
+        self.zones = []
+
+    def setting(self, key, default):
+        return (self._server.config.dnsbl or {}).get(key, default)
+
+    # Start checking a new client's address against every zone. Clients only register once their check is done
+    # (or its deadline has passed), a listed one is disconnected
+    def check(self, client):
+        zones = self.setting("zones", [])
+        name = Dnsbl.reverse(client.ip_address)
+
+        if not len(zones) or name is None:
+            return
+        elif zones != self.zones:
+            self.cache.clear()
+            self.zones = zones
+
+        cached = self.cache.get(client.ip_address, None)
+
+        if cached is not None:
+            self._server.metrics.increment("pyrcd_cache_hits_total", label="dnsbl")
+            self.finish(client, cached)
+            return
+
+        client.dnsbl_pending = True
+
+        if client.ip_address in self.waiting:
+            self.waiting[client.ip_address][1].append(client)
+            return
+
+        # The deadline counts from now, so time spent queued behind other checks comes out of it too
+        deadline = time.time() + self.setting("timeout", Dnsbl.timeout)
+
+        self._server.metrics.increment("pyrcd_cache_misses_total", label="dnsbl")
+        self.waiting[client.ip_address] = (deadline, [client])
+
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.setting("workers", Dnsbl.workers))
+
+        self._pool.submit(self.run, client.ip_address, name, zones, deadline)
+
+    # Pool thread: query every zone at once and wait for the answers until the deadline
+    def run(self, ip_address, name, zones, deadline):
+        started = time.perf_counter()
+
+        try:
+            result, ttl = self.query(name, zones, deadline)
+        except Exception as error:
+            self._server.log.warning("DNSBL check of {0} failed: {1}".format(ip_address, error))
+            result, ttl = None, 0
+
+        self.results.append((ip_address, result, ttl, time.perf_counter() - started))
+
+    # (listing, ttl) once every zone has answered or one says the address is listed, (None, 0) at the deadline
+    def query(self, name, zones, deadline):
+        nameserver = (self.setting("nameserver", None) or Dnsbl.nameserver(), self.setting("port", 53))
+        family = socket.AF_INET6 if ":" in nameserver[0] else socket.AF_INET
+        outstanding = {}
+        failed = False
+
+        if time.time() >= deadline:
+            return None, 0
+
+        with socket.socket(family, socket.SOCK_DGRAM) as handle:
+            handle.setblocking(False)
+
+            for zone in zones:
+                identifier = int.from_bytes(os.urandom(2), "big")
+                question = Dnsbl.question(identifier, name + "." + zone["zone"])
+                outstanding[identifier] = (zone, question[12:].lower())
+                handle.sendto(question, nameserver)
+
+            ttls = []
+
+            while len(outstanding):
+                remaining = deadline - time.time()
+
+                if remaining <= 0 or not len(select.select([handle], [], [], remaining)[0]):
+                    return None, 0
+
+                try:
+                    data, source = handle.recvfrom(4096)
+                except OSError:
+                    continue
+
+                # Only answers from the resolver asked, to a question still outstanding, are believed
+                if not Dnsbl.same_address(source, nameserver):
+                    continue
+
+                try:
+                    identifier, code, addresses, ttl, question = Dnsbl.answer(data)
+                except Dnsbl.DnsblError:
+                    continue
+
+                if identifier not in outstanding or outstanding[identifier][1] != question.lower():
+                    continue
+
+                zone = outstanding.pop(identifier)[0]
+
+                # Lists answer with an address in 127.0.0.0/8, NXDOMAIN (3) means the address isn't listed
+                if any(address.startswith("127.") for address in addresses):
+                    return {"zone": zone["zone"], "reason": zone.get("reason", "Listed in " + zone["zone"])}, ttl
+
+                # A zone that failed (e.g. SERVFAIL) doesn't get to clear the address for long
+                failed = failed or code not in (0, 3)
+                ttls.append(self.setting("negative_ttl", Dnsbl.negative_ttl))
+
+            return (None, 0) if failed else (False, min(ttls))
+
+    # The system resolver's first nameserver, used unless the section names one
+    @staticmethod
+    def nameserver():
+        try:
+            with open("/etc/resolv.conf") as handle:
+                for line in handle:
+                    fields = line.split()
+
+                    if len(fields) > 1 and fields[0] == "nameserver":
+                        return fields[1]
+        except OSError:
+            pass
+
+        return "127.0.0.1"
+
+    # Hand finished checks to the clients waiting on them, called from the server loop
+    def complete(self):
+        while len(self.results):
+            ip_address, result, ttl, seconds = self.results.popleft()
+            self._server.metrics.observe("pyrcd_dnsbl_lookup_seconds", seconds)
+
+            if result is not None:
+                self.cache.set(ip_address, result, min(max(ttl, 1), self.setting("cache_ttl", Dnsbl.cache_ttl)))
+
+            for client in self.waiting.pop(ip_address, (0, []))[1]:
+                self.finish(client, result)
+
+    # Once a second: let clients whose check has run past its deadline register as if their address wasn't
+    # listed, a late result is still cached when it arrives
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+
+        for ip_address, (deadline, clients) in list(self.waiting.items()):
+            if now >= deadline:
+                del self.waiting[ip_address]
+
+                for client in clients:
+                    self.finish(client, None)
+
+    def finish(self, client, result):
+        client.dnsbl_pending = False
+
+        if not client.active:
+            return
+        elif result:
+            self._server.metrics.increment("pyrcd_dnsbl_listed_total", label=result["zone"])
+            self._server.log.custom("BAN", "{0} is listed in {1}".format(client.ip_address, result["zone"]))
+            client.close_link(result["reason"])
+        else:
+            client.check_authorisation()
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    # Name to look an address up under: "4.3.2.1" for 1.2.3.4, reversed nibbles for IPv6. None for anything
+    # that isn't an IP address (e.g. Unix domain peers)
+    @staticmethod
+    def reverse(ip_address):
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None
+
+        if address.version == 4:
+            return ".".join(reversed(ip_address.split(".")))
+
+        return ".".join(reversed(address.exploded.replace(":", "")))
+
+    # DNS query for the A records of name, with recursion desired
+    @staticmethod
+    def question(identifier, name):
+        labels = b"".join(bytes([len(label)]) + label.encode("ascii") for label in name.strip(".").split("."))
+        return struct.pack("!HHHHHH", identifier, 0x0100, 1, 0, 0, 0) + labels + b"\0" + struct.pack("!HH", 1, 1)
+
+    # (identifier, response code, A record addresses, lowest TTL, question section) from a DNS response
+    @staticmethod
+    def answer(data):
+        try:
+            identifier, flags, questions, answers = struct.unpack("!HHHH", data[:8])
+            position = 12
+
+            for _ in range(questions):
+                position = Dnsbl.skip_name(data, position) + 4
+
+            question = data[12:position]
+
+            addresses = []
+            ttl = None
+
+            for _ in range(answers):
+                position = Dnsbl.skip_name(data, position)
+                record_type, record_class, record_ttl, length = struct.unpack("!HHIH", data[position:position + 10])
+                position += 10
+
+                if record_type == 1 and length == 4:
+                    addresses.append(socket.inet_ntoa(data[position:position + 4]))
+                    ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+
+                position += length
+        except (struct.error, IndexError) as error:
+            raise Dnsbl.DnsblError("Malformed DNS response: " + str(error))
+
+        if not flags & 0x8000:
+            raise Dnsbl.DnsblError("Not a DNS response")
+
+        return identifier, flags & 0xF, addresses, ttl or 0, question
+
+    # Whether a datagram's source is the (address, port) it was sent to, however the address is written
+    @staticmethod
+    def same_address(source, destination):
+        try:
+            return source[1] == destination[1] and ipaddress.ip_address(source[0]) == ipaddress.ip_address(destination[0])
+        except ValueError:
+            return False
+
+    # Position just past the (possibly compressed) name starting at position
+    @staticmethod
+    def skip_name(data, position):
+        while True:
+            length = data[position]
+
+            if length & 0xC0 == 0xC0:
+                return position + 2
+            elif length == 0:
+                return position + 1
+
+            position += length + 1
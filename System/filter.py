@@ -0,0 +1,180 @@
+import collections
+import re
+
+
+class Automaton(object):
+    # Aho-Corasick automaton over lower-cased literals: one pass over a message finds any of them, however
+    # many there are. Each node is a transition dict, a failure link and the first pattern ending there
+    def __init__(self, literals):
+        self.transitions = [{}]
+        self.failures = [0]
+        self.outputs = [None]
+
+        for literal, index in literals:
+            node = 0
+
+            for character in literal:
+                following = self.transitions[node].get(character, None)
+
+                if following is None:
+                    following = len(self.transitions)
+                    self.transitions.append({})
+                    self.failures.append(0)
+                    self.outputs.append(None)
+                    self.transitions[node][character] = following
+
+                node = following
+
+            if self.outputs[node] is None:
+                self.outputs[node] = index
+
+        # Breadth first, so a node's failure link always points at a node that's already finished
+        queue = collections.deque(self.transitions[0].values())
+
+        while len(queue):
+            node = queue.popleft()
+
+            for character, following in self.transitions[node].items():
+                failure = self.failures[node]
+
+                while failure and character not in self.transitions[failure]:
+                    failure = self.failures[failure]
+
+                self.failures[following] = self.transitions[failure].get(character, 0)
+
+                # A pattern that is a suffix of this one also matches here
+                if self.outputs[following] is None:
+                    self.outputs[following] = self.outputs[self.failures[following]]
+
+                queue.append(following)
+
+    # Index of the first literal found in text (already lower-cased), or None
+    def search(self, text):
+        transitions = self.transitions
+        failures = self.failures
+        outputs = self.outputs
+        node = 0
+
+        for character in text:
+            while node and character not in transitions[node]:
+                node = failures[node]
+
+            node = transitions[node].get(character, 0)
+
+            if outputs[node] is not None:
+                return outputs[node]
+
+        return None
+
+
+class Filter(object):
+    class FilterError(Exception):
+        pass
+
+    # "block" tells the sender their message was blocked, "silent" drops it without a word
+    actions = ["block", "silent"]
+
+    def __init__(self):
+        # Everything match() reads, replaced as a whole by load() so a rehash never leaves it half built
+        self.compiled = ([], None, None, [])
+
+        # Hits per (pattern, regex), kept across reloads for patterns that are still configured
+        self.hits = {}
+
+    # Compile the [filters] entries, raises FilterError (keeping the current patterns) if any are invalid
+    def load(self, entries):
+        patterns = []
+        literals = []
+        expressions = []
+        separate = []
+
+        for index, entry in enumerate(entries):
+            pattern = entry.get("pattern", "")
+            action = entry.get("action", "block")
+            regex = bool(entry.get("regex", False))
+
+            if not len(pattern):
+                raise self.FilterError("Filter {0} has no pattern".format(index + 1))
+            elif action not in Filter.actions:
+                raise self.FilterError("Filter '{0}' has an unknown action '{1}'".format(pattern, action))
+
+            if regex:
+                try:
+                    compiled = re.compile(pattern, re.IGNORECASE)
+                except re.error as error:
+                    raise self.FilterError("Filter '{0}' is not a valid regular expression: {1}".format(pattern, error))
+
+                # Group numbers and names change inside the combined expression, and global flags such as
+                # "(?i)" are only allowed at its very start, so patterns like that are matched on their own
+                fragment = "(?P<p{0}>{1})".format(index, pattern)
+
+                if len(compiled.groupindex) or Filter.references(pattern) or not Filter.nestable(fragment):
+                    separate.append((index, compiled))
+                else:
+                    expressions.append(fragment)
+            else:
+                literals.append((pattern.lower(), index))
+
+            patterns.append({
+                "pattern": pattern,
+                "regex": regex,
+                "action": action,
+                "reason": entry.get("reason", "Message blocked by a server filter")
+            })
+
+        # Every other regular expression goes into one alternation, the named group that matched tells them apart
+        try:
+            expression = re.compile("|".join(expressions), re.IGNORECASE) if len(expressions) else None
+        except re.error as error:
+            raise self.FilterError("Filters could not be combined: " + str(error))
+
+        self.compiled = (patterns, Automaton(literals) if len(literals) else None, expression, separate)
+        self.hits = {key: self.hits.get(key, 0) for key in [(pattern["pattern"], pattern["regex"]) for pattern in patterns]}
+
+    # Whether a pattern still compiles once it's wrapped in a group for the combined expression
+    @staticmethod
+    def nestable(fragment):
+        try:
+            re.compile(fragment, re.IGNORECASE)
+        except re.error:
+            return False
+
+        return True
+
+    # Whether a regular expression refers back to one of its groups: "\1", "(?P=name)" or "(?(1)...)"
+    @staticmethod
+    def references(pattern):
+        # Escapes are taken in pairs from the left, so "\\1" is a literal backslash followed by "1"
+        if any(escape.group(1) in "123456789" for escape in re.finditer(r"\\(.)", pattern)):
+            return True
+
+        return "(?P=" in pattern or "(?(" in pattern
+
+    # The pattern entry text matches (counting the hit), or None
+    def match(self, text):
+        patterns, automaton, expression, separate = self.compiled
+        index = None
+
+        if automaton is not None:
+            index = automaton.search(text.lower())
+
+        if index is None and expression is not None:
+            found = expression.search(text)
+
+            if found is not None:
+                index = int(found.lastgroup[1:])
+
+        if index is None:
+            index = next((position for position, compiled in separate if compiled.search(text) is not None), None)
+
+        if index is None:
+            return None
+
+        pattern = patterns[index]
+        self.hits[(pattern["pattern"], pattern["regex"])] += 1
+
+        return pattern
+
+    # (pattern entry, hits) for each configured pattern
+    def statistics(self):
+        return [(pattern, self.hits.get((pattern["pattern"], pattern["regex"]), 0)) for pattern in self.compiled[0]]
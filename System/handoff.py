@@ -0,0 +1,125 @@
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+
+
+class Handoff(object):
+    class HandoffError(Exception):
+        pass
+
+    # SCM_RIGHTS messages are capped by the kernel (SCM_MAX_FD is 253 on Linux)
+    batch = 200
+    timeout = 10
+
+    # Header sent ahead of the state: JSON length, number of file descriptors
+    header = struct.Struct("!II")
+
+    @staticmethod
+    def supported():
+        return hasattr(socket, "AF_UNIX") and hasattr(socket, "send_fds")
+
+    # Old process: start a replacement and pass it the sockets + state, returns once it has taken over
+    @staticmethod
+    def send(state, handles):
+        if not Handoff.supported():
+            raise Handoff.HandoffError("Socket handoff requires a Unix platform with SCM_RIGHTS support")
+
+        path = os.path.join(tempfile.gettempdir(), "pyrcd-handoff-{0}.sock".format(os.getpid()))
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection = None
+        process = None
+
+        try:
+            if os.path.exists(path):
+                os.unlink(path)
+
+            listener.bind(path)
+            listener.listen(1)
+            listener.settimeout(Handoff.timeout)
+
+            process = subprocess.Popen([sys.executable, os.path.realpath(sys.argv[0]), "--handoff", path])
+
+            connection = listener.accept()[0]
+            connection.settimeout(Handoff.timeout)
+
+            payload = json.dumps(state, separators=(",", ":")).encode("utf-8")
+            fds = [handle.fileno() for handle in handles]
+
+            connection.sendall(Handoff.header.pack(len(payload), len(fds)) + payload)
+
+            for offset in range(0, len(fds), Handoff.batch):
+                socket.send_fds(connection, [b"F"], fds[offset:offset + Handoff.batch])
+
+            # Wait for the new process to confirm it owns everything
+            if Handoff.receive_exactly(connection, 2) != b"OK":
+                raise Handoff.HandoffError("Replacement process did not acknowledge the handoff")
+
+            return process.pid
+        except (OSError, socket.timeout, Handoff.HandoffError) as error:
+            # Never leave a half-started replacement competing for the sockets
+            if process is not None:
+                process.kill()
+
+            raise Handoff.HandoffError("Handoff failed: " + str(error))
+        finally:
+            if connection is not None:
+                connection.close()
+
+            listener.close()
+
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    # New process: collect the state and sockets from the old process
+    @staticmethod
+    def receive(path):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(Handoff.timeout)
+
+        try:
+            connection.connect(path)
+
+            length, count = Handoff.header.unpack(Handoff.receive_exactly(connection, Handoff.header.size))
+            state = json.loads(Handoff.receive_exactly(connection, length).decode("utf-8"))
+            fds = []
+
+            while len(fds) < count:
+                data, received, flags, address = socket.recv_fds(connection, 1, min(Handoff.batch, count - len(fds)))
+
+                if not data:
+                    raise Handoff.HandoffError("Old process hung up after {0} of {1} sockets".format(len(fds), count))
+
+                fds.extend(received)
+
+            return state, [socket.socket(fileno=fd) for fd in fds], connection
+        except (OSError, ValueError, socket.timeout) as error:
+            connection.close()
+            raise Handoff.HandoffError("Could not take over from the old process: " + str(error))
+
+    # New process: tell the old process it can exit
+    @staticmethod
+    def acknowledge(connection):
+        try:
+            connection.sendall(b"OK")
+        finally:
+            connection.close()
+
+    @staticmethod
+    def receive_exactly(connection, length):
+        buffer = b""
+
+        while len(buffer) < length:
+            data = connection.recv(length - len(buffer))
+
+            if not data:
+                raise Handoff.HandoffError("Handoff connection closed early")
+
+            buffer += data
+
+        return buffer
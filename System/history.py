@@ -0,0 +1,145 @@
+import bisect
+import collections
+import itertools
+import os
+import time
+from System.capability import *
+
+
+class History(object):
+    class HistoryError(Exception):
+        pass
+
+    # Defaults for the optional [history] section: lines kept per channel, bytes kept across all channels and
+    # most lines a CHATHISTORY request may ask for
+    lines = 1000
+    memory = 16777216
+    limit = 100
+
+    # Rough per-record cost of the tuple, deque slot and msgid index entry on top of the line itself
+    overhead = 200
+
+    def __init__(self, server):
+        self._server = server
+
+        # Folded channel name -> buffer, least recently written first so the memory cap trims idle channels
+        self.buffers = collections.OrderedDict()
+        self.size = 0
+
+        # msgids are unique per process start, a counter keeps them short
+        self.prefix = "{0:x}{1}".format(int(time.time()), os.urandom(3).hex())
+        self.counter = itertools.count(1)
+
+    @staticmethod
+    def buffer():
+        return {"records": collections.deque(), "times": collections.deque(), "msgids": {}, "sequence": 0}
+
+    def setting(self, key, default):
+        return (self._server.config.history or {}).get(key, default)
+
+    def msgid(self):
+        return "{0}-{1:x}".format(self.prefix, next(self.counter))
+
+    # Keep a relayed line, encoded once without any tags. Records are (sequence, msgid, time, encoded line) and
+    # the sequence number turns a msgid into a deque position without searching. Their times in whole
+    # milliseconds are kept alongside for bisecting timestamp references
+    def record(self, target, msgid, now, line):
+        buffer = self.buffers.get(target.lower(), None)
+
+        if buffer is None:
+            buffer = self.buffers[target.lower()] = History.buffer()
+        else:
+            self.buffers.move_to_end(target.lower())
+
+        encoded = (line + "\r\n").encode("utf-8", "replace")
+        buffer["sequence"] += 1
+        buffer["records"].append((buffer["sequence"], msgid, now, encoded))
+        buffer["times"].append(int(now * 1000))
+        buffer["msgids"][msgid] = buffer["sequence"]
+        self.size += len(encoded) + History.overhead
+
+        while len(buffer["records"]) > self.setting("lines", History.lines):
+            self.trim(buffer)
+
+        # Over the global cap, take the oldest lines of the channels that have been quiet longest
+        memory = self.setting("memory", History.memory)
+
+        while self.size > memory and len(self.buffers):
+            name, oldest = next(iter(self.buffers.items()))
+            self.trim(oldest)
+
+            if not len(oldest["records"]):
+                del self.buffers[name]
+
+    def trim(self, buffer):
+        record = buffer["records"].popleft()
+        buffer["times"].popleft()
+        del buffer["msgids"][record[1]]
+        self.size -= len(record[3]) + History.overhead
+
+    def drop(self, target):
+        buffer = self.buffers.pop(target.lower(), None)
+
+        if buffer is not None:
+            self.size -= sum(len(record[3]) + History.overhead for record in buffer["records"])
+
+    # Deque positions bounding a "msgid=..." or "timestamp=..." reference: lines before it end at the first,
+    # lines after it start at the second. None if the reference is malformed, a msgid that is no longer
+    # (or never was) in the buffer leaves nothing on either side
+    def bounds(self, buffer, reference):
+        kind, _, value = reference.partition("=")
+        records = buffer["records"]
+
+        if kind == "msgid" and len(value):
+            sequence = buffer["msgids"].get(value, None)
+
+            if sequence is None:
+                return 0, len(records)
+
+            return sequence - records[0][0], sequence - records[0][0] + 1
+        elif kind == "timestamp":
+            try:
+                when = Capability.parse_timestamp(value)
+            except ValueError:
+                return None
+
+            # Compared in whole milliseconds, as precise as the server-time tags clients saw
+            return bisect.bisect_left(buffer["times"], when), bisect.bisect_right(buffer["times"], when)
+
+        return None
+
+    # Records answering a CHATHISTORY LATEST, BEFORE or AFTER query, oldest first, or None if the reference is
+    # malformed. The reference line itself is never included
+    def query(self, target, subcommand, reference, limit):
+        buffer = self.buffers.get(target.lower(), History.buffer())
+        records = buffer["records"]
+
+        if subcommand == "LATEST" and reference == "*":
+            return list(itertools.islice(records, max(len(records) - limit, 0), len(records)))
+
+        bounds = self.bounds(buffer, reference)
+
+        if bounds is None:
+            return None
+
+        before, after = bounds
+
+        if subcommand == "BEFORE":
+            start, end = max(before - limit, 0), before
+        elif subcommand == "AFTER":
+            start, end = after, min(after + limit, len(records))
+        else:
+            start, end = max(after, len(records) - limit), len(records)
+
+        return list(itertools.islice(records, start, end))
+
+    def export_state(self):
+        return [
+            [name, [[record[1], record[2], record[3].decode("utf-8")] for record in buffer["records"]]]
+            for name, buffer in self.buffers.items()
+        ]
+
+    def import_state(self, state):
+        for name, records in state:
+            for msgid, now, line in records:
+                self.record(name, msgid, now, line[:-2])
@@ -1,6 +1,7 @@
 class IRC(object):
     client_modes = {
         "i": 0,
+        "o": 0,
         "w": 0,
         "x": 0
     }
@@ -10,9 +11,24 @@ class IRC(object):
         "a": 1,
         "o": 1,
         "h": 1,
-        "v": 1
+        "v": 1,
+        "b": 1,
+        "e": 1,
+        "i": 0,
+        "k": 1,
+        "l": 1,
+        "m": 0,
+        "n": 0,
+        "t": 0,
+        "P": 0
     }
 
+    # Channel modes that take a parameter when set but not when unset
+    channel_set_only_modes = ["l"]
+
+    # Channel modes holding a list of masks rather than a single value
+    channel_list_modes = ["b", "e"]
+
     channel_power_symbols = ["q", "a", "o", "h", "v"]
 
     channel_powers = {
@@ -23,6 +39,50 @@ class IRC(object):
         "v": "+"
     }
 
+    channel_symbols = {
+        "~": "q",
+        "&": "a",
+        "@": "o",
+        "%": "h",
+        "+": "v"
+    }
+
+    # Split items into runs that fit on one reply line when joined together
+    @staticmethod
+    def chunk(items, length=400):
+        chunk = []
+        size = 0
+
+        for item in items:
+            if len(chunk) and size + len(item) + 1 > length:
+                yield chunk
+                chunk = []
+                size = 0
+
+            chunk.append(item)
+            size += len(item) + 1
+
+        if len(chunk):
+            yield chunk
+
+    # Split a raw line into its prefix, command and parameters (the trailing parameter included)
+    @staticmethod
+    def parse_line(line):
+        prefix = None
+
+        if line.startswith(":"):
+            prefix, _, line = line[1:].partition(" ")
+
+        if " :" in line:
+            line, _, trailing = line.partition(" :")
+            parameters = line.split() + [trailing]
+        else:
+            parameters = line.split()
+
+        command = parameters.pop(0).upper() if len(parameters) else ""
+
+        return prefix, command, parameters
+
     @staticmethod
     def nick_valid(nick):
         characters = "abcdefghijklmonpqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890-_\\[]{}^`"
@@ -43,7 +103,7 @@ class IRC(object):
         return "+" + ("".join(modes))
 
     @staticmethod
-    def mode_deconstruct(valid_modes, mode_string, arguments):
+    def mode_deconstruct(valid_modes, mode_string, arguments, set_only=()):
         mode = None
         output = []
         count = 0
@@ -56,7 +116,7 @@ class IRC(object):
                 mode = char
 
             if char in valid_modes.keys():
-                if valid_modes[char] > 0:
+                if valid_modes[char] > 0 and not (mode == "-" and char in set_only):
                     for parameter in range(valid_modes[char]):
                         if len(arguments) >= count + 1:
                             output.append({
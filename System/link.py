@@ -0,0 +1,972 @@
+import errno
+import hmac
+import itertools
+import os
+import selectors
+import socket
+import time
+
+from System.client import *
+from System.channel import *
+from System.irc import *
+from System.bans import *
+
+
+class RemoteClient(Client):
+    # A user on another server: state only, it has no socket and never receives lines from us directly
+    def __init__(self, server, link, origin, uid, nick, nick_time, user, hostname, masked_hostname, modes, connected, name):
+        self._server = server
+        self._handle = None
+        self.lock = None
+
+        self.active = True
+        self.connected = connected
+        self.last_cmd = connected
+        self.authorised = True
+        self.quit_reason = None
+
+        self.nick = nick
+        self.nick_time = nick_time
+        self.user = user
+        self.name = name
+        self.modes = modes
+        self.oper = None
+
+        self.channels = []
+        self.channel_modes = {}
+
+        # Where the user lives and which direct link reaches them
+        self.link = link
+        self.origin = origin
+        self.uid = uid
+
+        self.index = uid
+        self.ip_address = hostname
+        self.port = 0
+        self.hostname = hostname
+        self.masked_hostname = masked_hostname
+        self.secure = False
+
+        # Capabilities are negotiated with local clients only, and tags aren't carried between servers
+        self.caps = 0
+        self.tags = {}
+
+        # Services account, set by an ACCOUNT line after the UID
+        self.account = None
+
+    # Remote servers build their own lines from the propagated events
+    def write(self, buffer):
+        return True
+
+    def terminate(self):
+        self._server.links.remove_client(self)
+
+
+class Link(object):
+    # A direct connection to another server. The socket is non-blocking, outgoing links start out connecting
+    def __init__(self, links, handle, address, entry=None, connecting=False):
+        self._links = links
+        self._handle = handle
+        self._handle.setblocking(False)
+
+        self.address = address
+        self.entry = entry
+        self.name = None
+        self.description = ""
+        self.password = None
+        self.registered = False
+        self.active = True
+
+        self.buffer = b""
+        self.last_data = time.time()
+        self.ping_sent = 0
+
+        # Output waiting for the socket to become writable (or for the connection to be made), and the
+        # selector events currently registered for it
+        self.send_queue = bytearray()
+        self.connecting = connecting
+        self.events = selectors.EVENT_READ | selectors.EVENT_WRITE if connecting else selectors.EVENT_READ
+
+    def send(self, line):
+        if not self.active:
+            return False
+
+        self.send_queue += (line + "\r\n").encode("utf-8")
+
+        # A peer that stops reading would otherwise grow the queue without bound
+        if len(self.send_queue) > self._links.config.get("sendq", Links.sendq):
+            self._links.drop(self, "SendQ exceeded")
+            return False
+
+        return self.connecting or self.flush()
+
+    # Write as much of the queue as the socket takes, polling for writability while anything is left
+    def flush(self):
+        try:
+            if len(self.send_queue):
+                del self.send_queue[:self._handle.send(self.send_queue)]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as error:
+            self._links.drop(self, "Write error: " + str(error))
+            return False
+
+        self.watch(selectors.EVENT_READ | selectors.EVENT_WRITE if len(self.send_queue) else selectors.EVENT_READ)
+        return True
+
+    def watch(self, events):
+        if events != self.events and self.active:
+            self.events = events
+            self._links._server.selector.modify(self._handle, events, self)
+
+    # Writable socket: an outgoing connection has been made (or failed), or there's room for queued output
+    def write_ready(self):
+        if self.connecting:
+            error = self._handle.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+            if error:
+                self._links.drop(self, "Could not connect: " + os.strerror(error))
+                return
+
+            self.connecting = False
+            self.last_data = time.time()
+            self._links._server.log.custom("LINK", "Connected to {0}".format(self.entry["name"]))
+
+        self.flush()
+
+    def read(self):
+        if not self.active:
+            return
+
+        try:
+            data = self._handle.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as error:
+            data = None
+            self._links.drop(self, "Read error: " + str(error))
+
+        if not data:
+            self._links.drop(self, "Connection closed")
+            return
+
+        self.last_data = time.time()
+        self.buffer += data
+
+        # Keep any partial line until the rest of it arrives
+        *lines, self.buffer = self.buffer.split(b"\n")
+
+        for line in lines:
+            line = line.rstrip(b"\r").decode("utf-8", "replace")
+
+            if len(line) and self.active:
+                self._links.handle(self, line)
+
+    def close(self):
+        self.active = False
+
+        try:
+            self._handle.shutdown(socket.SHUT_RDWR)
+            self._handle.close()
+        except OSError:
+            pass
+
+
+class Links(object):
+    class LinkError(Exception):
+        pass
+
+    # Seconds between autoconnect attempts, and link connect/keepalive/timeout thresholds
+    retry_interval = 30
+    connect_timeout = 10
+    ping_interval = 60
+    ping_timeout = 120
+
+    # Default cap on unsent output before a link is dropped (overridden by [links] "sendq")
+    sendq = 16777216
+
+    # Members per SJOIN line during a burst
+    burst_members = 20
+
+    def __init__(self, server):
+        self._server = server
+        self._handle = None
+
+        # Direct links and every server known through them (name -> details)
+        self.links = []
+        self.servers = {}
+
+        self.attempts = {}
+        self.uids = itertools.count(1)
+
+    @property
+    def name(self):
+        return self._server.config.server["fqdn"]
+
+    @property
+    def config(self):
+        return self._server.config.links if self._server.config.links is not None else {}
+
+    def entry(self, name):
+        for entry in self.config.get("servers", []):
+            if entry["name"] == name:
+                return entry
+
+        return None
+
+    # Description of a server for WHOIS replies
+    def description(self, name):
+        if name in self.servers:
+            return self.servers[name]["description"]
+
+        return self._server.config.server["name"]
+
+    # Network-unique identifier for one of our own clients
+    def next_uid(self):
+        return "{0}/{1}".format(self.name, next(self.uids))
+
+    # Optional listener for incoming server links
+    def listen(self):
+        listen = self.config.get("listen", None)
+
+        if listen is None:
+            return
+
+        try:
+            self._handle = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._handle.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._handle.bind((listen["address"], listen["port"]))
+            self._handle.listen(10)
+        except socket.error as error:
+            raise self.LinkError("Failed to bind link socket: " + str(error))
+
+        self._server.watch(self._handle, self)
+        self._server.log.info("Listening for server links on {0}:{1}".format(listen["address"], listen["port"]))
+
+    # Readable link listener
+    def accept(self):
+        try:
+            handle, address = self._handle.accept()
+        except OSError:
+            return
+
+        self.add(Link(self, handle, address))
+        self._server.log.custom("LINK", "Incoming link from {0}:{1}".format(address[0], address[1]))
+
+    def add(self, link):
+        self.links.append(link)
+        self._server.watch(link._handle, link, link.events)
+
+    # Outgoing link to a configured server. The connect doesn't block, the handshake is queued until the
+    # socket turns writable (see Link.write_ready) and check() gives up on it after connect_timeout
+    def connect(self, entry):
+        self.attempts[entry["name"]] = time.time()
+        handle = None
+
+        try:
+            family, kind, protocol, _, address = socket.getaddrinfo(entry["address"], entry["port"], type=socket.SOCK_STREAM)[0]
+            handle = socket.socket(family, kind, protocol)
+            handle.setblocking(False)
+            error = handle.connect_ex(address)
+        except OSError as error:
+            if handle is not None:
+                handle.close()
+
+            raise self.LinkError("Could not link to {0}: {1}".format(entry["name"], error))
+
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)):
+            handle.close()
+            raise self.LinkError("Could not link to {0}: {1}".format(entry["name"], os.strerror(error)))
+
+        link = Link(self, handle, (entry["address"], entry["port"]), entry, True)
+        self.add(link)
+        self.send_handshake(link)
+        self._server.log.custom("LINK", "Connecting to {0} ({1}:{2})".format(entry["name"], entry["address"], entry["port"]))
+
+    # Close every link and the link listener
+    def terminate(self, reason):
+        for link in list(self.links):
+            link.send("ERROR :" + reason)
+            self.drop(link, reason)
+
+        if self._handle is not None:
+            self._server.unwatch(self._handle)
+            self._handle.close()
+            self._handle = None
+
+    def send_handshake(self, link):
+        link.send("PASS " + link.entry["password"])
+        link.send("SERVER {0} 1 :{1}".format(self.name, self._server.config.server["name"]))
+
+    # Once a second: autoconnects, keepalives and dead link detection
+    def check(self):
+        now = time.time()
+
+        for entry in self.config.get("servers", []):
+            if entry.get("autoconnect", False) and entry["name"] not in self.servers:
+                connecting = [link for link in self.links if link.entry is not None and link.entry["name"] == entry["name"]]
+
+                if not len(connecting) and now - self.attempts.get(entry["name"], 0) >= self.retry_interval:
+                    try:
+                        self.connect(entry)
+                    except Links.LinkError as error:
+                        self._server.log.warning(str(error))
+
+        for link in list(self.links):
+            if link.connecting and now - link.last_data >= self.connect_timeout:
+                self.drop(link, "Connection timed out")
+            elif now - link.last_data >= self.ping_timeout:
+                self.drop(link, "Ping timeout")
+            elif now - link.last_data >= self.ping_interval and now - link.ping_sent >= self.ping_interval:
+                link.ping_sent = now
+                link.send(":{0} PING :{0}".format(self.name))
+
+    # Tear down a direct link and everything behind it
+    def drop(self, link, reason):
+        if not link.active:
+            return
+
+        self._server.unwatch(link._handle)
+        link.close()
+        self.links.remove(link)
+
+        if link.registered:
+            self.remove_server(link.name, "{0} {1}".format(self.name, link.name), None)
+            self.propagate(":{0} SQUIT {1} :{2}".format(self.name, link.name, reason), None)
+
+        self._server.log.custom("LINK", "Link to {0} closed ({1})".format(link.name or link.address[0], reason))
+
+        if link.registered:
+            self._server.notice_operators("Link to {0} closed ({1})".format(link.name, reason))
+
+    # Forget a server plus everything introduced through it, their users quit with a netsplit reason
+    def remove_server(self, name, reason, from_link):
+        removed = {name}
+        changed = True
+
+        while changed:
+            changed = False
+
+            for server_name, details in list(self.servers.items()):
+                if server_name not in removed and details["uplink"] in removed:
+                    removed.add(server_name)
+                    changed = True
+
+        for server_name in removed:
+            self.servers.pop(server_name, None)
+
+        departing = [client for client in self._server.remote_clients.values() if client.origin in removed]
+        witnesses = set()
+
+        for client in departing:
+            witnesses.update(self._server.common_clients(client))
+
+        # Clients that negotiated batch get the quits grouped as one netsplit
+        batch = self._server.start_batch(witnesses, "netsplit", *reason.split(" "))
+
+        for client in departing:
+            client.quit_reason = reason
+            self.remove_client(client, False, tags={"batch": batch})
+
+        self._server.end_batch(witnesses, batch)
+
+    # Send to every registered link except the one the event came from
+    def propagate(self, line, from_link):
+        for link in list(self.links):
+            if link.registered and link is not from_link:
+                link.send(line)
+
+    # ---------------------------------------------------------------------------------------------
+    # Local events going out to the network
+    # ---------------------------------------------------------------------------------------------
+
+    def uid_line(self, client, hops):
+        return ":{0} UID {1} {2} {3} {4:.0f} {5} {6} {7} {8} {9:.0f} :{10}".format(
+            client.origin,
+            client.uid,
+            client.nick,
+            hops,
+            client.nick_time,
+            client.user,
+            client.hostname,
+            client.masked_hostname,
+            IRC.mode_construct(client.modes),
+            client.connected,
+            client.name
+        )
+
+    def sjoin_lines(self, channel, members):
+        modes, arguments = channel.mode_parameters()
+        head = ":{0} SJOIN {1:.0f} {2} {3}{4} :".format(
+            self.name,
+            channel.created,
+            channel.name,
+            modes,
+            "".join(" " + argument for argument in arguments)
+        )
+
+        lines = []
+
+        # An empty (permanent) channel still gets a single line
+        for offset in range(0, max(1, len(members)), self.burst_members):
+            lines.append(head + " ".join(
+                "".join(IRC.channel_powers[power] for power in IRC.channel_power_symbols
+                        if power in member.channel_modes[channel.name]) + member.uid
+                for member in members[offset:offset + self.burst_members]
+            ))
+
+        return lines
+
+    # Ban/exception lists for the burst, batched like SJOIN members
+    def bmask_lines(self, channel):
+        lines = []
+
+        for letter in IRC.channel_list_modes:
+            masks = [entry["mask"] for entry in channel.list_mode(letter)]
+
+            for offset in range(0, len(masks), self.burst_members):
+                lines.append(":{0} BMASK {1:.0f} {2} {3} :{4}".format(
+                    self.name,
+                    channel.created,
+                    channel.name,
+                    letter,
+                    " ".join(masks[offset:offset + self.burst_members])
+                ))
+
+        return lines
+
+    def introduce(self, client):
+        self.propagate(self.uid_line(client, 1), None)
+
+        if client.account is not None:
+            self.account(client)
+
+    def account(self, client, from_link=None):
+        self.propagate(":{0} ACCOUNT {1}".format(client.uid, client.account or "*"), from_link)
+
+    def nick(self, client, from_link=None):
+        self.propagate(":{0} NICK {1} {2:.0f}".format(client.uid, client.nick, client.nick_time), from_link)
+
+    def quit(self, client, reason, from_link=None):
+        self.propagate(":{0} QUIT :{1}".format(client.uid, reason), from_link)
+
+    def join(self, client, channel, from_link=None):
+        for line in self.sjoin_lines(channel, [client]):
+            self.propagate(line, from_link)
+
+    def part(self, client, channel, reason, from_link=None):
+        self.propagate(":{0} PART {1} :{2}".format(client.uid, channel.name, reason), from_link)
+
+    def topic(self, client, channel, from_link=None):
+        self.propagate(":{0} TOPIC {1} :{2}".format(client.uid, channel.name, channel.topic["content"]), from_link)
+
+    def kick(self, client, channel, target, reason, from_link=None):
+        self.propagate(":{0} KICK {1} {2} :{3}".format(client.uid, channel.name, target.uid, reason), from_link)
+
+    # Invites only matter on the target's own server, that's where the JOIN is checked
+    def invite(self, client, target, channel):
+        target.link.send(":{0} INVITE {1} {2}".format(client.uid, target.uid, channel.name))
+
+    def wallops(self, client, text, from_link=None):
+        self.propagate(":{0} WALLOPS :{1}".format(client.uid, text), from_link)
+
+    def gline(self, ban, from_link=None):
+        self.propagate(self.gline_line(ban), from_link)
+
+    def ungline(self, ban, setter, from_link=None):
+        self.propagate(":{0} UNGLINE {1} {2}".format(self.name, ban["mask"], setter), from_link)
+
+    def gline_line(self, ban):
+        return ":{0} GLINE {1} {2:.0f} {3:.0f} {4} :{5}".format(
+            self.name,
+            ban["mask"],
+            ban["expires"] or 0,
+            ban["time"],
+            ban["setter"],
+            ban["reason"]
+        )
+
+    def user_mode(self, client, modes, from_link=None):
+        self.propagate(":{0} MODE {0} {1}".format(client.uid, modes), from_link)
+
+    # Channel mode change, member arguments (e.g. +o nick) are passed as clients and sent as UIDs
+    def channel_mode(self, source, channel, modes, arguments, from_link=None):
+        arguments = [argument.uid if isinstance(argument, Client) else argument for argument in arguments]
+        self.propagate(":{0} MODE {1} {2}{3}".format(
+            source.uid,
+            channel.name,
+            modes,
+            "".join(" " + argument for argument in arguments)
+        ), from_link)
+
+    # Channel messages only travel down links that have members in the channel
+    def channel_message(self, source, channel, command, text, from_link=None):
+        for link in list(channel.links):
+            if link is not from_link:
+                link.send(":{0} {1} {2} :{3}".format(source.uid, command, channel.name, text))
+
+    def private_message(self, source, target, command, text):
+        target.link.send(":{0} {1} {2} :{3}".format(source.uid, command, target.uid, text))
+
+    # Full state dump to a newly registered link
+    def burst(self, link):
+        for name, details in self.servers.items():
+            if details["link"] is not link:
+                link.send(":{0} SERVER {1} {2} :{3}".format(details["uplink"], name, details["hops"] + 1, details["description"]))
+
+        for client in list(self._server.clients.values()):
+            if client.authorised and client.nick is not None:
+                link.send(self.uid_line(client, 1))
+
+                if client.account is not None:
+                    link.send(":{0} ACCOUNT {1}".format(client.uid, client.account))
+
+        for client in self._server.remote_clients.values():
+            if client.link is not link:
+                link.send(self.uid_line(client, 2))
+
+                if client.account is not None:
+                    link.send(":{0} ACCOUNT {1}".format(client.uid, client.account))
+
+        for channel in self._server.channels.values():
+            members = [client for client in channel.clients if client.link is not link]
+
+            if len(members) or "P" in channel.modes:
+                for line in self.sjoin_lines(channel, members):
+                    link.send(line)
+
+                for line in self.bmask_lines(channel):
+                    link.send(line)
+
+                if channel.topic["author"] is not None:
+                    link.send(":{0} TB {1} {2:.0f} {3} :{4}".format(
+                        self.name,
+                        channel.name,
+                        channel.topic["time"],
+                        channel.topic["author"],
+                        channel.topic["content"]
+                    ))
+
+        for ban in self._server.bans.list("G"):
+            link.send(self.gline_line(ban))
+
+        link.send(":{0} EOB".format(self.name))
+
+    # ---------------------------------------------------------------------------------------------
+    # Network events coming in
+    # ---------------------------------------------------------------------------------------------
+
+    def handle(self, link, line):
+        prefix, command, parameters = IRC.parse_line(line)
+        self._server.log.custom("RAW", "[{0}] <- {1}".format(link.name or link.address[0], line))
+
+        if not link.registered and command not in ["PASS", "SERVER", "ERROR"]:
+            self.drop(link, "Not registered")
+            return
+
+        try:
+            method = getattr(self, "s2s_" + command.lower())
+        except AttributeError:
+            return
+
+        try:
+            method(link, prefix, parameters)
+        except (IndexError, ValueError, KeyError) as error:
+            self._server.log.warning("Malformed {0} from {1}: {2} ({3})".format(command, link.name, line, error))
+
+    # Resolve a message prefix to a remote client (UID) coming from the expected direction
+    def source(self, link, prefix):
+        client = self._server.remote_clients.get(prefix, None)
+
+        if client is not None and client.link is link:
+            return client
+
+        return None
+
+    # Decide whether an incoming nick may be used, killing whichever side loses
+    def collide(self, link, uid, nick, nick_time):
+        existing = self._server.get_client(nick)
+
+        if existing is None or existing.uid == uid:
+            return True
+
+        self._server.log.custom("LINK", "Nick collision on {0} ({1} vs {2})".format(nick, existing.uid, uid))
+
+        # Older nick wins, on a tie both go
+        if nick_time <= existing.nick_time:
+            self.kill(existing, "Nick collision")
+
+        if nick_time >= existing.nick_time:
+            link.send(":{0} KILL {1} :Nick collision".format(self.name, uid))
+            return False
+
+        return True
+
+    # Remove a client from the whole network, UIDs make the QUIT unambiguous everywhere it lands
+    def kill(self, client, reason):
+        client.quit_reason = "Killed ({0})".format(reason)
+
+        if client.link is None:
+            client.close_link(client.quit_reason)
+        else:
+            client.link.send(":{0} KILL {1} :{2}".format(self.name, client.uid, reason))
+            self.remove_client(client, True, [client.link])
+
+    # A remote client leaves: tell local channel members, forget them, pass it on
+    def remove_client(self, client, propagate=True, exclude=None, tags=None):
+        if client.uid not in self._server.remote_clients:
+            return
+
+        reason = client.quit_reason or "Connection closed"
+
+        self._server.broadcast_quit(client, reason, tags)
+        self._server.remove_memberships(client)
+        self._server.remote_clients.pop(client.uid, None)
+        self._server.unindex_host(client)
+        self._server.unindex_user(client)
+
+        if self._server.nicks.get(client.nick.lower(), None) is client:
+            self._server.deregister_nick(client.nick)
+
+        if propagate:
+            for link in list(self.links):
+                if link.registered and link not in (exclude or [client.link]):
+                    link.send(":{0} QUIT :{1}".format(client.uid, reason))
+
+    def s2s_pass(self, link, prefix, parameters):
+        link.password = parameters[0]
+
+    def s2s_server(self, link, prefix, parameters):
+        name = parameters[0]
+
+        # Handshake: the peer introduces itself
+        if not link.registered:
+            entry = self.entry(name)
+            password = entry.get("password", "") if entry is not None else ""
+
+            # A server without a password configured can't link at all
+            if not len(password) or link.password is None or not hmac.compare_digest(link.password.encode(), password.encode()):
+                link.send("ERROR :Access denied")
+                self.drop(link, "Access denied for " + name)
+                return
+
+            if name in self.servers or name == self.name:
+                link.send("ERROR :Server {0} already exists".format(name))
+                self.drop(link, "Server {0} already exists".format(name))
+                return
+
+            # Incoming link, answer with our own credentials
+            if link.entry is None:
+                link.entry = entry
+                self.send_handshake(link)
+
+            link.name = name
+            link.description = parameters[-1]
+            link.registered = True
+
+            self.servers[name] = {"link": link, "uplink": self.name, "hops": 1, "description": link.description}
+            self.propagate(":{0} SERVER {1} 2 :{2}".format(self.name, name, link.description), link)
+            self.burst(link)
+
+            self._server.log.custom("LINK", "Linked with {0}".format(name))
+            self._server.notice_operators("Linked with {0}".format(name))
+        # A server further down the link, a name we already know means there's a loop
+        else:
+            if name in self.servers or name == self.name:
+                link.send("ERROR :Server {0} already exists".format(name))
+                self.drop(link, "Loop detected introducing " + name)
+                return
+
+            self.servers[name] = {"link": link, "uplink": prefix, "hops": int(parameters[1]), "description": parameters[-1]}
+            self.propagate(":{0} SERVER {1} {2} :{3}".format(prefix, name, int(parameters[1]) + 1, parameters[-1]), link)
+
+    def s2s_squit(self, link, prefix, parameters):
+        name = parameters[0]
+
+        if name in self.servers and self.servers[name]["link"] is link:
+            self.remove_server(name, "{0} {1}".format(self.servers[name]["uplink"], name), link)
+            self.propagate(":{0} SQUIT {1} :{2}".format(prefix, name, parameters[-1]), link)
+
+    def s2s_error(self, link, prefix, parameters):
+        self.drop(link, "ERROR: " + parameters[-1])
+
+    def s2s_ping(self, link, prefix, parameters):
+        link.send(":{0} PONG :{1}".format(self.name, parameters[-1]))
+
+    def s2s_pong(self, link, prefix, parameters):
+        pass
+
+    def s2s_eob(self, link, prefix, parameters):
+        self._server.log.custom("LINK", "End of burst from {0}".format(prefix))
+
+    # :<server> UID <uid> <nick> <hops> <nick ts> <user> <host> <masked host> <modes> <signon> :<name>
+    def s2s_uid(self, link, prefix, parameters):
+        uid, nick = parameters[0], parameters[1]
+        nick_time = float(parameters[3])
+
+        if uid in self._server.remote_clients or not self.collide(link, uid, nick, nick_time):
+            return
+
+        client = RemoteClient(
+            self._server, link, prefix, uid, nick, nick_time,
+            parameters[4], parameters[5], parameters[6],
+            [mode for mode in parameters[7] if mode != "+"],
+            float(parameters[8]),
+            parameters[-1]
+        )
+
+        self._server.remote_clients[uid] = client
+        self._server.register_nick(nick, client)
+        self._server.index_host(client)
+        self._server.index_user(client)
+
+        parameters[2] = str(int(parameters[2]) + 1)
+        self.propagate(":{0} UID {1} :{2}".format(prefix, " ".join(parameters[:-1]), parameters[-1]), link)
+
+    # :<uid> NICK <new nick> <nick ts>
+    def s2s_nick(self, link, prefix, parameters):
+        client = self.source(link, prefix)
+
+        if client is None:
+            return
+
+        nick_time = float(parameters[1])
+
+        if not self.collide(link, client.uid, parameters[0], nick_time):
+            client.quit_reason = "Nick collision"
+            self.remove_client(client, True, [link])
+            return
+
+        self._server.broadcast_nick(client, parameters[0])
+        self._server.deregister_nick(client.nick)
+        self._server.register_nick(parameters[0], client)
+        self._server.invalidate_verdicts(client)
+
+        client.nick = parameters[0]
+        client.nick_time = nick_time
+        self.nick(client, link)
+
+    # :<uid> QUIT :<reason>
+    def s2s_quit(self, link, prefix, parameters):
+        client = self.source(link, prefix)
+
+        if client is not None:
+            client.quit_reason = parameters[-1]
+            self.remove_client(client, True, [link])
+
+    # :<source> KILL <uid> :<reason>
+    def s2s_kill(self, link, prefix, parameters):
+        target = self._server.get_client_by_uid(parameters[0])
+
+        if target is None or target.link is link:
+            return
+
+        # Our own user, the rest of the network hears about it as a quit
+        if target.link is None:
+            target.quit_reason = "Killed ({0})".format(parameters[-1])
+            target.close_link(target.quit_reason)
+        else:
+            target.link.send(":{0} KILL {1} :{2}".format(prefix, target.uid, parameters[-1]))
+            target.quit_reason = "Killed ({0})".format(parameters[-1])
+            self.remove_client(target, True, [link, target.link])
+
+    # :<server> SJOIN <channel ts> <channel> <modes> [mode arguments] :<prefixed uids>
+    def s2s_sjoin(self, link, prefix, parameters):
+        created = float(parameters[0])
+        name = parameters[1]
+
+        if self._server.channel_exists(name):
+            channel = self._server.channels[name.lower()]
+        else:
+            channel = Channel(self._server, name)
+            channel.created = created
+            self._server.register_channel(channel.name, channel)
+
+        # Older channel wins its creation time, modes are merged
+        channel.created = min(channel.created, created)
+        channel.merge_modes(parameters[2], parameters[3:-1])
+
+        for member in parameters[-1].split():
+            powers = []
+
+            while len(member) and member[0] in IRC.channel_symbols:
+                powers.append(IRC.channel_symbols[member[0]])
+                member = member[1:]
+
+            client = self.source(link, member)
+
+            if client is not None and channel.name not in client.channels:
+                channel.join_remote(client, powers)
+
+        self.propagate(":{0} SJOIN {1}".format(prefix, " ".join(parameters[:-1]) + " :" + parameters[-1]), link)
+
+    # :<server> BMASK <channel ts> <channel> <b|e> :<masks>
+    def s2s_bmask(self, link, prefix, parameters):
+        if not self._server.channel_exists(parameters[1]) or parameters[2] not in IRC.channel_list_modes:
+            return
+
+        channel = self._server.channels[parameters[1].lower()]
+
+        for mask in parameters[-1].split():
+            channel.list_mode(parameters[2]).add(mask, prefix)
+
+        channel.verdicts.clear()
+        channel.save()
+        self.propagate(":{0} BMASK {1}".format(prefix, " ".join(parameters[:-1]) + " :" + parameters[-1]), link)
+
+    # :<uid> PART <channel> :<reason>
+    def s2s_part(self, link, prefix, parameters):
+        client = self.source(link, prefix)
+
+        if client is not None and self._server.channel_exists(parameters[0]):
+            channel = self._server.channels[parameters[0].lower()]
+
+            if channel.name in client.channels:
+                channel.remove_client(client, parameters[-1])
+
+                if channel.destroyed:
+                    self._server.deregister_channel(channel.name)
+
+                self.part(client, channel, parameters[-1], link)
+
+    # :<uid> TOPIC <channel> :<topic>
+    def s2s_topic(self, link, prefix, parameters):
+        client = self.source(link, prefix)
+
+        if client is not None and self._server.channel_exists(parameters[0]):
+            channel = self._server.channels[parameters[0].lower()]
+            channel.set_topic(client, parameters[-1])
+            self.topic(client, channel, link)
+
+    # :<server> TB <channel> <topic ts> <author> :<topic>, the older topic survives a burst
+    def s2s_tb(self, link, prefix, parameters):
+        if not self._server.channel_exists(parameters[0]):
+            return
+
+        channel = self._server.channels[parameters[0].lower()]
+
+        if channel.topic["author"] is None or float(parameters[1]) < channel.topic["time"]:
+            channel.topic = {"content": parameters[-1], "time": float(parameters[1]), "author": parameters[2]}
+            channel.broadcast_inclusive(":{0} TOPIC {1} :{2}".format(parameters[2], channel.name, parameters[-1]))
+            channel.save()
+
+        self.propagate(":{0} TB {1}".format(prefix, " ".join(parameters[:-1]) + " :" + parameters[-1]), link)
+
+    # :<uid> KICK <channel> <target uid> :<reason>
+    def s2s_kick(self, link, prefix, parameters):
+        client = self.source(link, prefix)
+        target = self._server.get_client_by_uid(parameters[1])
+
+        if client is None or target is None or not self._server.channel_exists(parameters[0]):
+            return
+
+        channel = self._server.channels[parameters[0].lower()]
+
+        if channel.name in target.channels:
+            channel.kick(client, target, parameters[-1])
+            self.kick(client, channel, target, parameters[-1], link)
+
+    # :<uid> INVITE <target uid> <channel>, delivered on the target's server and passed along otherwise
+    def s2s_invite(self, link, prefix, parameters):
+        client = self.source(link, prefix)
+        target = self._server.get_client_by_uid(parameters[0])
+
+        if client is None or target is None or not self._server.channel_exists(parameters[1]):
+            return
+
+        if target.link is None:
+            self._server.channels[parameters[1].lower()].invite(target)
+            target.write(client.substitute(":{identifier} INVITE {0} :{1}").format(target.nick, parameters[1]))
+        elif target.link is not link:
+            self.invite(client, target, self._server.channels[parameters[1].lower()])
+
+    # :<uid> ACCOUNT <account|*>
+    def s2s_account(self, link, prefix, parameters):
+        client = self.source(link, prefix)
+
+        if client is None:
+            return
+
+        client.account = parameters[0] if parameters[0] != "*" else None
+        self.account(client, link)
+
+    # :<server> GLINE <mask> <expires, 0 if permanent> <set time> <setter> :<reason>
+    def s2s_gline(self, link, prefix, parameters):
+        expires, when = float(parameters[1]), float(parameters[2])
+        existing = self._server.bans.entries.get(Mask.casefold(Bans.normalise(parameters[0])), None)
+
+        # Both sides burst their G-lines, one that's already known goes no further
+        if existing is not None and existing["kind"] == "G" and int(existing["time"]) == int(when):
+            return
+
+        # Expired while it was on its way here
+        if expires and expires <= time.time():
+            return
+
+        self._server.add_ban("G", parameters[0], parameters[3], parameters[-1], 0, link, when, expires or None)
+
+    # :<server> UNGLINE <mask> <remover>
+    def s2s_ungline(self, link, prefix, parameters):
+        self._server.remove_ban("G", parameters[0], parameters[1], link)
+
+    # :<uid> WALLOPS :<text>
+    def s2s_wallops(self, link, prefix, parameters):
+        client = self.source(link, prefix)
+
+        if client is None:
+            return
+
+        self._server.wallops(client, parameters[-1])
+        self.wallops(client, parameters[-1], link)
+
+    # :<uid> MODE <channel|uid> <modes> [arguments]
+    def s2s_mode(self, link, prefix, parameters):
+        source = self.source(link, prefix)
+
+        if source is None:
+            return
+
+        # User modes
+        if parameters[0] == source.uid:
+            for bunch in IRC.mode_deconstruct(IRC.client_modes, parameters[1], []):
+                if bunch["mode"] == "+" and bunch["type"] not in source.modes:
+                    source.modes.append(bunch["type"])
+                elif bunch["mode"] == "-" and bunch["type"] in source.modes:
+                    source.modes.remove(bunch["type"])
+                else:
+                    continue
+
+                self._server.index_user_mode(source, bunch["type"], bunch["mode"] == "+")
+
+            self.user_mode(source, parameters[1], link)
+        # Channel modes
+        elif self._server.channel_exists(parameters[0]):
+            channel = self._server.channels[parameters[0].lower()]
+            channel.apply_remote_mode(source, parameters[1], parameters[2:])
+            self.propagate(":{0} MODE {1}".format(prefix, " ".join(parameters)), link)
+
+    def s2s_privmsg(self, link, prefix, parameters):
+        self.relay_message(link, prefix, "PRIVMSG", parameters)
+
+    def s2s_notice(self, link, prefix, parameters):
+        self.relay_message(link, prefix, "NOTICE", parameters)
+
+    # :<uid> PRIVMSG|NOTICE <channel|uid> :<text>
+    def relay_message(self, link, prefix, command, parameters):
+        source = self.source(link, prefix)
+
+        if source is None:
+            return
+
+        if parameters[0][0] == "#":
+            if self._server.channel_exists(parameters[0]):
+                self._server.channels[parameters[0].lower()].relay(source, command, parameters[-1], link)
+        else:
+            target = self._server.get_client_by_uid(parameters[0])
+
+            if target is None:
+                return
+            elif target.link is None:
+                self._server.fanout([target], source.substitute(":{identifier} {0} {1} :{2}").format(command, target.nick, parameters[-1]))
+            elif target.link is not link:
+                self.private_message(source, target, command, parameters[-1])
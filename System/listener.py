@@ -0,0 +1,200 @@
+import ipaddress
+import os
+import socket
+import ssl
+import stat
+import time
+
+
+class Listener(object):
+    class ListenerError(Exception):
+        pass
+
+    # Connections that haven't finished their TLS handshake by now are dropped
+    handshake_timeout = 10
+
+    # TLS 1.3 session tickets issued per full handshake (one per reconnect we expect to resume)
+    tickets = 2
+
+    # Default for the per-listener "accept_batch" setting, "backlog" defaults to the kernel's limit
+    accept_batch = 16
+
+    def __init__(self, config, entry, handle=None):
+        # Reset properties
+        self.entry = entry
+        self.address = entry.get("address", None)
+        self.port = entry.get("port", None)
+        self.path = entry.get("path", None)
+        self.backlog = min(entry.get("backlog", Listener.somaxconn()), Listener.somaxconn())
+        self.accept_batch = entry.get("accept_batch", Listener.accept_batch)
+        self.context = None
+        self.tls = entry.get("tls", None)
+        self._handle = None
+
+        if self.path is not None:
+            if not hasattr(socket, "AF_UNIX"):
+                raise self.ListenerError("Unix domain sockets aren't supported on this platform")
+
+            self.family = socket.AF_UNIX
+            self.path = config.resolve(self.path)
+        elif ":" in self.address:
+            self.family = socket.AF_INET6
+        else:
+            self.family = socket.AF_INET
+
+        if self.tls is not None:
+            self.context = self.create_context(config, self.tls)
+
+        # Handed over by a previous process, already bound and listening
+        if handle is not None:
+            self._handle = handle
+            self._handle.setblocking(False)
+            return
+
+        try:
+            self._handle = socket.socket(self.family, socket.SOCK_STREAM)
+
+            if self.family == socket.AF_UNIX:
+                self.remove_stale_socket()
+                self._handle.bind(self.path)
+
+                if "permissions" in entry:
+                    os.chmod(self.path, int(entry["permissions"], 8))
+            else:
+                self._handle.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+                # "::" takes IPv4 connections too unless the listener is marked IPv6 only
+                if self.family == socket.AF_INET6:
+                    self._handle.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1 if entry.get("v6only", False) else 0)
+
+                self._handle.bind((self.address, self.port))
+
+            self._handle.listen(self.backlog)
+            self._handle.setblocking(False)
+        except (OSError, ValueError) as error:
+            if self._handle is not None:
+                self._handle.close()
+
+            raise self.ListenerError("Failed to bind socket {0}: {1}".format(self.describe(), error))
+
+    # The kernel silently truncates larger backlogs to this
+    @staticmethod
+    def somaxconn():
+        try:
+            with open("/proc/sys/net/core/somaxconn") as handle:
+                return int(handle.read())
+        except (OSError, ValueError):
+            return socket.SOMAXCONN
+
+    # A socket file left behind by a crash would make bind() fail, anything that isn't a socket is left alone
+    def remove_stale_socket(self):
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    # One server-side context per listener: the OpenSSL session cache and ticket keys live on it,
+    # so every connection through this listener can resume sessions issued by any other
+    @staticmethod
+    def create_context(config, tls):
+        try:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+            context.options |= ssl.OP_NO_COMPRESSION
+            context.load_cert_chain(config.resolve(tls["certificate"]), config.resolve(tls["key"]))
+            context.num_tickets = tls.get("tickets", Listener.tickets)
+        except (OSError, ssl.SSLError, ValueError) as error:
+            raise Listener.ListenerError("Could not load TLS certificate '{0}': {1}".format(tls["certificate"], error))
+
+        return context
+
+    @property
+    def handle(self):
+        return self._handle
+
+    def describe(self):
+        if self.family == socket.AF_UNIX:
+            location = self.path
+        elif self.family == socket.AF_INET6:
+            location = "[{0}]:{1}".format(self.address, self.port)
+        else:
+            location = "{0}:{1}".format(self.address, self.port)
+
+        return location + (" (TLS)" if self.context is not None else "")
+
+    # Accept up to accept_batch (or limit, if lower) pending connections in one go, returns (handle, (host, port))
+    # pairs. Sockets come back non-blocking, TLS connections come back wrapped but not yet handshaken
+    def accept(self, limit=None):
+        accepted = []
+        limit = self.accept_batch if limit is None else min(limit, self.accept_batch)
+
+        while len(accepted) < limit:
+            try:
+                handle, address = self._handle.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # e.g. ECONNABORTED or EMFILE, leave the rest queued for the next pass
+                break
+
+            handle.setblocking(False)
+
+            # Lines are written whole, don't let Nagle hold them back waiting for more
+            if self.family != socket.AF_UNIX:
+                handle.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            if self.context is not None:
+                handle = self.context.wrap_socket(handle, server_side=True, do_handshake_on_connect=False)
+
+            accepted.append((handle, self.peer(handle, address)))
+
+        return accepted
+
+    # Normalise the peer address to a (host, port) pair clients can be keyed and masked by
+    def peer(self, handle, address):
+        # Unix domain peers have no address, the descriptor keeps the index unique
+        if self.family == socket.AF_UNIX:
+            return "localhost", handle.fileno()
+
+        host, port = address[0], address[1]
+
+        if self.family == socket.AF_INET6:
+            mapped = ipaddress.IPv6Address(host.split("%")[0]).ipv4_mapped
+
+            # Dual-stack listeners see IPv4 clients as ::ffff:a.b.c.d
+            if mapped is not None:
+                host = str(mapped)
+            # A leading ":" would be read as the start of a trailing parameter
+            elif host.startswith(":"):
+                host = "0" + host
+
+        return host, port
+
+    # Advance a non-blocking handshake, True once it's complete; returns the CPU time spent in this step too
+    @staticmethod
+    def handshake(handle):
+        started = time.perf_counter()
+
+        try:
+            handle.do_handshake()
+            return True, time.perf_counter() - started
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return False, time.perf_counter() - started
+
+    # OpenSSL's own session cache counters (hits are resumed sessions)
+    def session_stats(self):
+        if self.context is None:
+            return None
+
+        return self.context.session_stats()
+
+    # Unix socket files are removed unless the socket has been handed to another process
+    def close(self, unlink=True):
+        self._handle.close()
+
+        if unlink and self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
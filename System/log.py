@@ -24,10 +24,15 @@ class Log(object):
         "DISCONNECT": (1, -1, "RED"),
         "LOOKUP": (1, -1, "MAGENTA"),
         "AUTHORISED": (1, -1, "GREEN"),
+        "LINK": (1, -1, "BLUE"),
+        "BAN": (1, -1, "YELLOW"),
 
         # Connection/channel logging
         "JOIN": (2, 4, "RED"),
         "PART": (2, 4, "RED"),
+        "TOPIC": (2, 4, "RED"),
+        "KICK": (2, 4, "RED"),
+        "INVITE": (2, 4, "RED"),
 
         # Stalker logging
         "PRIVMSG": (3, 4, "RED"),
@@ -45,7 +50,7 @@ class Log(object):
     def __init__(self, directory, debug):
         # Reset properties
         self._handle = None
-        self._directory = directory
+        self.directory = directory
         self._name = directory + time.strftime("%Y-%m-%d %H-%M-%S") + ".txt"
         self.debug = debug
 
@@ -59,8 +64,8 @@ class Log(object):
             pass
 
     def open(self):
-        if not os.access(self._directory, os.W_OK):
-            raise Log.LogError("Directory '{0}' is not writable".format(self._directory))
+        if not os.access(self.directory, os.W_OK):
+            raise Log.LogError("Directory '{0}' is not writable".format(self.directory))
 
         try:
             self._handle = open(self._name, "wb", 0)
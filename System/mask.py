@@ -0,0 +1,167 @@
+import functools
+import re
+import time
+
+
+class Mask(object):
+    wildcards = "*?"
+
+    # Folded the same way as nicks, channels and accounts, matching the advertised CASEMAPPING=ascii
+    @staticmethod
+    def casefold(text):
+        return text.lower()
+
+    # A matcher for mask (taking an already folded subject), compiled once and cached. Plain strings,
+    # prefixes and suffixes skip the regular expression engine entirely
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def compile(mask):
+        mask = Mask.casefold(mask)
+        body = mask.strip("*")
+
+        if not any(character in mask for character in Mask.wildcards):
+            return mask.__eq__
+        elif not any(character in body for character in Mask.wildcards):
+            if mask.startswith("*") and mask.endswith("*"):
+                return lambda subject: body in subject
+            elif mask.endswith("*"):
+                return lambda subject: subject.startswith(body)
+            else:
+                return lambda subject: subject.endswith(body)
+
+        pattern = re.compile(re.escape(mask).replace("\\*", ".*").replace("\\?", "."), re.DOTALL)
+        return lambda subject: pattern.fullmatch(subject) is not None
+
+    # Case-insensitive match of a single subject against a mask
+    @staticmethod
+    def match(mask, subject):
+        return Mask.compile(mask)(Mask.casefold(subject))
+
+    # Fill in the missing parts of a ban-style mask: "nick" -> "nick!*@*", "user@host" -> "*!user@host",
+    # "host.name" -> "*!*@host.name"
+    @staticmethod
+    def normalise(mask):
+        if "!" not in mask and "@" not in mask:
+            return mask + "!*@*" if "." not in mask and ":" not in mask else "*!*@" + mask
+        elif "!" not in mask:
+            return "*!" + mask
+        elif "@" not in mask:
+            return mask + "@*"
+
+        return mask
+
+    # The literal text before the first and after the last wildcard
+    @staticmethod
+    def anchors(mask):
+        first = min([mask.index(character) for character in Mask.wildcards if character in mask] or [len(mask)])
+        last = max([mask.rindex(character) for character in Mask.wildcards if character in mask] or [-1])
+
+        return mask[:first], mask[last + 1:]
+
+
+class MaskList(object):
+    # An ordered list of masks (bans, exceptions) indexed by their literal prefix or suffix, whichever is
+    # longer. Looking a subject up costs one dict probe per distinct anchor length rather than one match
+    # per mask, only masks anchored on nothing at all (e.g. "*!*@*") are checked one by one
+    def __init__(self):
+        self.entries = {}
+        self.matchers = {}
+        self.prefixes = {}
+        self.suffixes = {}
+        self.unanchored = set()
+
+        # Anchor length -> number of masks indexed under an anchor that long
+        self.prefix_lengths = {}
+        self.suffix_lengths = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, mask):
+        return Mask.casefold(mask) in self.entries
+
+    # Entries in the order they were added, as {"mask", "setter", "time"} dicts
+    def __iter__(self):
+        return iter(list(self.entries.values()))
+
+    def add(self, mask, setter, when=None):
+        folded = Mask.casefold(mask)
+
+        if folded in self.entries:
+            return False
+
+        self.entries[folded] = {"mask": mask, "setter": setter, "time": when if when is not None else time.time()}
+        self.matchers[folded] = Mask.compile(folded)
+        self.index(folded, True)
+        return True
+
+    def remove(self, mask):
+        folded = Mask.casefold(mask)
+
+        if folded not in self.entries:
+            return False
+
+        del self.entries[folded]
+        del self.matchers[folded]
+        self.index(folded, False)
+        return True
+
+    def index(self, folded, adding):
+        prefix, suffix = Mask.anchors(folded)
+
+        if not len(prefix) and not len(suffix):
+            if adding:
+                self.unanchored.add(folded)
+            else:
+                self.unanchored.discard(folded)
+
+            return
+
+        if len(prefix) >= len(suffix):
+            buckets, lengths, anchor = self.prefixes, self.prefix_lengths, prefix
+        else:
+            buckets, lengths, anchor = self.suffixes, self.suffix_lengths, suffix
+
+        if adding:
+            buckets.setdefault(anchor, set()).add(folded)
+            lengths[len(anchor)] = lengths.get(len(anchor), 0) + 1
+        else:
+            buckets[anchor].discard(folded)
+            lengths[len(anchor)] -= 1
+
+            if not len(buckets[anchor]):
+                del buckets[anchor]
+
+            if not lengths[len(anchor)]:
+                del lengths[len(anchor)]
+
+    # Masks that could match subject, narrowed down by the anchors
+    def candidates(self, subject):
+        found = list(self.unanchored)
+
+        for length in self.prefix_lengths:
+            found.extend(self.prefixes.get(subject[:length], ()))
+
+        for length in self.suffix_lengths:
+            if length <= len(subject):
+                found.extend(self.suffixes.get(subject[len(subject) - length:], ()))
+
+        return found
+
+    # The first entry matching any of subjects (e.g. the same nick!user@ with different hosts), or None
+    def match(self, subjects):
+        for subject in subjects:
+            subject = Mask.casefold(subject)
+
+            for folded in self.candidates(subject):
+                if self.matchers[folded](subject):
+                    return self.entries[folded]
+
+        return None
+
+    def export_state(self):
+        return [[entry["mask"], entry["setter"], entry["time"]] for entry in self.entries.values()]
+
+    def import_state(self, state):
+        for mask, setter, when in state:
+            self.add(mask, setter, when)
@@ -0,0 +1,202 @@
+import bisect
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class Metrics(object):
+    class MetricsError(Exception):
+        pass
+
+    # Histogram bucket upper bounds, "time" is in seconds and "size" is a plain count
+    buckets = {
+        "time": (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+        "size": (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+        "bytes": (0, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+    }
+
+    # Short descriptions for the Prometheus "# HELP" lines
+    descriptions = {
+        "pyrcd_lines_in_total": "Lines received from clients",
+        "pyrcd_lines_out_total": "Lines written to clients",
+        "pyrcd_bytes_in_total": "Bytes received from clients",
+        "pyrcd_bytes_out_total": "Bytes written to clients",
+        "pyrcd_commands_total": "Commands handled, by command",
+        "pyrcd_command_seconds": "Time spent in cmd_* handlers, by command",
+        "pyrcd_broadcast_fanout": "Recipients per channel broadcast",
+        "pyrcd_send_queue_bytes": "Output queued for a client waiting on its socket, sampled once a second",
+        "pyrcd_accept_batch": "Connections accepted per readable listener",
+        "pyrcd_dns_lookup_seconds": "Reverse DNS lookup latency",
+        "pyrcd_dnsbl_lookup_seconds": "Time taken to check an address against every DNSBL zone",
+        "pyrcd_dnsbl_listed_total": "Connections refused for being listed, by zone",
+        "pyrcd_cache_hits_total": "Cache hits, by cache",
+        "pyrcd_cache_misses_total": "Cache misses, by cache",
+        "pyrcd_loop_iteration_seconds": "Time spent processing one event loop iteration",
+        "pyrcd_loop_lag_seconds": "Time an idle selector wait overran its timeout by",
+        "pyrcd_tls_handshakes_total": "Completed TLS handshakes",
+        "pyrcd_tls_resumed_total": "TLS handshakes that resumed a previous session",
+        "pyrcd_tls_handshake_failures_total": "TLS handshakes that failed or timed out",
+        "pyrcd_tls_handshake_seconds": "CPU time spent in do_handshake() per completed TLS handshake"
+    }
+
+    # Prometheus label name used for each labelled metric
+    label_names = {
+        "pyrcd_commands_total": "command",
+        "pyrcd_command_seconds": "command",
+        "pyrcd_cache_hits_total": "cache",
+        "pyrcd_cache_misses_total": "cache",
+        "pyrcd_filter_hits_total": "pattern",
+        "pyrcd_dnsbl_listed_total": "zone"
+    }
+
+    def __init__(self):
+        # Reset properties
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+        self._http = None
+
+    # Add to a counter, optionally under a label (e.g. the command name)
+    def increment(self, name, value=1, label=None):
+        key = (name, label)
+
+        try:
+            self.counters[key] += value
+        except KeyError:
+            self.counters[key] = value
+
+    # Record a single observation in a histogram
+    def observe(self, name, value, kind="time", label=None):
+        key = (name, label)
+
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            histogram = self.histograms[key] = {
+                "kind": kind,
+                "buckets": [0] * (len(self.buckets[kind]) + 1),
+                "sum": 0,
+                "count": 0
+            }
+
+        histogram["buckets"][bisect.bisect_left(self.buckets[kind], value)] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    # Read back a counter value
+    def counter(self, name, label=None):
+        return self.counters.get((name, label), 0)
+
+    # Labelled values of a counter, e.g. per-command totals
+    def labels(self, name):
+        return {label: value for (key, label), value in list(self.counters.items()) if key == name}
+
+    # Combine all collector callbacks into a single dictionary of gauges
+    def gauges(self):
+        output = {}
+
+        for collector in self.collectors:
+            output.update(collector())
+
+        return output
+
+    # Prometheus text exposition format
+    def render(self):
+        output = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                output.append("# HELP {0} {1}".format(name, self.descriptions.get(name, name)))
+                output.append("# TYPE {0} {1}".format(name, kind))
+
+        def label_string(name, label, extra=None):
+            pairs = []
+
+            if label is not None:
+                pairs.append('{0}="{1}"'.format(self.label_names.get(name, "label"), str(label).replace('"', '\\"')))
+
+            if extra is not None:
+                pairs.append(extra)
+
+            return "{" + ",".join(pairs) + "}" if len(pairs) else ""
+
+        for (name, label), value in sorted(list(self.counters.items()), key=lambda item: (item[0][0], str(item[0][1]))):
+            describe(name, "counter")
+            output.append("{0}{1} {2}".format(name, label_string(name, label), value))
+
+        for (name, label), histogram in sorted(list(self.histograms.items()), key=lambda item: (item[0][0], str(item[0][1]))):
+            describe(name, "histogram")
+            cumulative = 0
+
+            for bound, count in zip(self.buckets[histogram["kind"]] + ("+Inf",), list(histogram["buckets"])):
+                cumulative += count
+                output.append("{0}_bucket{1} {2}".format(name, label_string(name, label, 'le="{0}"'.format(bound)), cumulative))
+
+            output.append("{0}_sum{1} {2}".format(name, label_string(name, label), histogram["sum"]))
+            output.append("{0}_count{1} {2}".format(name, label_string(name, label), histogram["count"]))
+
+        for name, value in sorted(self.gauges().items()):
+            describe(name, "gauge")
+            output.append("{0} {1}".format(name, value))
+
+        return "\n".join(output) + "\n"
+
+    # Approximate quantile of a histogram (upper bound of the bucket it falls in)
+    def quantile(self, name, quantile, label=None):
+        histogram = self.histograms.get((name, label), None)
+
+        if histogram is None or histogram["count"] == 0:
+            return 0
+
+        target = histogram["count"] * quantile
+        cumulative = 0
+        bounds = self.buckets[histogram["kind"]]
+
+        for index, count in enumerate(histogram["buckets"]):
+            cumulative += count
+
+            if cumulative >= target:
+                return bounds[index] if index < len(bounds) else bounds[-1]
+
+        return bounds[-1]
+
+    # Serve the Prometheus text endpoint from a daemon thread
+    def serve(self, address, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ["/", "/metrics"]:
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Keep HTTP access logging out of the console
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._http = HTTPServer((address, port), Handler)
+        except OSError as error:
+            raise self.MetricsError("Failed to bind metrics endpoint: " + str(error))
+
+        thread = threading.Thread(target=self._http.serve_forever, args=[])
+        thread.daemon = True
+        thread.start()
+
+    def terminate(self):
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+            self._http = None
@@ -0,0 +1,140 @@
+import json
+import os
+import queue
+import threading
+import time
+
+
+class Persistence(object):
+    class PersistenceError(Exception):
+        pass
+
+    # Compact the journal after this many records even if the interval hasn't passed
+    compact_records = 10000
+
+    def __init__(self, file, log, compact_interval=3600):
+        # Reset properties
+        self.file = file
+        self.journal_file = file + ".journal"
+        self.compact_interval = compact_interval
+        self.channels = {}
+
+        self._log = log
+        self._queue = queue.Queue()
+        self._journal = None
+        self._records = 0
+        self._compacted = time.time()
+
+        # Load whatever the last run left behind, then start appending
+        try:
+            self.load(self.file)
+            self._records = self.load(self.journal_file)
+            self._journal = open(self.journal_file, "a", encoding="utf-8")
+
+            # Fold the journal into the snapshot straight away, this also drops any torn tail
+            if self._records:
+                self.compact()
+        except (IOError, OSError) as error:
+            raise self.PersistenceError("Could not load channel state from '{0}': {1}".format(self.file, error))
+
+        self._thread = threading.Thread(target=self.run, args=[])
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Replay a snapshot or journal file into self.channels, returns the number of records read
+    def load(self, file):
+        count = 0
+
+        if not os.path.exists(file):
+            return count
+
+        with open(file, encoding="utf-8") as handle:
+            for line in handle:
+                # A torn line means the process died mid-write, skip it
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+
+                self.apply(record)
+                count += 1
+
+        return count
+
+    def apply(self, record):
+        if record[0] == "set":
+            self.channels[record[1]["name"].lower()] = record[1]
+        elif record[0] == "del":
+            self.channels.pop(record[1].lower(), None)
+
+    # Channel states recovered at startup
+    def restore(self):
+        return list(self.channels.values())
+
+    # Called from the event loop, records are encoded here so later changes to the channel can't race the writer
+    def record(self, state):
+        self._queue.put(json.dumps(("set", state), separators=(",", ":")))
+
+    def remove(self, name):
+        self._queue.put(json.dumps(("del", name), separators=(",", ":")))
+
+    # Writer thread: batches everything queued into one write + fsync, compacts periodically
+    def run(self):
+        running = True
+
+        while running:
+            batch = []
+
+            try:
+                batch.append(self._queue.get(timeout=1))
+
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                running = False
+
+            try:
+                if len(batch):
+                    for record in batch:
+                        self.apply(json.loads(record))
+                        self._journal.write(record + "\n")
+
+                    self._journal.flush()
+                    os.fsync(self._journal.fileno())
+                    self._records += len(batch)
+
+                if self._records >= self.compact_records or (
+                    self._records and time.time() - self._compacted >= self.compact_interval
+                ):
+                    self.compact()
+            except (IOError, OSError) as error:
+                self._log.warning("Could not write channel state: " + str(error))
+
+        self._journal.close()
+
+    # Rewrite the snapshot from the current state and start a fresh journal
+    def compact(self):
+        temporary = self.file + ".tmp"
+
+        with open(temporary, "w", encoding="utf-8") as handle:
+            for state in self.channels.values():
+                handle.write(json.dumps(("set", state), separators=(",", ":")) + "\n")
+
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        os.replace(temporary, self.file)
+
+        self._journal.close()
+        self._journal = open(self.journal_file, "w", encoding="utf-8")
+        self._records = 0
+        self._compacted = time.time()
+
+    # Flush anything still queued and stop the writer thread
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,126 @@
+import os
+import sys
+import threading
+import time
+
+
+class Profiler(object):
+    class ProfilerError(Exception):
+        pass
+
+    # Sampling defaults, durations are in seconds
+    default_duration = 30
+    max_duration = 300
+    interval = 0.005
+
+    def __init__(self, log):
+        # Reset properties
+        self.active = False
+        self.file = None
+        self.samples = 0
+        self.stacks = {}
+        self.commands = {}
+
+        self._log = log
+
+        # Guards commands, which the server thread adds to while the sampler thread writes them out
+        self._lock = threading.Lock()
+        self._thread = None
+        self._target = None
+        self._deadline = 0
+
+    # Begin a time-bounded sampling run of the given thread in the background
+    def start(self, thread_id, duration=None):
+        if self.active:
+            raise self.ProfilerError("A profile is already running (writing to '{0}')".format(self.file))
+
+        if duration is None:
+            duration = self.default_duration
+
+        duration = max(1, min(int(duration), self.max_duration))
+
+        self.active = True
+        self.samples = 0
+        self.stacks = {}
+        self.commands = {}
+        self.file = self._log.directory + time.strftime("profile %Y-%m-%d %H-%M-%S") + ".folded"
+
+        self._target = thread_id
+        self._deadline = time.time() + duration
+
+        try:
+            self._thread = threading.Thread(target=self.run, args=[])
+            self._thread.daemon = True
+            self._thread.start()
+        except threading.ThreadError as error:
+            self.active = False
+            raise self.ProfilerError("Failed to start profiler thread: " + str(error))
+
+        self._log.info("Profiling server thread for {0} seconds, writing to '{1}'".format(duration, self.file))
+        return duration
+
+    # Cut a running profile short, the sampler writes its output on the way out
+    def stop(self):
+        self._deadline = 0
+
+    # Sampler loop, folds the target thread's stack into "a;b;c" keys
+    def run(self):
+        while time.time() < self._deadline:
+            frame = sys._current_frames().get(self._target, None)
+
+            if frame is not None:
+                stack = []
+
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{0} ({1})".format(code.co_name, os.path.basename(code.co_filename)))
+                    frame = frame.f_back
+
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+
+            time.sleep(self.interval)
+
+        self.write()
+        self.active = False
+
+    # Attribute handler time to a command while a profile is running
+    def record_command(self, command, elapsed):
+        if self.active:
+            with self._lock:
+                try:
+                    totals = self.commands[command]
+                    totals[0] += 1
+                    totals[1] += elapsed
+                    totals[2] = max(totals[2], elapsed)
+                except KeyError:
+                    self.commands[command] = [1, elapsed, elapsed]
+
+    # Collapsed stacks (flamegraph.pl / speedscope input) plus a per-command summary
+    def write(self):
+        with self._lock:
+            commands = [(command, list(totals)) for command, totals in self.commands.items()]
+
+        try:
+            with open(self.file, "w") as handle:
+                for stack, count in sorted(self.stacks.items()):
+                    handle.write("{0} {1}\n".format(stack, count))
+
+            with open(self.file[:-len(".folded")] + ".commands.txt", "w") as handle:
+                handle.write("{0:<12} {1:>10} {2:>14} {3:>14} {4:>14}\n".format(
+                    "command", "calls", "total (ms)", "mean (ms)", "max (ms)"
+                ))
+
+                for command, totals in sorted(commands, key=lambda item: -item[1][1]):
+                    handle.write("{0:<12} {1:>10} {2:>14.3f} {3:>14.3f} {4:>14.3f}\n".format(
+                        command,
+                        totals[0],
+                        totals[1] * 1000,
+                        totals[1] * 1000 / totals[0],
+                        totals[2] * 1000
+                    ))
+
+            self._log.info("Profile finished ({0} samples), written to '{1}'".format(self.samples, self.file))
+        except IOError as error:
+            self._log.warning("Could not write profile '{0}': {1}".format(self.file, error))
@@ -0,0 +1,354 @@
+import base64
+import binascii
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import multiprocessing
+import os
+from System.cache import *
+
+
+class Sasl(object):
+    class SaslError(Exception):
+        pass
+
+    mechanisms = ["PLAIN", "SCRAM-SHA-256"]
+
+    # Defaults for the optional [sasl] section
+    workers = 2
+    queue = 64
+    cache_size = 4096
+    cache_ttl = 300
+
+    # PBKDF2 rounds for new credentials, RFC 7677 asks for at least 4096
+    iterations = 4096
+
+    # AUTHENTICATE payloads arrive base64 encoded in chunks of at most this many characters
+    chunk = 400
+    message_limit = 8192
+
+    def __init__(self, server):
+        self._server = server
+        self._pool = None
+
+        # Finished pool jobs as (callback, future), filled by the pool's callback thread and drained by the
+        # server loop so clients are only ever touched from there
+        self.results = collections.deque()
+        self.jobs = 0
+
+        # Successful PLAIN verifications, keyed by an HMAC of the account, password and credential under a
+        # per-process secret so the cache never holds anything password-equivalent
+        self.secret = os.urandom(32)
+        self.verified = Cache(Sasl.cache_size, Sasl.cache_ttl)
+
+        # Unknown accounts are checked against this so they take as long to fail as known ones
+        self.dummy = Sasl.hash_password(base64.b64encode(os.urandom(18)).decode())
+
+    def setting(self, key, default):
+        return (self._server.config.sasl or {}).get(key, default)
+
+    # Look up the credential for account (case-insensitive) and call callback(name, credential), both None if
+    # there's no such account. Configured accounts answer straight away, the account store may answer later
+    def credential(self, account, callback):
+        for name, credential in self._server.config.accounts.items():
+            if name.lower() == account.lower():
+                callback(name, credential)
+                return
+
+        if self._server.accounts is None:
+            callback(None, None)
+        else:
+            self._server.accounts.account(account, lambda record: callback(*(record or (None, None))))
+
+    # Wrap a continuation of client's exchange, it's dropped if the client left, aborted or started over
+    def resume(self, client, session, function):
+        session["pending"] = True
+
+        def resumed(*arguments):
+            if client.active and client.sasl_session is session:
+                session["pending"] = False
+                function(*arguments)
+
+        return resumed
+
+    # AUTHENTICATE from client, data is a mechanism name to start, "*" to abort or a chunk of the payload
+    def authenticate(self, client, data):
+        session = client.sasl_session
+
+        if client.account is not None:
+            client.num_907_sasl_already()
+        elif data == "*":
+            if session is not None:
+                self.abort(client)
+        elif session is None:
+            if data.upper() not in Sasl.mechanisms:
+                client.num_908_sasl_mechanisms(Sasl.mechanisms)
+                client.num_904_sasl_fail()
+                return
+
+            client.sasl_session = {"mechanism": data.upper(), "buffer": "", "step": 0, "pending": False}
+            client.write("AUTHENTICATE +")
+        # Nothing more is expected while the credentials are being checked
+        elif session["pending"]:
+            return
+        elif len(data) > Sasl.chunk or len(session["buffer"]) + len(data) > Sasl.message_limit:
+            client.sasl_session = None
+            client.num_905_sasl_too_long()
+        else:
+            session["buffer"] += data if data != "+" else ""
+
+            # A full chunk means there's more to come
+            if len(data) == Sasl.chunk:
+                return
+
+            try:
+                message = base64.b64decode(session["buffer"], validate=True).decode("utf-8")
+            except (binascii.Error, UnicodeDecodeError):
+                self.fail(client)
+                return
+
+            session["buffer"] = ""
+            session["step"] += 1
+
+            try:
+                if session["mechanism"] == "PLAIN":
+                    self.plain(client, session, message)
+                else:
+                    self.scram(client, session, message)
+            except Sasl.SaslError as error:
+                self._server.log.warning(str(error))
+                self.fail(client)
+
+    # "authzid\0authcid\0password", authorising as anyone but yourself isn't supported
+    def plain(self, client, session, message):
+        parts = message.split("\0")
+
+        if len(parts) != 3 or (len(parts[0]) and parts[0] != parts[1]):
+            self.fail(client)
+            return
+
+        self.credential(parts[1], self.resume(client, session, lambda name, credential: self.plain_verify(
+            client, session, name, credential, parts[1], parts[2]
+        )))
+
+    def plain_verify(self, client, session, name, credential, account, password):
+        key = hmac.new(self.secret, "\0".join([account.lower(), password, credential or ""]).encode(), "sha256").digest()
+
+        # Reconnect storms hit the cache rather than the pool
+        if name is not None and self.verified.get(key, False):
+            self._server.metrics.increment("pyrcd_cache_hits_total", label="sasl")
+            self.succeed(client, name)
+            return
+
+        self._server.metrics.increment("pyrcd_cache_misses_total", label="sasl")
+
+        def verified(result):
+            if result and name is not None:
+                self.verified.set(key, True, self.setting("cache_ttl", Sasl.cache_ttl))
+                self.succeed(client, name)
+            else:
+                self.fail(client)
+
+        if not self.run(Sasl.verify_plain, [credential or self.dummy, password], self.resume(client, session, verified)):
+            self._server.log.warning("SASL verification queue is full, rejecting {0}".format(client.get_identifier()))
+            self.fail(client)
+
+    # SCRAM-SHA-256 (RFC 5802/7677). The server side only needs the stored keys, so unlike PLAIN
+    # there's no key derivation to offload and each step is answered straight away
+    def scram(self, client, session, message):
+        # client-first-message: "n,,n=<user>,r=<client nonce>"
+        if session["step"] == 1:
+            header, _, bare = message.partition(",")
+            authzid, _, bare = bare.partition(",")
+            attributes = Sasl.attributes(bare)
+
+            if header not in ("n", "y") or len(authzid) or "n" not in attributes or "r" not in attributes:
+                self.fail(client)
+                return
+
+            session["header"] = header + ",,"
+            session["nonce"] = attributes["r"] + base64.b64encode(os.urandom(18)).decode()
+            session["first"] = bare
+
+            self.credential(attributes["n"].replace("=2C", ",").replace("=3D", "="), self.resume(
+                client, session, lambda name, credential: self.scram_challenge(client, session, name, credential)
+            ))
+        # client-final-message: "c=<channel binding>,r=<nonce>,p=<proof>"
+        elif session["step"] == 2:
+            without_proof, _, proof = message.rpartition(",p=")
+            attributes = Sasl.attributes(without_proof)
+            channel_binding = base64.b64encode(session["header"].encode()).decode()
+
+            if attributes.get("c", None) != channel_binding or attributes.get("r", None) != session["nonce"]:
+                self.fail(client)
+                return
+
+            auth_message = ",".join([session["first"], session["server_first"], without_proof]).encode()
+            signature = Sasl.verify_scram(session["keys"][0], session["keys"][1], auth_message, proof)
+
+            if session["account"] is None or signature is None:
+                self.fail(client)
+                return
+
+            self.send(client, "v=" + base64.b64encode(signature).decode())
+        # The client acknowledges the server signature with an empty message
+        else:
+            self.succeed(client, session["account"])
+
+    # server-first-message: "r=<client + server nonce>,s=<salt>,i=<iterations>"
+    def scram_challenge(self, client, session, name, credential):
+        try:
+            iterations, salt, stored_key, server_key = Sasl.parse_credential(credential or self.dummy)
+        except Sasl.SaslError as error:
+            self._server.log.warning(str(error))
+            self.fail(client)
+            return
+
+        session["account"] = name
+        session["keys"] = (stored_key, server_key)
+        session["server_first"] = "r={0},s={1},i={2}".format(session["nonce"], base64.b64encode(salt).decode(), iterations)
+
+        self.send(client, session["server_first"])
+
+    # Run function(*arguments) on the process pool and call callback(result) from the server loop once it's done,
+    # result is None if the job failed. Returns False without queueing anything when too many jobs are waiting
+    def run(self, function, arguments, callback):
+        if self.jobs >= self.setting("queue", Sasl.queue):
+            return False
+
+        if self._pool is None:
+            # Spawned rather than forked, so workers don't inherit (and hold open) every client socket
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.setting("workers", Sasl.workers),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+
+        try:
+            future = self._pool.submit(function, *arguments)
+        except (concurrent.futures.process.BrokenProcessPool, RuntimeError) as error:
+            self._server.log.warning("SASL worker pool failed, restarting it: " + str(error))
+            self._pool = None
+            return False
+
+        self.jobs += 1
+        future.add_done_callback(lambda done: self.results.append((callback, done)))
+        return True
+
+    # Hand finished pool jobs back to whoever queued them, called from the server loop
+    def complete(self):
+        while len(self.results):
+            callback, future = self.results.popleft()
+            self.jobs -= 1
+
+            try:
+                result = future.result()
+            except Exception as error:
+                self._server.log.warning("SASL worker job failed: " + str(error))
+                result = None
+
+            callback(result)
+
+    def succeed(self, client, account):
+        client.sasl_session = None
+        client.account = account
+        client.num_900_logged_in(account)
+        client.num_903_sasl_success()
+
+        if client.authorised:
+            self._server.links.account(client)
+
+        self._server.metrics.increment("pyrcd_sasl_total", label="success")
+
+    def fail(self, client):
+        client.sasl_session = None
+        client.num_904_sasl_fail()
+        self._server.metrics.increment("pyrcd_sasl_total", label="failure")
+
+    def abort(self, client):
+        client.sasl_session = None
+        client.num_906_sasl_aborted()
+
+    # Send a challenge, split into chunks with "+" marking a payload that ended on a chunk boundary
+    def send(self, client, message):
+        encoded = base64.b64encode(message.encode("utf-8")).decode()
+
+        for start in range(0, len(encoded), Sasl.chunk):
+            client.write("AUTHENTICATE " + encoded[start:start + Sasl.chunk])
+
+        if len(encoded) % Sasl.chunk == 0:
+            client.write("AUTHENTICATE +")
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    # "a=1,b=2" into a dict
+    @staticmethod
+    def attributes(message):
+        attributes = {}
+
+        for attribute in message.split(","):
+            key, _, value = attribute.partition("=")
+            attributes[key] = value
+
+        return attributes
+
+    # Stored form of a password: "scram-sha-256$<iterations>$<salt>$<stored key>$<server key>", base64 fields.
+    # Both mechanisms are checked against it and the password itself is never kept
+    @staticmethod
+    def hash_password(password, iterations=None, salt=None):
+        iterations = iterations or Sasl.iterations
+        salt = salt or os.urandom(16)
+        salted = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+        client_key = hmac.new(salted, b"Client Key", "sha256").digest()
+        server_key = hmac.new(salted, b"Server Key", "sha256").digest()
+
+        return "scram-sha-256${0}${1}${2}${3}".format(
+            iterations,
+            base64.b64encode(salt).decode(),
+            base64.b64encode(hashlib.sha256(client_key).digest()).decode(),
+            base64.b64encode(server_key).decode()
+        )
+
+    @staticmethod
+    def parse_credential(credential):
+        try:
+            scheme, iterations, salt, stored_key, server_key = credential.split("$")
+
+            if scheme != "scram-sha-256":
+                raise ValueError("unknown scheme " + scheme)
+
+            return int(iterations), base64.b64decode(salt), base64.b64decode(stored_key), base64.b64decode(server_key)
+        except (ValueError, binascii.Error) as error:
+            raise Sasl.SaslError("Malformed credential: " + str(error))
+
+    # Runs in a worker process: the PBKDF2 rounds are what would stall the server loop
+    @staticmethod
+    def verify_plain(credential, password):
+        iterations, salt, stored_key, server_key = Sasl.parse_credential(credential)
+        salted = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+        client_key = hmac.new(salted, b"Client Key", "sha256").digest()
+
+        return hmac.compare_digest(hashlib.sha256(client_key).digest(), stored_key)
+
+    # Check a SCRAM client proof, returns the server signature to send back or None
+    @staticmethod
+    def verify_scram(stored_key, server_key, auth_message, proof):
+        try:
+            proof = base64.b64decode(proof, validate=True)
+        except binascii.Error:
+            return None
+
+        signature = hmac.new(stored_key, auth_message, "sha256").digest()
+
+        if len(proof) != len(signature):
+            return None
+
+        client_key = bytes(a ^ b for a, b in zip(proof, signature))
+
+        if not hmac.compare_digest(hashlib.sha256(client_key).digest(), stored_key):
+            return None
+
+        return hmac.new(server_key, auth_message, "sha256").digest()
@@ -1,92 +1,508 @@
-import select
+import bisect
+import collections
+import random
+import selectors
 
+from System.capability import *
 from System.client import *
 from System.channel import *
+from System.metrics import *
+from System.profiler import *
+from System.handoff import *
+from System.persistence import *
+from System.link import *
+from System.listener import *
+from System.sasl import *
+from System.accounts import *
+from System.history import *
+from System.whowas import *
+from System.filter import *
+from System.bans import *
+from System.dnsbl import *
+from System.cloak import *
 
 
 class Server(object):
     class ServerError(Exception):
         pass
 
-    def __init__(self, config, log):
+    # Defaults for the [server] "accept_budget" and "setup_budget" settings: connections accepted, and
+    # accepted connections turned into clients, per event loop iteration
+    accept_budget = 256
+    setup_budget = 64
+
+    def __init__(self, config, log, handoff=None):
         # Reset properties
-        self._handle = None
         self.revision = 0.1
         self.started = time.time()
 
-        self.config = None
-        self.log = None
-        self.sockets = []
+        self.config = config
+        self.log = log
+
+        # Every socket the loop waits on, registered with the object that handles it
+        self.selector = selectors.DefaultSelector()
 
-        # Cached hostnames
+        # Listening sockets keyed by handle, and TLS connections still handshaking
+        self.listeners = {}
+        self.handshakes = {}
+
+        # Accepted connections waiting for their Client to be built, and clients with unsent output
+        self.pending = collections.deque()
+        self.writers = set()
+
+        # Main loop state, a successful hot restart records the new process ID in successor
+        self.running = True
+        self.restart_pending = False
+        self.rehash_pending = False
+        self.profile_pending = False
+        self.successor = None
+
+        # Cached hostnames, and finished lookups as (client, hostname or None, seconds taken) filled by the lookup
+        # threads and drained by the server loop
         self.hostnames = {}
+        self.lookups = collections.deque()
 
+        # Local clients keyed by file descriptor, nicks (local and remote) map straight to their client
         self.max_clients = 0
         self.clients = {}
+        self.uids = {}
         self.nicks = {}
         self.nicks_cased = {}
 
+        # Users on linked servers, keyed by UID
+        self.remote_clients = {}
+
+        # Registered users (local and remote) overall and per user mode, LUSERS reads its counts from
+        # these and WALLOPS/operator notices only visit the members of one set
+        self.users = set()
+        self.user_modes = {mode: set() for mode in IRC.client_modes}
+        self.max_users = 0
+
         self.channels = {}
         self.channels_cased = {}
 
-        # Initialise server socket
+        # Secondary indexes for WHO/LIST: users by (real and masked) host, nicks in sorted order for
+        # prefix lookups, and channel names bucketed by member count
+        self.hosts = {}
+        self.nicks_sorted = []
+        self.channel_sizes = {}
+
+        # WHOWAS: users who have quit or changed nick
+        self.whowas = WhoWas(config.server.get("whowas_limit", WhoWas.limit))
+
+        # MONITOR: folded nick -> local clients watching it, so presence changes only reach the watchers
+        self.monitors = {}
+
+        # Clients with WHO/LIST replies still being streamed out
+        self.streams = set()
+
+        # Instrumentation
+        self.metrics = Metrics()
+        self.metrics.collectors.append(self.collect_metrics)
+        self.profiler = Profiler(log)
+        self.thread_id = threading.get_ident()
+
+        # Permanent channel storage
+        self.persistence = None
+
+        # Registered accounts and nicks, plus users on a registered nick who have yet to log in to it
+        self.accounts = None
+        self.enforcing = {}
+
+        # Server-to-server links
+        self.links = Links(self)
+
+        # SASL authentication, password checks run on a process pool
+        self.sasl = Sasl(self)
+
+        # Recent channel messages for CHATHISTORY
+        self.history = History(self)
+
+        # K-lines and G-lines
+        self.bans = Bans()
+
+        # Keyed hashes standing in for client hosts (user mode +x)
+        self.cloak = Cloak(self)
+
+        if self.cloak.generated:
+            self.log.warning("No cloak key configured, cloaks will change when the server is started afresh")
+
+        # DNS blocklist checks of connecting addresses, run on a thread pool during registration
+        self.dnsbl = Dnsbl(self)
+
+        # Operator-defined patterns checked against every PRIVMSG/NOTICE before it's delivered
+        self.filter = Filter()
+
         try:
-            self._handle = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._handle.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self._handle.bind((config.bind["address"], config.bind["port"]))
-            self._handle.listen(10)
-        except socket.error as error:
-            raise self.ServerError("Failed to bind socket: " + str(error))
+            self.filter.load(config.filters)
+        except Filter.FilterError as error:
+            raise self.ServerError(str(error))
 
-        self.config = config
-        self.log = log
+        # Take over the sockets and state of a previous process
+        if handoff is not None:
+            try:
+                state, handles, connection = Handoff.receive(handoff)
+            except Handoff.HandoffError as error:
+                raise self.ServerError(str(error))
+
+            count = len(state["listeners"])
+
+            self.start_listeners(state["listeners"], handles[:count])
+            self.import_state(state, handles[count:])
+            Handoff.acknowledge(connection)
+            self.start_persistence(False)
+            self.start_accounts()
+        # Initialise server sockets
+        else:
+            self.start_listeners(config.bind)
+            self.start_persistence(True)
+            self.start_accounts()
+
+        self.start_metrics()
+
+        try:
+            self.links.listen()
+        except Links.LinkError as error:
+            raise self.ServerError(str(error))
+
+    # Bind (or adopt handed-over) listening sockets, TLS contexts are always built fresh
+    def start_listeners(self, entries, handles=None):
+        for position, entry in enumerate(entries):
+            try:
+                listener = Listener(self.config, entry, handles[position] if handles is not None else None)
+            except Listener.ListenerError as error:
+                raise self.ServerError(str(error))
+
+            self.listeners[listener.handle] = listener
+            self.watch(listener.handle, listener)
+            self.log.info("Listening on " + listener.describe())
+
+            if entry.get("backlog", 0) > listener.backlog:
+                self.log.warning("Backlog of {0} on {1} exceeds the kernel limit (somaxconn), using {2}".format(
+                    entry["backlog"],
+                    listener.describe(),
+                    listener.backlog
+                ))
+
+    # Optional permanent channel storage, restoring whatever was saved unless a handoff already carried it over
+    def start_persistence(self, restore):
+        if self.config.persistence is None:
+            return
+
+        try:
+            self.persistence = Persistence(
+                self.config.resolve(self.config.persistence["file"]),
+                self.log,
+                self.config.persistence.get("compact_interval", 3600)
+            )
+        except Persistence.PersistenceError as error:
+            raise self.ServerError(str(error))
+
+        if restore:
+            for state in self.persistence.restore():
+                channel = Channel(self, state["name"])
+                channel.import_state(state)
+                self.register_channel(channel.name, channel)
+
+            self.log.info("Restored {0} permanent channels".format(len(self.channels)))
+
+    # Optional account and nick registration store
+    def start_accounts(self):
+        if self.config.registration is None:
+            return
+
+        try:
+            self.accounts = Accounts(
+                self.config.resolve(self.config.registration["file"]),
+                self.log,
+                self.config.registration.get("cache_size", Accounts.cache_size)
+            )
+        except Accounts.AccountsError as error:
+            raise self.ServerError(str(error))
+
+    # Optional Prometheus text endpoint
+    def start_metrics(self):
+        if self.config.metrics is not None:
+            try:
+                self.metrics.serve(self.config.metrics["address"], self.config.metrics["port"])
+            except Metrics.MetricsError as error:
+                raise self.ServerError(str(error))
+
+    # Register a socket with the selector, events come back with handler attached
+    def watch(self, handle, handler, events=selectors.EVENT_READ):
+        self.selector.register(handle, events, handler)
+
+    # Unregister before closing, a closed socket can't be looked up any more
+    def unwatch(self, handle):
+        try:
+            self.selector.unregister(handle)
+        except (KeyError, ValueError):
+            pass
 
     def tick(self):
-        self.sockets.append(self._handle)
+        self.thread_id = threading.get_ident()
         last_check = time.time()
 
-        while True:
+        while self.running:
+            # Hot restarts are deferred to here so no command is half-handled when the state is captured
+            if self.restart_pending:
+                if self.hot_restart():
+                    break
+
+            # As are signalled rehashes, so configuration never changes under a command or a fanout
+            if self.rehash_pending:
+                self.rehash_pending = False
+
+                try:
+                    self.rehash()
+                except Configuration.ConfigError:
+                    pass
+
+            # And signalled profiles, so nothing is logged from inside a signal handler
+            if self.profile_pending:
+                self.profile_pending = False
+
+                try:
+                    self.profiler.start(self.thread_id)
+                except Profiler.ProfilerError as error:
+                    self.log.warning(str(error))
+
             # Mass ping/alive checks
             if time.time() - last_check > 1:
+                last_check = time.time()
                 self.inactive_client_check()
+                self.expire_handshakes()
+                self.sample_send_queues()
+                self.links.check()
+                self.enforce_nicks()
+                self.expire_bans()
+                self.dnsbl.expire()
+
+            # Wait for readable sockets (and writable ones, for clients with output the kernel wouldn't take yet).
+            # Waits up to 10 milliseconds when idle rather than sleeping every pass, so a busy server isn't throttled
+            timeout = 0 if len(self.pending) or self.streams_ready() else 0.01
+            select_start = time.perf_counter()
+
+            events = self.selector.select(timeout)
+
+            iteration_start = time.perf_counter()
+
+            # Nothing was ready, any time past the timeout is lag
+            if not len(events):
+                self.metrics.observe("pyrcd_loop_lag_seconds", max(0, iteration_start - select_start - timeout))
+
+            accept_budget = self.config.server.get("accept_budget", Server.accept_budget)
+
+            # The registration carries the handler, no lookups needed
+            for key, mask in events:
+                handler = key.data
+
+                # Incoming client data or room in the send buffer, skipped if it disconnected earlier in this pass
+                if isinstance(handler, Client):
+                    if mask & selectors.EVENT_WRITE and handler.active:
+                        handler.flush()
+
+                    if mask & selectors.EVENT_READ and handler.active:
+                        self.read_client(handler)
+                # Client connection pending, storms are spread over several iterations by the budget
+                elif isinstance(handler, Listener):
+                    if accept_budget > 0:
+                        accept_budget -= self.accept_clients(handler, accept_budget)
+                # Server link traffic
+                elif isinstance(handler, Link):
+                    if mask & selectors.EVENT_WRITE:
+                        handler.write_ready()
+
+                    if mask & selectors.EVENT_READ and handler.active:
+                        handler.read()
+                elif isinstance(handler, Links):
+                    handler.accept()
+                # TLS handshake in progress
+                elif key.fileobj in self.handshakes:
+                    self.continue_handshake(key.fileobj)
 
-            # Run select() on the list of socks
-            read_socks, write_socks, error_socks = select.select(self.sockets, [], [], 0)
-
-            # Loop through changed sockets
-            for sock in read_socks:
-                # Client connection pending
-                if sock == self._handle:
-                    client_sock = self._handle.accept()[0]
-                    self.sockets.append(client_sock)
-
-                    ip_address, port = client_sock.getpeername()
-                    index = "{0}:{1}".format(ip_address, port)
-                    self.clients[index] = Client(self, client_sock, (ip_address, port))
-                # Incoming client data
-                else:
-                    ip_address, port = sock.getpeername()
-                    index = "{0}:{1}".format(ip_address, port)
-                    data = sock.recv(self.config.server["recv_buffer"])
-
-                    # Successfully read data
-                    if data:
-                        # Loop through line-by-line
-                        for line in data.decode().split("\n"):
-                            if len(line):
-                                self.clients[index].handle_data(line)
-                    # Client disconnected
-                    elif not data and self.clients[index].active:
-                        self.clients[index].terminate()
-
-                    if index not in self.clients:
-                        self.sockets.remove(sock)
-
-            # Pause for 10 milliseconds to prevent excessive CPU usage
-            time.sleep(0.01)
-
-    @staticmethod
-    def resolve_ip_address(ip_address):
+            # Build clients for (some of) the connections accepted so far
+            self.setup_clients()
+
+            # Another chunk of any WHO/LIST replies whose send queue has room
+            self.continue_streams()
+
+            # Deliver finished hostname lookups, SASL verifications, DNSBL checks and account store lookups to
+            # their clients
+            self.complete_lookups()
+            self.sasl.complete()
+            self.dnsbl.complete()
+
+            if self.accounts is not None:
+                self.accounts.complete()
+
+            self.metrics.observe("pyrcd_loop_iteration_seconds", time.perf_counter() - iteration_start)
+
+    def read_client(self, client):
+        handle = client._handle
+
+        try:
+            data = handle.recv(self.config.server["recv_buffer"])
+
+            # OpenSSL may already hold the rest of a record, select() can't see that
+            while client.secure and handle.pending():
+                data += handle.recv(handle.pending())
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except OSError:
+            data = b""
+
+        # Client disconnected
+        if not data:
+            client.terminate()
+            return
+
+        self.metrics.increment("pyrcd_bytes_in_total", len(data))
+
+        # Only complete lines are handled, a partial one waits in the buffer for the rest
+        lines = (client.recv_queue + data).split(b"\n")
+        client.recv_queue = lines.pop()
+
+        # Loop through line-by-line, stopping if one of them disconnects the client
+        for line in lines:
+            if not client.active:
+                break
+
+            line = line.rstrip(b"\r").decode("utf-8", "replace")
+
+            if len(line):
+                self.metrics.increment("pyrcd_lines_in_total")
+                client.handle_data(line)
+
+    # Streams pause while the client's send queue is above its watermark, the socket drains it meanwhile
+    def streams_ready(self):
+        for client in self.streams:
+            if len(client.send_queue) < Client.stream_watermark:
+                return True
+
+        return False
+
+    def continue_streams(self):
+        for client in list(self.streams):
+            if len(client.send_queue) < Client.stream_watermark:
+                client.continue_stream()
+
+    # Drain the listener's queue (up to its accept batch and the budget left) instead of taking one connection
+    # per select() pass, returns the number accepted
+    def accept_clients(self, listener, budget):
+        accepted = listener.accept(budget)
+
+        for handle, address in accepted:
+            # Banned addresses are turned away before they cost a Client, a DNS lookup or a TLS handshake
+            ban = self.bans.check_address(address[0]) if len(self.bans) else None
+
+            if ban is not None:
+                self.reject_connection(handle, address, listener.context is None, ban)
+            # TLS clients only become clients once the handshake is done, so nothing is written to them before then
+            elif listener.context is not None:
+                self.handshakes[handle] = {"address": address, "started": time.time(), "cpu": 0}
+                self.watch(handle, self.handshakes[handle])
+            # Client setup (registration, DNS lookup thread, notices) is deferred to setup_clients()
+            else:
+                self.pending.append((handle, address))
+
+        self.metrics.observe("pyrcd_accept_batch", len(accepted), "size")
+        return len(accepted)
+
+    # Close a banned connection, plain text ones are told why first (if the socket will take it straight away)
+    def reject_connection(self, handle, address, plain, ban):
+        if plain:
+            try:
+                handle.send("ERROR :Closing Link: {0} ({1}-lined: {2})\r\n".format(
+                    address[0], ban["kind"], ban["reason"]
+                ).encode("utf-8", "replace"))
+            except OSError:
+                pass
+
+        try:
+            handle.close()
+        except OSError:
+            pass
+
+        self.metrics.increment("pyrcd_connections_banned_total", label=ban["kind"])
+        self.log.custom("BAN", "{0}:{1} rejected by {2}-line {3}".format(address[0], address[1], ban["kind"], ban["mask"]))
+
+    # Turn up to setup_budget accepted connections into clients, established clients are served in between
+    def setup_clients(self, budget=None):
+        if budget is None:
+            budget = self.config.server.get("setup_budget", Server.setup_budget)
+
+        while len(self.pending) and budget > 0:
+            handle, address = self.pending.popleft()
+            self.add_client(handle, address)
+            budget -= 1
+
+    # Clients register themselves (and may close straight away if the server is full)
+    def add_client(self, handle, address):
+        Client(self, handle, (address[0], address[1]))
+
+    # Called by Client.flush(), clients with queued output are polled for writability
+    def want_write(self, client, pending):
+        if pending and client.active:
+            if client not in self.writers:
+                self.writers.add(client)
+                self.selector.modify(client._handle, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+        elif client in self.writers:
+            self.writers.discard(client)
+
+            if client.active:
+                self.selector.modify(client._handle, selectors.EVENT_READ, client)
+
+    # Run one non-blocking handshake step, called whenever the client's socket is readable
+    def continue_handshake(self, handle):
+        pending = self.handshakes[handle]
+
+        try:
+            complete, elapsed = Listener.handshake(handle)
+        except (ssl.SSLError, OSError) as error:
+            self.metrics.increment("pyrcd_tls_handshake_failures_total")
+            self.log.custom("CONNECT", "{0}:{1} TLS handshake failed: {2}".format(pending["address"][0], pending["address"][1], error))
+            self.drop_handshake(handle)
+            return
+
+        pending["cpu"] += elapsed
+
+        if complete:
+            del self.handshakes[handle]
+            self.unwatch(handle)
+
+            self.metrics.increment("pyrcd_tls_handshakes_total")
+            self.metrics.observe("pyrcd_tls_handshake_seconds", pending["cpu"])
+
+            if handle.session_reused:
+                self.metrics.increment("pyrcd_tls_resumed_total")
+
+            self.add_client(handle, pending["address"])
+
+    def drop_handshake(self, handle):
+        self.handshakes.pop(handle, None)
+        self.unwatch(handle)
+
+        try:
+            handle.close()
+        except OSError:
+            pass
+
+    def expire_handshakes(self):
+        for handle, pending in list(self.handshakes.items()):
+            if time.time() - pending["started"] >= Listener.handshake_timeout:
+                self.metrics.increment("pyrcd_tls_handshake_failures_total")
+                self.drop_handshake(handle)
+
+    # Hand finished reverse DNS lookups to their clients
+    def complete_lookups(self):
+        while len(self.lookups):
+            client, hostname, seconds = self.lookups.popleft()
+            self.metrics.observe("pyrcd_dns_lookup_seconds", seconds)
+            client.finish_lookup(hostname, False)
+
+    # Called on a lookup thread, no server state may be touched here
+    def resolve_ip_address(self, ip_address):
         try:
             hostname = socket.gethostbyaddr(ip_address)
 
@@ -94,9 +510,198 @@ class Server(object):
                 return hostname[0]
             else:
                 raise socket.herror()
-        except socket.herror:
+        except OSError:
             return False
 
+    # Ask the main loop to stop after the current iteration
+    def stop(self):
+        self.running = False
+
+    # Serialisable snapshot of everything needed to carry on in another process
+    def export_state(self):
+        return {
+            "listeners": [listener.entry for listener in self.listeners.values()],
+            "started": self.started,
+            "max_clients": self.max_clients,
+            "max_users": self.max_users,
+            "clients": [client.export_state() for client in self.clients.values()],
+            "channels": [channel.export_state() for channel in self.channels.values()],
+            "history": self.history.export_state(),
+            "whowas": self.whowas.export_state(),
+            "bans": self.bans.export_state()
+        }
+
+    # Rebuild clients and channels from export_state(), handles line up with the "clients" list
+    def import_state(self, state, handles):
+        self.started = state["started"]
+
+        for client_state, handle in zip(state["clients"], handles):
+            Client(self, handle, client_state["address"], client_state)
+
+        for channel_state in state["channels"]:
+            channel = Channel(self, channel_state["name"])
+            channel.import_state(channel_state)
+            self.register_channel(channel.name, channel)
+
+        self.history.import_state(state.get("history", []))
+        self.whowas.import_state(state.get("whowas", []))
+        self.bans.import_state(state.get("bans", []))
+        self.max_clients = max(self.max_clients, state["max_clients"])
+        self.max_users = max(self.max_users, state.get("max_users", 0))
+        self.log.info("Took over {0} clients and {1} channels".format(len(self.clients), len(self.channels)))
+
+    # Pass the listening socket, client sockets and state to a fresh process, clients stay connected
+    def hot_restart(self):
+        self.restart_pending = False
+        self.log.info("Hot restart: handing {0} clients to a new process...".format(len(self.clients)))
+
+        # The new process binds the metrics endpoint, reopens the channel journal and relinks itself
+        self.metrics.terminate()
+        self.links.terminate("Restarting")
+
+        if self.persistence is not None:
+            self.persistence.close()
+            self.persistence = None
+
+        if self.accounts is not None:
+            self.accounts.close()
+            self.accounts = None
+
+        # TLS session state lives inside this process's OpenSSL, those clients have to reconnect
+        for handle in list(self.handshakes.keys()):
+            self.drop_handshake(handle)
+
+        # Queued output isn't part of the state, give it one last chance to go out (cutting streamed replies short)
+        self.setup_clients(len(self.pending))
+
+        for client in list(self.streams):
+            client.end_streams()
+
+        for client in list(self.clients.values()):
+            client.flush()
+
+        for client in list(self.clients.values()):
+            if client.secure:
+                client.close_link("Server restarting, please reconnect")
+
+        handles = list(self.listeners.keys()) + [client._handle for client in self.clients.values()]
+
+        try:
+            self.successor = Handoff.send(self.export_state(), handles)
+        except Handoff.HandoffError as error:
+            self.log.warning(str(error) + ", carrying on")
+            self.start_metrics()
+            self.start_persistence(False)
+            self.start_accounts()
+            self.links.listen()
+            return False
+
+        self.running = False
+        self.log.info("Hot restart: process {0} has taken over".format(self.successor))
+        return True
+
+    # Drop our copies of the handed-over sockets without shutting the connections down
+    def release(self):
+        for client in self.clients.values():
+            self.unwatch(client._handle)
+
+            try:
+                client._handle.close()
+            except OSError:
+                pass
+
+        for listener in self.listeners.values():
+            self.unwatch(listener.handle)
+            listener.close(False)
+
+    # Reload changed configuration files, raises Configuration.ConfigError and keeps the old state on failure
+    def rehash(self):
+        try:
+            changed = self.config.reload()
+        except Configuration.ConfigError as error:
+            self.log.warning("Rehash failed: " + str(error))
+            raise
+
+        self.log.debug = self.config.server["debug"]
+
+        # The new patterns only replace the old ones once they've all compiled
+        if "pyrcd.json" in changed:
+            try:
+                self.filter.load(self.config.filters)
+            except Filter.FilterError as error:
+                self.log.warning("Keeping the current filters: " + str(error))
+                self.notice_operators("Keeping the current filters: " + str(error))
+
+        self.log.info("Rehashed configuration, reloaded: " + (", ".join(changed) if len(changed) else "nothing"))
+
+        return changed
+
+    # Ban mask (see Bans.add) and disconnect the local users it covers, IRC operators excepted so they can take
+    # back a ban that was too wide. G-lines are passed on to linked servers
+    def add_ban(self, kind, mask, setter, reason, duration=0, from_link=None, when=None, expires=None):
+        ban = self.bans.add(kind, mask, setter, reason, duration, when, expires)
+
+        if kind == "G":
+            self.links.gline(ban, from_link)
+
+        self.log.custom("BAN", "{0}-line on {1} set by {2}: {3}".format(kind, ban["mask"], setter, reason))
+        self.notice_operators("{0}-line on {1} set by {2} ({3})".format(kind, ban["mask"], setter, reason))
+
+        for client in list(self.clients.values()):
+            if client.authorised and "o" not in client.modes and Bans.covers(ban, client.user, client.hostname, client.ip_address):
+                client.close_link("{0}-lined: {1}".format(kind, reason))
+
+        return ban
+
+    def remove_ban(self, kind, mask, setter, from_link=None):
+        ban = self.bans.entries.get(Mask.casefold(Bans.normalise(mask)), None)
+
+        if ban is None or ban["kind"] != kind:
+            return None
+
+        self.bans.remove(mask)
+
+        if kind == "G":
+            self.links.ungline(ban, setter, from_link)
+
+        self.log.custom("BAN", "{0}-line on {1} removed by {2}".format(kind, ban["mask"], setter))
+        self.notice_operators("{0}-line on {1} removed by {2}".format(kind, ban["mask"], setter))
+        return ban
+
+    # Called once a second, temporary bans are forgotten as their time runs out
+    def expire_bans(self):
+        for ban in self.bans.expire():
+            self.log.custom("BAN", "{0}-line on {1} expired".format(ban["kind"], ban["mask"]))
+
+    # Gauges reported alongside the counters and histograms
+    def collect_metrics(self):
+        return {
+            "pyrcd_uptime_seconds": int(time.time() - self.started),
+            "pyrcd_clients": len(self.clients),
+            "pyrcd_clients_max": self.max_clients,
+            "pyrcd_nicks": len(self.nicks),
+            "pyrcd_operators": len(self.user_modes["o"]),
+            "pyrcd_channels": len(self.channels),
+            "pyrcd_remote_clients": len(self.remote_clients),
+            "pyrcd_linked_servers": len(self.links.servers),
+            "pyrcd_tls_handshakes_pending": len(self.handshakes),
+            "pyrcd_pending_setups": len(self.pending),
+            "pyrcd_clients_send_blocked": len(self.writers),
+            "pyrcd_tls_session_cache_entries": sum(
+                listener.session_stats()["number"] for listener in self.listeners.values() if listener.context is not None
+            ),
+            "pyrcd_hostname_cache_entries": len(self.hostnames),
+            "pyrcd_account_cache_entries": len(self.accounts.cache) if self.accounts is not None else 0,
+            "pyrcd_history_bytes": self.history.size,
+            "pyrcd_whowas_entries": len(self.whowas),
+            "pyrcd_bans": len(self.bans)
+        }
+
+    # Sample the output each client has queued waiting for its socket to become writable
+    def sample_send_queues(self):
+        for client in list(self.clients.values()):
+            self.metrics.observe("pyrcd_send_queue_bytes", len(client.send_queue), "bytes")
+
     def inactive_client_check(self):
         try:
             for key, client in self.clients.items():
@@ -121,83 +726,403 @@ class Server(object):
     def register_client(self, client):
         self.log.custom("CONNECT", "{0}:{1}".format(client.ip_address, client.port))
         self.clients[client.index] = client
+        self.uids[client.uid] = client
+        self.watch(client._handle, client)
 
         if len(self.clients) > self.max_clients:
             self.max_clients = len(self.clients)
 
     def deregister_client(self, client):
+        if self.clients.get(client.index, None) is not client:
+            return
+
+        del self.clients[client.index]
+        self.uids.pop(client.uid, None)
+        self.writers.discard(client)
+        self.streams.discard(client)
+        self.unindex_host(client)
+        self.unindex_user(client)
+        self.remove_monitors(client, list(client.monitoring))
+        self.enforcing.pop(client, None)
+        self.unwatch(client._handle)
+
         if client.nick is not None:
             self.deregister_nick(client.nick)
 
         self.log.custom("DISCONNECT", "{0}:{1}".format(client.ip_address, client.port))
-        self.clients.pop(client.index, None)
+
+        # Tell everyone sharing a channel and the rest of the network
+        if client.authorised:
+            reason = client.quit_reason if client.quit_reason is not None else "Connection closed"
+
+            self.broadcast_quit(client, reason)
+            self.links.quit(client, reason)
+
+        self.remove_memberships(client)
+
+    # Drop a departing client from every channel it was in
+    def remove_memberships(self, client):
+        for name in list(client.channels):
+            channel = self.channels[name.lower()]
+            channel.remove_member(client)
+
+            if channel.destroyed:
+                self.deregister_channel(channel.name)
 
     def nick_available(self, nick):
         return nick.lower() not in self.nicks
 
-    def register_nick(self, nick, index):
-        self.nicks[nick.lower()] = index
+    # Look up a local or remote client by nick, None if nobody has it
+    def get_client(self, nick):
+        return self.nicks.get(nick.lower(), None)
+
+    def get_client_by_uid(self, uid):
+        return self.uids.get(uid, None) or self.remote_clients.get(uid, None)
+
+    # Unregistered clients hold their nick without being online as far as MONITOR is concerned, they're
+    # announced once registration completes. notify is off while a hot restart rebuilds the indexes
+    def register_nick(self, nick, client, notify=True):
+        if nick.lower() not in self.nicks:
+            bisect.insort(self.nicks_sorted, nick.lower())
+
+        self.nicks[nick.lower()] = client
         self.nicks_cased[nick.lower()] = nick
 
+        if notify and client.authorised:
+            self.monitor_online(client, nick)
+
     def deregister_nick(self, nick):
-        self.nicks.pop(nick.lower(), None)
+        client = self.nicks.pop(nick.lower(), None)
+
+        if client is not None:
+            position = bisect.bisect_left(self.nicks_sorted, nick.lower())
+            del self.nicks_sorted[position]
+
+            if client.authorised:
+                self.monitor_offline(nick)
+                self.whowas.add((
+                    nick, client.user, client.get_hostname(), client.name, client.origin, client.account, time.time()
+                ))
+
         self.nicks_cased.pop(nick.lower(), None)
 
-    def broadcast_nick(self, old_nick, new_nick):
-        client = self.clients[self.nicks[old_nick.lower()]]
-        completed = [client]
+    # Start watching nicks for client, returns the folded nicks that weren't already watched
+    def add_monitors(self, client, nicks):
+        added = []
 
-        for channel in client.channels:
-            channel = self.channels[channel.lower()]
+        for nick in nicks:
+            nick = nick.lower()
+
+            if nick not in client.monitoring:
+                client.monitoring.add(nick)
+                self.monitors.setdefault(nick, set()).add(client)
+                added.append(nick)
+
+        return added
+
+    def remove_monitors(self, client, nicks):
+        for nick in nicks:
+            nick = nick.lower()
+            client.monitoring.discard(nick)
+            watchers = self.monitors.get(nick, set())
+            watchers.discard(client)
+
+            if not len(watchers):
+                self.monitors.pop(nick, None)
+
+    # nick is passed during a nick change, before client.nick has been updated
+    def monitor_online(self, client, nick=None):
+        nick = nick or client.nick
+
+        for watcher in self.monitors.get(nick.lower(), ()):
+            watcher.num_730_monitor_online(["{0}!{1}@{2}".format(nick, client.user, client.get_hostname())])
+
+    def monitor_offline(self, nick):
+        for watcher in self.monitors.get(nick.lower(), ()):
+            watcher.num_731_monitor_offline([nick])
+
+    # Clients whose nick starts with prefix, found by bisecting the sorted nick list
+    def nicks_with_prefix(self, prefix):
+        prefix = prefix.lower()
+        position = bisect.bisect_left(self.nicks_sorted, prefix)
+        matches = []
+
+        while position < len(self.nicks_sorted) and self.nicks_sorted[position].startswith(prefix):
+            matches.append(self.nicks[self.nicks_sorted[position]])
+            position += 1
+
+        return matches
+
+    # Look up who owns client's nick (from the account store's cache when possible, never waiting on the disk),
+    # a user on somebody else's registered nick gets the grace period to log in before being renamed
+    def check_nick(self, client):
+        if self.accounts is None:
+            return
+
+        nick = client.nick
+
+        def owner_found(owner):
+            if owner is None or not client.active or client.nick != nick:
+                return
+            elif client.account is not None and client.account.lower() == owner.lower():
+                return
+
+            grace = self.config.registration.get("grace", Accounts.grace)
+            self.enforcing[client] = (nick, owner, time.time() + grace)
+            client.notice_server("{0} is a registered nick, log in to {1} within {2} seconds or it will be changed".format(
+                nick,
+                owner,
+                grace
+            ))
+
+        self.accounts.nick_owner(nick, owner_found)
+
+    # Rename users whose grace period on a registered nick ran out, called once a second
+    def enforce_nicks(self):
+        for client, (nick, owner, deadline) in list(self.enforcing.items()):
+            if not client.active or client.nick != nick or (client.account or "").lower() == owner.lower():
+                del self.enforcing[client]
+            elif time.time() >= deadline:
+                del self.enforcing[client]
+                guest = "Guest{0:05d}".format(random.randrange(100000))
+
+                while not self.nick_available(guest):
+                    guest = "Guest{0:05d}".format(random.randrange(100000))
+
+                client.notice_server("You didn't log in to {0} in time, your nick has been changed".format(owner))
+                client.cmd_nick([guest])
+
+    # Count a newly registered (or introduced) user and index it under each of its user modes
+    def index_user(self, client):
+        self.users.add(client)
+        self.max_users = max(self.max_users, len(self.users))
 
-            for server_client in channel.clients:
-                if server_client not in completed:
-                    server_client.write(client.substitute(":{identifier} NICK :" + new_nick))
-                else:
-                    completed.append(server_client)
+        for mode in client.modes:
+            self.index_user_mode(client, mode, True)
 
-    def broadcast_quit(self, index, reason):
-        client = self.clients[index]
-        completed = [client]
+    def unindex_user(self, client):
+        self.users.discard(client)
+
+        for clients in self.user_modes.values():
+            clients.discard(client)
+
+    def index_user_mode(self, client, mode, adding):
+        if mode not in self.user_modes:
+            return
+
+        if adding:
+            self.user_modes[mode].add(client)
+        else:
+            self.user_modes[mode].discard(client)
+
+    # Local users with a user mode set, e.g. "w" for WALLOPS recipients
+    def clients_with_mode(self, mode):
+        return [client for client in self.user_modes.get(mode, ()) if client.link is None]
+
+    # Network-wide WALLOPS from source (a client, local or remote), delivered to local +w users
+    def wallops(self, source, text):
+        self.fanout(self.user_modes["w"], source.substitute(":{identifier} WALLOPS :" + text))
+
+    # Server notice to local IRC operators
+    def notice_operators(self, text):
+        for client in self.clients_with_mode("o"):
+            client.notice_server(text)
+
+    # Index a registered client under its real and masked host, called again if the real host changes
+    def index_host(self, client):
+        self.unindex_host(client)
+        client.indexed_hosts = {client.hostname.lower(), client.masked_hostname.lower()}
+
+        for host in client.indexed_hosts:
+            self.hosts.setdefault(host, set()).add(client)
+
+    def unindex_host(self, client):
+        for host in getattr(client, "indexed_hosts", ()):
+            clients = self.hosts.get(host, set())
+            clients.discard(client)
+
+            if not len(clients):
+                self.hosts.pop(host, None)
+
+        client.indexed_hosts = set()
+
+    def clients_with_host(self, host):
+        return list(self.hosts.get(host.lower(), ()))
+
+    # Users a WHO mask could match. When only nicks and hosts are being matched, exact masks (and nick
+    # prefixes like "foo*") are answered from the indexes; anything else has to look at everyone
+    def who_candidates(self, mask, fields):
+        wildcards = "*" in mask or "?" in mask
+        prefix = mask.rstrip("*")
+
+        if not fields <= {"n", "h"}:
+            return list(self.nicks.values())
+
+        candidates = set()
+
+        if "n" in fields:
+            if not wildcards:
+                candidates.update(client for client in [self.get_client(mask)] if client is not None)
+            elif len(prefix) and "*" not in prefix and "?" not in prefix:
+                candidates.update(self.nicks_with_prefix(prefix))
+            else:
+                return list(self.nicks.values())
+
+        if "h" in fields:
+            if wildcards:
+                return list(self.nicks.values())
+
+            candidates.update(self.clients_with_host(mask))
+
+        return list(candidates)
+
+    # A nick or host change can change which bans match, drop the client's cached channel verdicts
+    def invalidate_verdicts(self, client):
+        for name in client.channels:
+            channel = self.channels.get(name.lower(), None)
+
+            if channel is not None:
+                channel.verdicts.pop(client, None)
+
+    # Everyone sharing at least one channel with client, client itself excluded
+    def common_clients(self, client):
+        common = set()
 
         for channel in client.channels:
-            channel = self.channels[channel.lower()]
+            common.update(self.channels[channel.lower()].clients)
+
+        common.discard(client)
+        return common
+
+    def broadcast_nick(self, client, new_nick):
+        common = self.common_clients(client)
+        self.fanout(common, client.substitute(":{identifier} NICK :" + new_nick))
+        self.metrics.observe("pyrcd_broadcast_fanout", len(common), "size")
+
+    def broadcast_quit(self, client, reason, tags=None):
+        common = self.common_clients(client)
+        self.fanout(common, client.substitute(":{identifier} QUIT :" + reason), tags)
+        self.metrics.observe("pyrcd_broadcast_fanout", len(common), "size")
+
+    # Send one line to many clients. Recipients are grouped by the capabilities that change how it's
+    # serialised, so each variant is built once per group rather than once per client
+    def fanout(self, clients, line, tags=None, required=0, now=None):
+        groups = {}
+        now = time.time() if now is None else now
+        tags = tags or {}
+
+        for client in clients:
+            # Remote clients hear about it over their link, required filters out e.g. non-message-tags clients
+            if client.link is None and client.caps & required == required:
+                groups.setdefault(client.caps & Capability.serialised, []).append(client)
+
+        for caps, members in groups.items():
+            rendered = Capability.render(line, caps, tags, now)
+            encoded = (rendered + "\r\n").encode("utf-8", "replace")
+
+            for client in members:
+                client.write_encoded(rendered, encoded)
 
-            for server_client in channel.clients:
-                if server_client not in completed:
-                    server_client.write(client.substitute(":{identifier} QUIT :" + reason))
-                else:
-                    completed.append(server_client)
+    # Open a batch on every client in clients that negotiated it, returns the reference for the "batch" tag
+    def start_batch(self, clients, batch_type, *parameters):
+        reference = Capability.reference()
+        self.fanout(clients, ":{0} BATCH +{1} {2}".format(
+            self.config.server["fqdn"],
+            reference,
+            " ".join((batch_type,) + parameters)
+        ), required=Capability.batch)
+
+        return reference
+
+    def end_batch(self, clients, reference):
+        self.fanout(clients, ":{0} BATCH -{1}".format(self.config.server["fqdn"], reference), required=Capability.batch)
 
     def terminate(self):
-        self._handle.close()
+        # A successor owns the Unix socket files now, leave them in place
+        for listener in self.listeners.values():
+            self.unwatch(listener.handle)
+            listener.close(self.successor is None)
+
+        for handle in list(self.handshakes.keys()):
+            self.drop_handshake(handle)
+
+        while len(self.pending):
+            self.pending.popleft()[0].close()
+
+        self.metrics.terminate()
+        self.links.terminate("Server shutting down")
+        self.sasl.shutdown()
+        self.dnsbl.shutdown()
+
+        if self.persistence is not None:
+            self.persistence.close()
+            self.persistence = None
+
+        if self.accounts is not None:
+            self.accounts.close()
+            self.accounts = None
+
+        self.selector.close()
 
     def register_channel(self, channel, channel_object):
         self.channels[channel.lower()] = channel_object
         self.channels_cased[channel.lower()] = channel
+        self.channel_sizes.setdefault(len(channel_object.clients), set()).add(channel.lower())
 
     def deregister_channel(self, channel):
-        self.channels.pop(channel.lower(), None)
+        channel_object = self.channels.pop(channel.lower(), None)
         self.channels_cased.pop(channel.lower(), None)
 
+        if channel_object is not None:
+            self.unsize_channel(channel.lower(), len(channel_object.clients))
+            self.history.drop(channel)
+
+    # Move a channel to the bucket for its new member count, called by Channel on joins and parts
+    def resize_channel(self, channel, previous):
+        if self.channels.get(channel.name.lower(), None) is channel:
+            self.unsize_channel(channel.name.lower(), previous)
+            self.channel_sizes.setdefault(len(channel.clients), set()).add(channel.name.lower())
+
+    def unsize_channel(self, name, size):
+        bucket = self.channel_sizes.get(size, set())
+        bucket.discard(name)
+
+        if not len(bucket):
+            self.channel_sizes.pop(size, None)
+
+    # Channels with more than minimum and fewer than maximum members, largest first. Yields lazily so a
+    # LIST can be streamed, each bucket is copied only when it's reached
+    def channels_by_size(self, minimum=-1, maximum=None):
+        for size in sorted(self.channel_sizes.keys(), reverse=True):
+            if size <= minimum:
+                break
+            elif maximum is not None and size >= maximum:
+                continue
+
+            for name in list(self.channel_sizes.get(size, ())):
+                channel = self.channels.get(name, None)
+
+                if channel is not None:
+                    yield channel
+
     def channel_exists(self, channel):
         return channel.lower() in self.channels
 
-    def terminate_clients(self):
-        for client in set(self.clients):
-            self.clients[client].active = False
-            self.clients[client].terminate()
+    def terminate_clients(self, reason="Server shutting down"):
+        for client in list(self.clients.values()):
+            client.close_link(reason)
 
-    def private_message(self, client_index, target_nick, text):
-        client = self.clients[client_index]
-        target = self.clients[self.nicks[target_nick.lower()]]
+    def private_message(self, client, target_nick, text):
+        target = self.get_client(target_nick)
 
-        target.write(client.substitute(":{identifier} PRIVMSG {0} :{1}").format(target.nick, text))
-        self.log.custom("PRIVMSG", "[{0}] [1]: {2}".format(client.nick, target.nick, text))
+        if target.link is not None:
+            self.links.private_message(client, target, "PRIVMSG", text)
 
-    def channel_message(self, client_index, target_channel, text):
-        client = self.clients[client_index]
+        self.deliver(client, target, client.substitute(":{identifier} PRIVMSG {0} :{1}").format(target.nick, text))
 
+        self.log.custom("PRIVMSG", "[{0} to {1}]: {2}".format(client.nick, target.nick, text))
+
+    def channel_message(self, client, target_channel, text):
         # Channel exists
         if target_channel.lower() in self.channels:
             channel = self.channels[target_channel.lower()]
@@ -206,16 +1131,30 @@ class Server(object):
         else:
             client.num_403_no_such_channel(target_channel)
 
-    def private_notice(self, client_index, target_nick, text):
-        client = self.clients[client_index]
-        target = self.clients[self.nicks[target_nick.lower()]]
+    def private_notice(self, client, target_nick, text):
+        target = self.get_client(target_nick)
+
+        if target.link is not None:
+            self.links.private_message(client, target, "NOTICE", text)
 
-        target.write(client.substitute(":{identifier} NOTICE {0} :{1}").format(target.nick, text))
+        self.deliver(client, target, client.substitute(":{identifier} NOTICE {0} :{1}").format(target.nick, text))
         self.log.custom("NOTICE", "[{0} to {1}]: {2}".format(client.nick, target.nick, text))
 
-    def channel_notice(self, client_index, target_channel, text):
-        client = self.clients[client_index]
+    # Tags only, nothing is sent to clients that can't see tags
+    def private_tagmsg(self, client, target_nick):
+        target = self.get_client(target_nick)
+        self.deliver(client, target, client.substitute(":{identifier} TAGMSG " + target.nick), Capability.message_tags)
+
+    # Private message to target (fanout skips remote ones), echoed back if the sender asked for echo-message
+    def deliver(self, client, target, line, required=0):
+        recipients = [target]
+
+        if client.caps & Capability.echo_message and target is not client:
+            recipients.append(client)
 
+        self.fanout(recipients, line, client.tags, required)
+
+    def channel_notice(self, client, target_channel, text):
         # Channel exists
         if target_channel.lower() in self.channels:
             channel = self.channels[target_channel.lower()]
@@ -224,26 +1163,53 @@ class Server(object):
         else:
             client.num_403_no_such_channel(target_channel)
 
-    def channel_join(self, client_index, target_channel, arguments):
-        client = self.clients[client_index]
+    def channel_tagmsg(self, client, target_channel):
+        # Channel exists
+        if target_channel.lower() in self.channels:
+            channel = self.channels[target_channel.lower()]
+            channel.handle_tagmsg(client)
+        # Channel does not exist
+        else:
+            client.num_403_no_such_channel(target_channel)
 
+    def channel_join(self, client, target_channel, arguments):
         # Channel already exists
         if target_channel.lower() in self.channels:
-            channel = self.channels[self.channels_cased[target_channel.lower()]]
+            channel = self.channels[target_channel.lower()]
+
+            # An invite gets past +i, +k and +l (but not bans), and is used up by the join
+            invited = channel.invited(client)
+
+            if "i" in channel.modes and not invited:
+                client.num_473_invite_only_channel(channel.name)
+                return
+            elif "k" in channel.modes and arguments != channel.modes["k"] and not invited:
+                client.num_475_bad_channel_key(channel.name)
+                return
+            elif "l" in channel.modes and len(channel.clients) >= int(channel.modes["l"]) and not invited:
+                client.num_471_channel_is_full(channel.name)
+                return
+            elif channel.banned(client):
+                client.num_474_banned_from_channel(channel.name)
+                return
+
+            channel.invited(client, True)
             channel.join_client(client, arguments)
-        # Channel doesn't exist
+        # Channel doesn't exist, new channels start out +nt
         else:
             channel = Channel(self, target_channel)
+            channel.modes = {"n": "", "t": ""}
             self.register_channel(channel.name, channel)
             channel.join_client(client, arguments)
 
+        self.links.join(client, channel)
         self.log.custom("JOIN", "[{0}]: {1}".format(channel.name, client.nick))
 
-    def channel_part(self, client_index, target_channel, arguments):
-        client = self.clients[client_index]
-        channel = self.channels[self.channels_cased[target_channel.lower()]]
+    def channel_part(self, client, target_channel, arguments):
+        channel = self.channels[target_channel.lower()]
 
         channel.remove_client(client, arguments)
+        self.links.part(client, channel, arguments)
         self.log.custom("PART", "[{0}]: {1}".format(channel.name, client.nick))
 
         if channel.destroyed:
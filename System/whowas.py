@@ -0,0 +1,47 @@
+import collections
+import itertools
+
+
+class WhoWas(object):
+    # Default for the [server] "whowas_limit" setting, departed users remembered across all nicks
+    limit = 4096
+
+    # A fixed ring of records, each (nick, user, host, real name, server, account, time). Once it's full every
+    # new record overwrites the oldest one, so memory never grows past the limit
+    def __init__(self, limit=None):
+        self.slots = [None] * (limit or WhoWas.limit)
+        self.position = 0
+
+        # Folded nick -> ring positions holding its records, oldest first
+        self.nicks = {}
+
+    def __len__(self):
+        return len(self.slots) - self.slots.count(None)
+
+    def add(self, record):
+        previous = self.slots[self.position]
+
+        # The slot being reused holds the oldest record overall, so it's also the oldest one for its nick
+        if previous is not None:
+            positions = self.nicks[previous[0].lower()]
+            positions.popleft()
+
+            if not len(positions):
+                del self.nicks[previous[0].lower()]
+
+        self.slots[self.position] = record
+        self.nicks.setdefault(record[0].lower(), collections.deque()).append(self.position)
+        self.position = (self.position + 1) % len(self.slots)
+
+    # Records for nick, newest first, at most count of them if count is given
+    def lookup(self, nick, count=None):
+        positions = self.nicks.get(nick.lower(), ())
+        return [self.slots[position] for position in itertools.islice(reversed(positions), count)]
+
+    # Records oldest first, for carrying them across a hot restart
+    def export_state(self):
+        return [record for record in self.slots[self.position:] + self.slots[:self.position] if record is not None]
+
+    def import_state(self, state):
+        for record in state:
+            self.add(tuple(record))
@@ -1,57 +1,103 @@
 #!/usr/bin/env python3
 
+import signal
+
 # pyrcd libraries
 from System.log import *
 from System.configuration import *
 from System.server import *
 
 
-# Base directory of pyrcd
-_HOME_ = os.path.dirname(os.path.realpath(__file__))
-
-# Initialise some crap to suppress warnings
-log = None
-config = None
-server = None
-
-# Logging
-try:
-    log = Log(_HOME_ + "/Logs/", 1)
-    log.info("pyrcd starting...")
-except Log.LogError as error:
-    sys.exit(str(error) + ", exiting.")
-
-# Version check
-if sys.version_info[0] != 3:
-    log.error("pyrcd requires Python 3")
-
-# Configuration
-keys = {
-    "bind": ["address", "port"],
-    "server": ["debug", "fqdn", "name", "client_limit", "recv_buffer", "motd", "rules"]
-}
-
-try:
-    config = Configuration(_HOME_ + "/Configuration/", keys)
-    log.info("Configuration successfully loaded")
-except Configuration.ConfigError as error:
-    log.error(str(error) + ", exiting.")
-
-log.debug = config.server["debug"]
-log.info("Attempting to bind to {0}:{1}...".format(config.bind["address"], config.bind["port"]))
-
-# Server socket
-try:
-    server = Server(config, log)
-except Server.ServerError as error:
-    log.error(str(error))
-
-log.info("Successfully bound to {0}:{1}".format(config.bind["address"], config.bind["port"]))
-
-# Enter continuous execution
-try:
-    server.tick()
-except KeyboardInterrupt:
-    log.info("Caught interrupt signal, exiting.")
-    server.terminate_clients()
-    server.terminate()
\ No newline at end of file
+# Worker processes (e.g. the SASL pool) import this file too, only the main process runs a server
+if __name__ == "__main__":
+    # Base directory of pyrcd
+    _HOME_ = os.path.dirname(os.path.realpath(__file__))
+
+    # Initialise some crap to suppress warnings
+    log = None
+    config = None
+    server = None
+
+    # Logging
+    try:
+        log = Log(_HOME_ + "/Logs/", 1)
+        log.info("pyrcd starting...")
+    except Log.LogError as error:
+        sys.exit(str(error) + ", exiting.")
+
+    # Version check
+    if sys.version_info[0] != 3:
+        log.error("pyrcd requires Python 3")
+
+    # Configuration
+    keys = {
+        "bind": [],
+        "server": ["debug", "fqdn", "name", "client_limit", "recv_buffer", "motd", "rules"]
+    }
+
+    try:
+        config = Configuration(_HOME_ + "/Configuration/", keys)
+        log.info("Configuration successfully loaded")
+    except Configuration.ConfigError as error:
+        log.error(str(error) + ", exiting.")
+
+    log.debug = config.server["debug"]
+
+    # Hot restarts start us with "--handoff <path>" to take over the previous process's sockets
+    handoff = None
+
+    if "--handoff" in sys.argv[1:-1]:
+        handoff = sys.argv[sys.argv.index("--handoff") + 1]
+        log.info("Taking over from the previous process via {0}...".format(handoff))
+    else:
+        log.info("Binding {0} listener{1}...".format(len(config.bind), "s" if len(config.bind) > 1 else ""))
+
+    # Server socket
+    try:
+        server = Server(config, log, handoff)
+    except Server.ServerError as error:
+        log.error(str(error))
+
+    # SIGUSR1 starts a sampling profile of the server thread without a restart
+    if hasattr(signal, "SIGUSR1"):
+        def handle_profile_signal(signum, frame):
+            server.profile_pending = True
+
+        signal.signal(signal.SIGUSR1, handle_profile_signal)
+
+    # SIGHUP reloads changed configuration files
+    if hasattr(signal, "SIGHUP"):
+        def handle_rehash_signal(signum, frame):
+            server.rehash_pending = True
+
+        signal.signal(signal.SIGHUP, handle_rehash_signal)
+
+    # SIGUSR2 hands every connection over to a freshly started process
+    if hasattr(signal, "SIGUSR2"):
+        def handle_restart_signal(signum, frame):
+            server.restart_pending = True
+
+        signal.signal(signal.SIGUSR2, handle_restart_signal)
+
+    # SIGTERM shuts down as gracefully as an interrupt
+    if hasattr(signal, "SIGTERM"):
+        def handle_terminate_signal(signum, frame):
+            server.stop()
+
+        signal.signal(signal.SIGTERM, handle_terminate_signal)
+
+    # Enter continuous execution
+    try:
+        server.tick()
+    except KeyboardInterrupt:
+        log.info("Caught interrupt signal, exiting.")
+
+    # Clients now belong to the new process, leave their connections open
+    if server.successor is not None:
+        log.info("Handed over to process {0}, exiting.".format(server.successor))
+        server.release()
+        server.terminate()
+    else:
+        log.info("Shutting down, disconnecting {0} clients.".format(len(server.clients)))
+        server.terminate_clients()
+        server.terminate()
\ No newline at end of file
@@ -0,0 +1,66 @@
+import ipaddress
+import random
+import pytest
+from System.bans import *
+
+
+# Most specific added network containing address, the answer the tries should give
+def reference(networks, address):
+    address = ipaddress.ip_address(address)
+    covering = [network for network in networks if network.version == address.version and address in network]
+
+    return max(covering, key=lambda network: network.prefixlen) if len(covering) else None
+
+
+def addresses(generator, version, count):
+    # Networks and addresses are drawn from a small space so prefixes nest, branch and share nodes
+    if version == 4:
+        return [str(ipaddress.IPv4Address(0x0A000000 | generator.getrandbits(12) << 4)) for _ in range(count)]
+
+    return [str(ipaddress.IPv6Address(0x20010DB8 << 96 | generator.getrandbits(12) << 84)) for _ in range(count)]
+
+
+@pytest.mark.parametrize("version", [4, 6])
+def test_check_address_agrees_with_linear_scan(version):
+    generator = random.Random(version)
+    bits = 32 if version == 4 else 128
+    bans = Bans()
+    networks = set()
+
+    for address in addresses(generator, version, 300):
+        network = ipaddress.ip_network("{0}/{1}".format(address, generator.randint(bits - 28, bits)), strict=False)
+        bans.add("K", "*@" + str(network), "setter", "reason")
+        networks.add(network)
+
+    probes = addresses(generator, version, 1000)
+
+    for _ in range(2):
+        assert len(bans.networks[version]) == len(networks)
+
+        for address in probes:
+            expected = reference(networks, address)
+            entry = bans.check_address(address)
+
+            assert (entry["mask"] if entry is not None else None) == ("*@" + str(expected) if expected is not None else None), address
+
+        # Then take half of them out again and look once more
+        for network in generator.sample(sorted(networks), len(networks) // 2):
+            assert bans.remove(str(network)) is not None
+            networks.discard(network)
+
+
+def test_ipv4_mapped_addresses_hit_ipv4_bans():
+    bans = Bans()
+    bans.add("K", "*@192.0.2.0/24", "setter", "reason")
+
+    assert bans.check_address("::ffff:192.0.2.1")["mask"] == "*@192.0.2.0/24"
+    assert bans.check_address("192.0.3.1") is None
+    assert bans.check_address("localhost") is None
+
+
+def test_removing_a_missing_network_leaves_the_trie_alone():
+    bans = Bans()
+    bans.add("K", "*@10.0.0.0/8", "setter", "reason")
+
+    assert bans.remove("10.0.0.0/16") is None
+    assert bans.check_address("10.1.2.3")["mask"] == "*@10.0.0.0/8"
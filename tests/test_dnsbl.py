@@ -0,0 +1,167 @@
+import socket
+import struct
+import threading
+import time
+import pytest
+from System.dnsbl import *
+
+
+class FakeServer(object):
+    def __init__(self, settings):
+        self.config = type("Configuration", (object,), {"dnsbl": settings})()
+        self.metrics = type("Metrics", (object,), {"increment": lambda *args, **kwargs: None, "observe": lambda *args, **kwargs: None})()
+        self.log = type("Log", (object,), {"warning": lambda *args: None, "custom": lambda *args: None})()
+
+
+class FakeClient(object):
+    def __init__(self, ip_address):
+        self.ip_address = ip_address
+        self.dnsbl_pending = False
+        self.active = True
+        self.authorised = False
+        self.closed = None
+
+    def check_authorisation(self):
+        self.authorised = True
+
+    def close_link(self, reason):
+        self.closed = reason
+
+
+class FakeResolver(object):
+    # A UDP "nameserver" on localhost, replying to each question with whatever reply() returns (None stays silent)
+    def __init__(self, reply):
+        self.reply = reply
+        self.handle = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.handle.bind(("127.0.0.1", 0))
+        self.handle.settimeout(0.1)
+        self.port = self.handle.getsockname()[1]
+        self.questions = []
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            try:
+                data, source = self.handle.recvfrom(4096)
+            except OSError:
+                continue
+
+            self.questions.append(data)
+            response = self.reply(data)
+
+            if response is not None:
+                self.handle.sendto(response, source)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.handle.close()
+
+
+# Response to question listing the address as 127.0.0.2, answering with identifier if given
+def listed(question, identifier=None):
+    header = struct.pack("!HHHHHH", identifier if identifier is not None else struct.unpack("!H", question[:2])[0], 0x8180, 1, 1, 0, 0)
+    record = struct.pack("!HHHIH", 0xC00C, 1, 1, 600, 4) + socket.inet_aton("127.0.0.2")
+
+    return header + question[12:] + record
+
+
+@pytest.fixture
+def resolver(request):
+    resolver = FakeResolver(request.param)
+    yield resolver
+    resolver.close()
+
+
+def settings(resolver, timeout=0.3):
+    return {"zones": [{"zone": "bl.test", "reason": "Listed"}], "nameserver": "127.0.0.1", "port": resolver.port, "timeout": timeout}
+
+
+def wait(dnsbl, seconds):
+    stop = time.time() + seconds
+
+    while not len(dnsbl.results) and time.time() < stop:
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize("resolver", [lambda question: None], indirect=True)
+def test_silent_resolver_times_out_on_the_loop(resolver):
+    dnsbl = Dnsbl(FakeServer(settings(resolver)))
+    client = FakeClient("192.0.2.1")
+    clone = FakeClient("192.0.2.1")
+
+    dnsbl.check(client)
+    dnsbl.check(clone)
+    deadline = dnsbl.waiting["192.0.2.1"][0]
+
+    assert client.dnsbl_pending and clone.dnsbl_pending
+
+    # Nothing happens before the deadline, then both clones go on to register unchecked
+    dnsbl.expire(deadline - 0.01)
+    assert not client.authorised
+
+    dnsbl.expire(deadline)
+    assert client.authorised and clone.authorised
+    assert not client.dnsbl_pending and not len(dnsbl.waiting)
+
+    # The query gives up at the same deadline, and an unanswered check isn't cached
+    wait(dnsbl, 2)
+    dnsbl.complete()
+    assert dnsbl.cache.get("192.0.2.1", None) is None
+    assert len(resolver.questions) == 1
+
+    dnsbl.shutdown()
+
+
+def test_stuck_pool_still_releases_clients():
+    dnsbl = Dnsbl(FakeServer({"zones": [{"zone": "bl.test"}], "timeout": 0.1}))
+    release = threading.Event()
+    dnsbl.query = lambda name, zones, deadline: (release.wait(5), (False, 60))[1]
+    client = FakeClient("192.0.2.2")
+
+    dnsbl.check(client)
+    dnsbl.expire(time.time() + 1)
+    assert client.authorised and not client.dnsbl_pending
+
+    # A late result is cached for the next connection from that address
+    release.set()
+    wait(dnsbl, 2)
+    dnsbl.complete()
+    assert dnsbl.cache.get("192.0.2.2", None) is False
+
+    dnsbl.shutdown()
+
+
+@pytest.mark.parametrize("resolver", [listed], indirect=True)
+def test_listed_address_is_disconnected_and_cached(resolver):
+    dnsbl = Dnsbl(FakeServer(settings(resolver, timeout=2)))
+    client = FakeClient("192.0.2.3")
+
+    dnsbl.check(client)
+    wait(dnsbl, 2)
+    dnsbl.complete()
+
+    assert client.closed == "Listed" and not client.authorised
+    assert dnsbl.cache.get("192.0.2.3", None)["zone"] == "bl.test"
+
+    # The next connection from the address is answered from the cache without asking again
+    again = FakeClient("192.0.2.3")
+    dnsbl.check(again)
+    assert again.closed == "Listed" and len(resolver.questions) == 1
+
+    dnsbl.shutdown()
+
+
+@pytest.mark.parametrize("resolver", [lambda question: listed(question, identifier=struct.unpack("!H", question[:2])[0] ^ 1)], indirect=True)
+def test_reply_to_another_question_is_ignored(resolver):
+    dnsbl = Dnsbl(FakeServer(settings(resolver)))
+
+    assert dnsbl.query("1.2.0.192", dnsbl.setting("zones", []), time.time() + 0.3) == (None, 0)
+
+
+def test_reply_must_come_from_the_nameserver():
+    assert Dnsbl.same_address(("127.0.0.1", 53), ("127.0.0.1", 53))
+    assert not Dnsbl.same_address(("127.0.0.1", 5353), ("127.0.0.1", 53))
+    assert not Dnsbl.same_address(("127.0.0.2", 53), ("127.0.0.1", 53))
@@ -0,0 +1,51 @@
+import fnmatch
+import random
+from System.mask import *
+
+
+# fnmatch with only "*" and "?" special, the way masks treat them
+def reference(mask, subject):
+    return fnmatch.fnmatchcase(Mask.casefold(subject), Mask.casefold(mask).replace("[", "[[]"))
+
+
+def masks(generator, count):
+    return ["".join(generator.choice("aAbB*?[]!@.") for _ in range(generator.randint(0, 8))) for _ in range(count)]
+
+
+def test_match_agrees_with_fnmatch():
+    generator = random.Random(1459)
+    subjects = ["".join(generator.choice("aAbB[]!@.") for _ in range(generator.randint(0, 8))) for _ in range(300)]
+
+    for mask in masks(generator, 300):
+        for subject in subjects:
+            assert Mask.match(mask, subject) == reference(mask, subject), (mask, subject)
+
+
+def test_match_folds_ascii_only():
+    assert Mask.match("*!*@HOST.example", "nick!user@host.EXAMPLE")
+    assert not Mask.match("nick[a]", "nick{a}")
+    assert not Mask.match("nick~", "nick^")
+
+
+def test_mask_list_agrees_with_linear_scan():
+    generator = random.Random(2812)
+    entries = MaskList()
+    added = []
+
+    for mask in masks(generator, 200):
+        if entries.add(mask, "setter"):
+            added.append(mask)
+
+    for mask in added[::3]:
+        assert entries.remove(mask)
+
+    remaining = [mask for mask in added if mask in entries]
+
+    for _ in range(500):
+        subject = "".join(generator.choice("aAbB[]!@.") for _ in range(generator.randint(0, 8)))
+        found = entries.match([subject])
+
+        assert (found is not None) == any(reference(mask, subject) for mask in remaining), subject
+
+        if found is not None:
+            assert reference(found["mask"], subject)